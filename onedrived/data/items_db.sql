@@ -15,3 +15,27 @@ CREATE TABLE IF NOT EXISTS items (
   record_time   TEXT,
   PRIMARY KEY (parent_path, name) ON CONFLICT REPLACE
 );
+
+CREATE INDEX IF NOT EXISTS items_content ON items (sha1_hash, size);
+
+CREATE TABLE IF NOT EXISTS repo_state (
+  key   TEXT PRIMARY KEY ON CONFLICT REPLACE,
+  value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS dir_snapshots (
+  path     TEXT PRIMARY KEY ON CONFLICT REPLACE,
+  mtime_ns INT
+);
+
+CREATE TABLE IF NOT EXISTS task_journal (
+  seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+  task_type TEXT,
+  rel_path  TEXT,
+  item_id   TEXT,
+  etag      TEXT,
+  args      TEXT,
+  in_memory INT DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS task_journal_rel_path ON task_journal (rel_path);
@@ -1,14 +1,18 @@
 import json
 import logging
 import time
+import urllib.parse
 
 import onedrivesdk
 import onedrivesdk.error
 import requests
+from onedrivesdk.options import HeaderOption
 
-from . import od_dateutils
+from . import od_dateutils, od_trace
 
 THROTTLE_PAUSE_SEC = 60
+COPY_POLL_INTERVAL_SEC = 1
+COPY_TIMEOUT_SEC = 600
 
 
 def get_drive_request_builder(repo):
@@ -67,7 +71,33 @@ def get_item_created_datetime(item):
     return od_dateutils.str_to_datetime(item._prop_dict['createdDateTime'])
 
 
+def get_item_parent_relpath(item):
+    """
+    Read path of the parent of an item relative to Drive root (e.g., '' for items under root) from its
+    parentReference facet. Drive root and deleted items returned by delta API may carry no path.
+    :param onedrivesdk.Item item:
+    :return str | None:
+    """
+    parent_reference = item.parent_reference
+    if parent_reference is None or parent_reference.path is None:
+        return None
+    # The path looks like "/drive/root:/foo/bar" and is percent-encoded.
+    _, _, relpath = parent_reference.path.partition(':')
+    return urllib.parse.unquote(relpath)
+
+
 def item_request_call(repo, request_func, *args, **kwargs):
+    # Name the span after the request class and method (e.g., "ItemRequestBuilder.download"), and record the URL so
+    # that a stalled call can be told apart from others of the same kind.
+    owner = getattr(request_func, '__self__', None)
+    name = getattr(request_func, '__name__', 'request')
+    if owner is not None:
+        name = type(owner).__name__ + '.' + name
+    with od_trace.span(name, 'api', url=getattr(owner, '_request_url', None)):
+        return _item_request_call(repo, request_func, *args, **kwargs)
+
+
+def _item_request_call(repo, request_func, *args, **kwargs):
     while True:
         try:
             return request_func(*args, **kwargs)
@@ -82,3 +112,45 @@ def item_request_call(repo, request_func, *args, **kwargs):
         except requests.ConnectionError as e:
             logging.error('Encountered connection error: %s. Retry in %d sec.', e, THROTTLE_PAUSE_SEC)
             time.sleep(THROTTLE_PAUSE_SEC)
+
+
+def copy_item(repo, item_id, parent_relpath, name):
+    """
+    Copy a remote item to another path in the same Drive with the copy action, and wait until the server finishes.
+    No data is transferred between local and remote.
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param str item_id: ID of the item to copy.
+    :param str parent_relpath: Relative path of the directory to copy the item to.
+    :param str name: Name of the copy.
+    :return str | None: ID of the copy, or None if copying failed or did not finish in COPY_TIMEOUT_SEC.
+    """
+    ref = onedrivesdk.ItemReference()
+    ref.path = '/drives/' + repo.drive.id + '/root:' + parent_relpath
+    copy_request = repo.authenticator.client.item(drive=repo.drive.id, id=item_id).copy(
+        name=name, parent_reference=ref).request()
+    # ItemCopyRequest.post() polls the status on a thread of its own without pause. Send the request directly.
+    copy_request.content_type = 'application/json'
+    copy_request.append_option(HeaderOption('Prefer', 'respond-async'))
+    response = item_request_call(repo, copy_request.send, copy_request.body_options)
+    monitor_url = response.headers['Location']
+    deadline = time.time() + COPY_TIMEOUT_SEC
+    while time.time() < deadline:
+        # The monitor URL takes no authentication. When the copy finishes, it redirects to the new item.
+        with od_trace.span('copy_status', 'api', url=monitor_url):
+            status_response = requests.get(monitor_url, allow_redirects=False)
+        if status_response.status_code == requests.codes.see_other:
+            return status_response.headers['Location'].rstrip('/').rsplit('/', maxsplit=1)[-1]
+        try:
+            status = status_response.json()
+        except ValueError:
+            status = {}
+        if status.get('status') == 'completed':
+            return status.get('resourceId')
+        if status_response.status_code >= 400 or status.get('status') in ('failed', 'deleteFailed'):
+            logging.error('Server failed to copy item %s to "%s/%s": %s.',
+                          item_id, parent_relpath, name, status_response.text)
+            return None
+        time.sleep(COPY_POLL_INTERVAL_SEC)
+    logging.error('Server did not finish copying item %s to "%s/%s" in %d seconds.',
+                  item_id, parent_relpath, name, COPY_TIMEOUT_SEC)
+    return None
@@ -0,0 +1,158 @@
+"""
+od_cache.py
+A size-capped local store of file content keyed by SHA-1. It keeps copies of files that sync removes locally, so that
+when the remote items come back (e.g., restored from the recycle bin) they are restored without downloading.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+import collections
+import logging
+import os
+import tempfile
+import threading
+
+from . import mkdir
+from .od_fileutils import clone_file
+
+
+class ContentCache:
+    """Stores one file per SHA-1 value and evicts the least recently used files when over the byte budget."""
+
+    TEMP_SUFFIX = '.tmp'
+
+    def __init__(self, cache_dir, max_bytes, uid):
+        """
+        :param str cache_dir: Directory to store cached files. Created if missing.
+        :param int max_bytes: Max total size of cached files.
+        :param int uid: Owner of the cache directory.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Maps SHA-1 value to file size, from least to most recently used.
+        self._entries = collections.OrderedDict()
+        self._total_bytes = 0
+        mkdir(cache_dir, uid, mode=0o700, exist_ok=True)
+        self._load()
+
+    def _get_path(self, sha1_hash):
+        return self.cache_dir + '/' + sha1_hash
+
+    def _load(self):
+        files = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.endswith(self.TEMP_SUFFIX) or not entry.is_file(follow_symlinks=False):
+                    # Left by an interrupted copy.
+                    os.remove(entry.path)
+                    continue
+                stat = entry.stat(follow_symlinks=False)
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        # Files are touched when used, so mtime orders them by recency.
+        for _, sha1_hash, size in sorted(files):
+            self._entries[sha1_hash] = size
+            self._total_bytes += size
+        with self._lock:
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 0:
+            sha1_hash, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._get_path(sha1_hash))
+            except OSError as e:
+                logging.error('Error evicting cached file "%s": %s.', sha1_hash, e)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def __contains__(self, sha1_hash):
+        return sha1_hash.upper() in self._entries
+
+    def add_file(self, path, sha1_hash):
+        """
+        Copy a file into the cache. The caller must make sure the file has the given SHA-1 value.
+        :param str path:
+        :param str sha1_hash:
+        :return True | False: Whether or not the content is in the cache.
+        """
+        sha1_hash = sha1_hash.upper()
+        with self._lock:
+            if sha1_hash in self._entries:
+                self._entries.move_to_end(sha1_hash)
+                os.utime(self._get_path(sha1_hash))
+                return True
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return False
+        fd, tmp_path = tempfile.mkstemp(suffix=self.TEMP_SUFFIX, dir=self.cache_dir)
+        os.close(fd)
+        try:
+            clone_file(path, tmp_path)
+            os.rename(tmp_path, self._get_path(sha1_hash))
+        except OSError:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            if sha1_hash not in self._entries:
+                self._entries[sha1_hash] = size
+                self._total_bytes += size
+            self._entries.move_to_end(sha1_hash)
+            self._evict()
+        logging.debug('Cached content of file "%s".', path)
+        return True
+
+    def copy_file(self, sha1_hash, dst_path):
+        """
+        :param str sha1_hash:
+        :param str dst_path:
+        :return str | None: How the data was copied to dst_path (see od_fileutils.clone_file), or None if the content
+            is not in the cache.
+        """
+        sha1_hash = sha1_hash.upper()
+        with self._lock:
+            if sha1_hash not in self._entries:
+                return None
+            self._entries.move_to_end(sha1_hash)
+        path = self._get_path(sha1_hash)
+        try:
+            method = clone_file(path, dst_path)
+            os.utime(path)
+            return method
+        except FileNotFoundError:
+            # Evicted by another thread.
+            return None
+
+    def open_file(self, sha1_hash):
+        """
+        :param str sha1_hash:
+        :return file | None: The cached file opened for reading, or None if the content is not in the cache. The file
+            stays readable even if it's evicted before closed.
+        """
+        sha1_hash = sha1_hash.upper()
+        with self._lock:
+            if sha1_hash not in self._entries:
+                return None
+            self._entries.move_to_end(sha1_hash)
+            try:
+                return open(self._get_path(sha1_hash), 'rb')
+            except FileNotFoundError:
+                return None
+
+    def remove(self, sha1_hash):
+        """
+        :param str sha1_hash:
+        """
+        sha1_hash = sha1_hash.upper()
+        with self._lock:
+            size = self._entries.pop(sha1_hash, None)
+            if size is None:
+                return
+            self._total_bytes -= size
+            try:
+                os.remove(self._get_path(sha1_hash))
+            except OSError as e:
+                logging.error('Error removing cached file "%s": %s.', sha1_hash, e)
@@ -53,8 +53,22 @@ class UserContext:
         'webhook_renew_interval_sec': 7200,  # Renew webhook every 2 hours.
         'webhook_action_delay_sec': 120,
         'num_workers': 2,
+        'max_tasks_in_memory': 10000,
         'start_delay_sec': 0,
-        'logfile_path': ''
+        'logfile_path': '',
+        'trace_file_path': '',
+        'trace_file_max_bytes': 64 << 20,
+        'content_cache_max_bytes': 256 << 20,
+        'lan_sync_secret': '',
+        'lan_sync_port': 0,
+        'lan_sync_discovery_port': 37281,
+        'lan_sync_broadcast_address': '255.255.255.255',
+        'lan_sync_peers': '',
+        'watcher_backend': 'inotify',
+        'hash_workers': 4,
+        'background_io_class': 'best-effort',
+        'background_nice': 10,
+        'background_read_bytes_per_sec': 0
     }
 
     DEFAULT_CONFIG_FILENAME = 'onedrived_config_v2.json'
@@ -75,6 +89,10 @@ class UserContext:
         self.config = self.DEFAULT_CONFIG
         self.loop = loop
         self._watcher = None
+        self._repositories = []
+        self._content_cache = None
+        self._lan_sync = None
+        self._hash_service = None
 
     def _create_config_dir_if_missing(self):
         if os.path.exists(self.config_dir) and not os.path.isdir(self.config_dir):
@@ -113,6 +131,50 @@ class UserContext:
     def watcher(self, watcher):
         self._watcher = watcher
 
+    @property
+    def repositories(self):
+        """
+        :return [onedrived.od_repo.OneDriveLocalRepository]: Repositories of all Drives being synced.
+        """
+        return self._repositories
+
+    @repositories.setter
+    def repositories(self, repos):
+        self._repositories = repos
+
+    @property
+    def content_cache(self):
+        """
+        :return onedrived.od_cache.ContentCache | None: None if caching is disabled.
+        """
+        return self._content_cache
+
+    @content_cache.setter
+    def content_cache(self, cache):
+        self._content_cache = cache
+
+    @property
+    def lan_sync(self):
+        """
+        :return onedrived.od_lansync.LanSync | None: None if LAN sync is disabled.
+        """
+        return self._lan_sync
+
+    @lan_sync.setter
+    def lan_sync(self, lan_sync):
+        self._lan_sync = lan_sync
+
+    @property
+    def hash_service(self):
+        """
+        :return onedrived.od_hashutils.HashService | None: None if files are hashed by the threads that need them.
+        """
+        return self._hash_service
+
+    @hash_service.setter
+    def hash_service(self, hash_service):
+        self._hash_service = hash_service
+
     @staticmethod
     def set_logger(min_level=logging.WARNING, path=None):
         logging_config = {'level': min_level, 'format': '[%(asctime)-15s] %(levelname)s: %(threadName)s: %(message)s'}
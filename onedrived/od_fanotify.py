@@ -0,0 +1,208 @@
+"""
+od_fanotify.py
+A watcher backend on fanotify (Linux 5.9+, FAN_REPORT_DFID_NAME). One mark watches a whole filesystem, so watching a
+dir takes no syscall beyond looking up its file handle and no watch quota. Requires CAP_SYS_ADMIN.
+
+The backend has the interface of inotify_simple.INotify used by LocalRepositoryWatcher: fd, add_watch(), rm_watch(),
+read() and close(). Events are reported as inotify_simple.Event, with wd identifying the parent dir.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import os
+import select
+import struct
+import time
+
+from inotify_simple import Event
+
+FAN_CLOEXEC = 0x1
+FAN_NONBLOCK = 0x2
+FAN_REPORT_DIR_FID = 0x400
+FAN_REPORT_NAME = 0x800
+FAN_REPORT_DFID_NAME = FAN_REPORT_DIR_FID | FAN_REPORT_NAME
+FAN_MARK_ADD = 0x1
+FAN_MARK_FILESYSTEM = 0x100
+FAN_EVENT_INFO_TYPE_DFID_NAME = 2
+FAN_ONDIR = 0x40000000
+FAN_Q_OVERFLOW = 0x4000
+FAN_NOFD = -1
+AT_FDCWD = -100
+MAX_HANDLE_SZ = 128
+# Event bits fanotify shares with inotify: CLOSE_WRITE, MOVED_FROM, MOVED_TO, CREATE, DELETE and DELETE_SELF. FAN_ONDIR
+# has the value of IN_ISDIR.
+FAN_CLOSE_WRITE = 0x8
+FAN_MOVED_FROM = 0x40
+FAN_MOVED_TO = 0x80
+FAN_CREATE = 0x100
+FAN_DELETE = 0x200
+FAN_DELETE_SELF = 0x400
+SUPPORTED_EVENTS = FAN_CLOSE_WRITE | FAN_MOVED_FROM | FAN_MOVED_TO | FAN_CREATE | FAN_DELETE | FAN_DELETE_SELF
+# Order in which merged events most likely happened.
+EVENT_ORDER = (FAN_CREATE, FAN_MOVED_TO, FAN_CLOSE_WRITE, FAN_MOVED_FROM, FAN_DELETE, FAN_DELETE_SELF)
+
+_EVENT_METADATA = struct.Struct('=IBBHQii')
+_EVENT_INFO_HEADER = struct.Struct('=BBH')
+_FSID_AND_HANDLE_HEADER = struct.Struct('=iiIi')
+
+
+class _FileHandle(ctypes.Structure):
+    _fields_ = [('handle_bytes', ctypes.c_uint), ('handle_type', ctypes.c_int),
+                ('f_handle', ctypes.c_ubyte * MAX_HANDLE_SZ)]
+
+
+def _load_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    if not hasattr(libc, 'fanotify_init') or not hasattr(libc, 'name_to_handle_at'):
+        raise OSError(errno.ENOSYS, 'fanotify is not supported by the C library.')
+    libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+    libc.fanotify_mark.argtypes = [ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int, ctypes.c_char_p]
+    libc.name_to_handle_at.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(_FileHandle),
+                                       ctypes.POINTER(ctypes.c_int), ctypes.c_int]
+    return libc
+
+
+def _raise_errno(message):
+    e = ctypes.get_errno()
+    raise OSError(e, '%s: %s' % (message, os.strerror(e)))
+
+
+def parse_events(data):
+    """
+    :param bytes data: Data read from a fanotify fd initialized with FAN_REPORT_DFID_NAME.
+    :return [(int, bytes | None, str)]: Mask, key of the dir file handle and name of each event. Key is None for
+        events without a dir, e.g., queue overflow. Name is '' for events on the dir itself.
+    """
+    events = []
+    offset = 0
+    while offset + _EVENT_METADATA.size <= len(data):
+        event_len, _, _, metadata_len, mask, fd, _ = _EVENT_METADATA.unpack_from(data, offset)
+        if event_len < metadata_len:
+            break
+        if fd != FAN_NOFD:
+            os.close(fd)
+        key, name = None, ''
+        info_offset = offset + metadata_len
+        while info_offset + _EVENT_INFO_HEADER.size <= offset + event_len:
+            info_type, _, info_len = _EVENT_INFO_HEADER.unpack_from(data, info_offset)
+            if info_len == 0:
+                break
+            if info_type == FAN_EVENT_INFO_TYPE_DFID_NAME:
+                _, _, handle_bytes, handle_type = _FSID_AND_HANDLE_HEADER.unpack_from(
+                    data, info_offset + _EVENT_INFO_HEADER.size)
+                handle_offset = info_offset + _EVENT_INFO_HEADER.size + _FSID_AND_HANDLE_HEADER.size
+                key = struct.pack('=i', handle_type) + data[handle_offset:handle_offset + handle_bytes]
+                name_bytes = data[handle_offset + handle_bytes:info_offset + info_len].split(b'\0', 1)[0]
+                name = os.fsdecode(name_bytes)
+                if name == '.':
+                    name = ''
+            info_offset += info_len
+        events.append((mask, key, name))
+        offset += event_len
+    return events
+
+
+class Fanotify:
+
+    READ_SIZE = 65536
+
+    def __init__(self):
+        self._libc = _load_libc()
+        fd = self._libc.fanotify_init(FAN_CLOEXEC | FAN_NONBLOCK | FAN_REPORT_DFID_NAME, os.O_RDONLY)
+        if fd < 0:
+            _raise_errno('Error initializing fanotify')
+        self.fd = fd
+        self._marked_devs = set()
+        self._wd_seq = itertools.count(1)
+        # Watched dirs are known by file handles, which stay the same when the dirs are moved.
+        self._wds = dict()
+        self._handles = dict()
+        self._cookie_seq = itertools.count(1)
+
+    def _get_handle_key(self, path):
+        handle = _FileHandle(handle_bytes=MAX_HANDLE_SZ)
+        mount_id = ctypes.c_int()
+        if self._libc.name_to_handle_at(AT_FDCWD, os.fsencode(path), ctypes.byref(handle), ctypes.byref(mount_id),
+                                        0) != 0:
+            _raise_errno('Error getting file handle of "%s"' % path)
+        return struct.pack('=i', handle.handle_type) + bytes(handle.f_handle[:handle.handle_bytes])
+
+    def add_watch(self, path, mask):
+        """
+        :param str path:
+        :param int mask: Inotify event flags. Those fanotify does not support are ignored.
+        :return int: A watch descriptor. A dir watched again, even under another path, gets the same one.
+        """
+        dev = os.stat(path).st_dev
+        if dev not in self._marked_devs:
+            if self._libc.fanotify_mark(self.fd, FAN_MARK_ADD | FAN_MARK_FILESYSTEM,
+                                        (mask & SUPPORTED_EVENTS) | FAN_ONDIR, AT_FDCWD, os.fsencode(path)) != 0:
+                _raise_errno('Error marking filesystem of "%s"' % path)
+            self._marked_devs.add(dev)
+        key = self._get_handle_key(path)
+        wd = self._wds.get(key)
+        if wd is None:
+            wd = self._wds[key] = next(self._wd_seq)
+            self._handles[wd] = key
+        return wd
+
+    def rm_watch(self, wd):
+        key = self._handles.pop(wd, None)
+        if key is None:
+            raise OSError(errno.EINVAL, 'Watch descriptor %d is not found.' % wd)
+        del self._wds[key]
+
+    def read(self, timeout=None, read_delay=None):
+        """
+        :param int | None timeout: Milliseconds to wait for events. None to wait forever.
+        :param int | None read_delay: Milliseconds to wait after the first event is available, so that more events
+            can be read at once.
+        :return [inotify_simple.Event]: Events of watched dirs. A move is reported as a MOVED_FROM event followed by a
+            MOVED_TO event, which are given the same cookie.
+        """
+        if not select.select([self.fd], [], [], None if timeout is None else timeout / 1000)[0]:
+            return []
+        if read_delay is not None:
+            time.sleep(read_delay / 1000)
+        data = b''
+        while True:
+            try:
+                chunk = os.read(self.fd, self.READ_SIZE)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            data += chunk
+        events = []
+        last_moved_from = None
+        for mask, key, name in parse_events(data):
+            wd = self._wds.get(key)
+            if mask & FAN_Q_OVERFLOW:
+                events.append(Event(wd=-1, mask=FAN_Q_OVERFLOW, cookie=0, name=''))
+            if wd is None:
+                # Not a watched dir, e.g., a dir outside the repositories.
+                last_moved_from = None
+                continue
+            # Fanotify merges events on the same name, but the watcher expects one event type per event.
+            for event_type in EVENT_ORDER:
+                if not mask & event_type:
+                    continue
+                cookie = 0
+                if event_type == FAN_MOVED_FROM:
+                    cookie = next(self._cookie_seq)
+                elif event_type == FAN_MOVED_TO and last_moved_from is not None:
+                    # The kernel reports the two halves of a rename next to each other.
+                    cookie = last_moved_from.cookie
+                elif event_type == FAN_DELETE_SELF:
+                    self.rm_watch(wd)
+                ev = Event(wd=wd, mask=event_type | (mask & FAN_ONDIR), cookie=cookie, name=name)
+                last_moved_from = ev if event_type == FAN_MOVED_FROM else None
+                events.append(ev)
+        return events
+
+    def close(self):
+        os.close(self.fd)
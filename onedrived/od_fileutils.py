@@ -0,0 +1,123 @@
+import errno
+import fcntl
+import os
+import shutil
+import threading
+
+from . import od_iosched
+
+# ioctl request of Linux to share the data of one file with another on filesystems like Btrfs and XFS.
+FICLONE = 0x40049409
+
+# Errors that mean the operation is not supported for the pair of files.
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF}
+
+# Read buffers of each thread, by size.
+_read_buffers = threading.local()
+
+
+def _clone(src, dst):
+    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy_file_range(src, dst):
+    size = os.fstat(src.fileno()).st_size
+    offset = 0
+    while offset < size:
+        n = os.copy_file_range(src.fileno(), dst.fileno(), size - offset)
+        if n == 0:
+            break
+        offset += n
+
+
+def clone_file(src_path, dst_path):
+    """
+    Copy the data of a file to a new file without reading it into memory if possible. The data is shared by reflink
+    if the filesystem supports it, copied in kernel with copy_file_range() if not, and copied by reading and writing
+    otherwise.
+    :param str src_path:
+    :param str dst_path: Path of the new file. It's overwritten if it exists.
+    :return str: How the data was copied: "reflink", "copy_file_range", or "copy".
+    """
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        try:
+            _clone(src, dst)
+            return 'reflink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS:
+                raise
+        if hasattr(os, 'copy_file_range'):
+            try:
+                _copy_file_range(src, dst)
+                return 'copy_file_range'
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS:
+                    raise
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst)
+        return 'copy'
+
+
+def iter_file_blocks(file_path, block_size=1 << 20):
+    """
+    Read a file block by block into a buffer reused by the calling thread, so that reading a large file does not
+    allocate a new bytes object per block. The file is opened unbuffered and read directly into the buffer.
+
+    Files are not mmap'ed because a file truncated by another process while mapped kills the reader with SIGBUS.
+    Reads of background threads count against the read budget of onedrived.od_iosched.
+    :param str file_path:
+    :param int block_size:
+    :return collections.Iterable[memoryview]: Blocks of the file. A block is only valid until the next one is read.
+    """
+    free_buffers = getattr(_read_buffers, 'free', None)
+    if free_buffers is None:
+        free_buffers = _read_buffers.free = dict()
+    # A buffer in use is taken out of the pool, so that nested reads of the calling thread get their own buffers.
+    buf = free_buffers.pop(block_size, None) or bytearray(block_size)
+    try:
+        with open(file_path, 'rb', buffering=0) as f, memoryview(buf) as view:
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                od_iosched.throttle_read(n)
+                with view[:n] as block:
+                    yield block
+    finally:
+        free_buffers[block_size] = buf
+
+
+def is_open_for_writing(item_stat, proc_root='/proc'):
+    """
+    Tell whether or not another process has a file open for writing, by the file descriptors listed in /proc.
+    Processes whose file descriptors can't be read, e.g., those of other users, are not checked.
+    :param posix.stat_result item_stat: Stat of the file.
+    :param str proc_root:
+    :return True | False:
+    """
+    own_pid = str(os.getpid())
+    try:
+        pids = [ent.name for ent in os.scandir(proc_root) if ent.name.isdigit() and ent.name != own_pid]
+    except OSError:
+        return False
+    for pid in pids:
+        fd_dir = proc_root + '/' + pid + '/fd'
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                fd_stat = os.stat(fd_dir + '/' + fd)
+                if fd_stat.st_ino != item_stat.st_ino or fd_stat.st_dev != item_stat.st_dev:
+                    continue
+                with open(proc_root + '/' + pid + '/fdinfo/' + fd) as f:
+                    for line in f:
+                        if line.startswith('flags:') and int(line.split()[1], 8) & os.O_ACCMODE != os.O_RDONLY:
+                            return True
+            except (OSError, ValueError, IndexError):
+                # The process closed the file or exited.
+                continue
+    return False
@@ -1,21 +1,28 @@
+import concurrent.futures
 import hashlib
+import os
 
+from . import od_iosched
+from . import od_trace
+from .od_fileutils import iter_file_blocks
 
-def hash_match(local_abspath, remote_item):
+
+def hash_match(local_abspath, remote_item, get_sha1_value=None):
     """
     :param str local_abspath:
     :param onedrivesdk.model.item.Item remote_item:
+    :param get_sha1_value: Function that returns SHA-1 value of a path. Default: sha1_value.
     :return True | False:
     """
     file_facet = remote_item.file
     if file_facet:
         hash_facet = file_facet.hashes
         if hash_facet:
-            return hash_facet.sha1_hash and hash_facet.sha1_hash == sha1_value(local_abspath)
+            return hash_facet.sha1_hash and hash_facet.sha1_hash == (get_sha1_value or sha1_value)(local_abspath)
     return False
 
 
-def sha1_value(file_path, block_size=2 << 22):
+def sha1_value(file_path, block_size=1 << 20):
     """
     Calculate the MD5 or SHA hash value of the data of the specified file.
     :param str file_path:
@@ -23,9 +30,63 @@ def sha1_value(file_path, block_size=2 << 22):
     :return str:
     """
     alg = hashlib.sha1()
-    with open(file_path, 'rb') as f:
-        data = f.read(block_size)
-        while len(data):
-            alg.update(data)
-            data = f.read(block_size)
+    with od_trace.span('sha1_value', 'hash', path=file_path):
+        for block in iter_file_blocks(file_path, block_size):
+            alg.update(block)
     return alg.hexdigest().upper()
+
+
+def quick_fingerprint(file_path, block_size=64 << 10):
+    """
+    Calculate a fingerprint of a file from its size and the hash of its first, middle and last blocks. Files with
+    different fingerprints have different content. Files with the same fingerprint may still differ elsewhere.
+    :param str file_path:
+    :param int block_size:
+    :return str:
+    """
+    alg = hashlib.sha1()
+    with open(file_path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= 3 * block_size:
+            alg.update(os.pread(f.fileno(), size, 0))
+        else:
+            for offset in (0, (size - block_size) // 2, size - block_size):
+                alg.update(os.pread(f.fileno(), block_size, offset))
+    return '%d:%s' % (size, alg.hexdigest().upper())
+
+
+def _sha1_value_in_background(file_path):
+    od_iosched.init_background_thread()
+    return sha1_value(file_path)
+
+
+class HashService:
+    """
+    Hashes files on a pool of threads. hashlib releases the GIL while hashing, so the files are hashed in parallel.
+    The threads run in the background I/O and CPU classes.
+    """
+
+    def __init__(self, max_workers):
+        """
+        :param int max_workers: Max number of files hashed at the same time.
+        """
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit_batch(self, paths):
+        """
+        :param [str] paths:
+        :return dict[str, concurrent.futures.Future]: Futures of SHA-1 values by path. Files are read in the order of
+            their inode numbers, which on most file systems is close to their order on disk.
+        """
+        keyed_paths = []
+        for path in paths:
+            try:
+                path_stat = os.stat(path)
+                keyed_paths.append(((path_stat.st_dev, path_stat.st_ino), path))
+            except OSError:
+                # Hashing fails with the same error, which is reported by the future.
+                keyed_paths.append(((-1, -1), path))
+        return {path: self._executor.submit(_sha1_value_in_background, path) for _, path in sorted(keyed_paths)}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,174 @@
+"""
+od_iosched.py
+I/O and CPU scheduling of background work, e.g., full merges, downloads and hashing, so that it yields to interactive
+use of the machine. Tasks triggered by local changes run in the normal classes.
+
+A thread is switched to or from the background I/O class per task with ioprio_set(). Raising the nice value of a thread
+can't be undone without privilege, so only threads that always do background work, i.e., hashing threads, are niced.
+Reads of local files by background threads can also be capped in bytes per second.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import threading
+import time
+
+IOPRIO_CLASS_NONE = 0
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+# Class of threads that never called ioprio_set(). The kernel derives their best-effort level from their nice value.
+IOPRIO_NORMAL = (IOPRIO_CLASS_NONE, 0)
+# Numbers of the ioprio_set and gettid syscalls, which older glibc does not wrap.
+_SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'armv7l': 314, 'ppc64le': 273}
+_SYS_GETTID = {'x86_64': 186, 'i386': 224, 'i686': 224, 'aarch64': 178, 'armv7l': 224, 'ppc64le': 207}
+
+# Values of config "background_io_class".
+BACKGROUND_IO_CLASSES = {
+    'normal': None,
+    'best-effort': (IOPRIO_CLASS_BE, 7),
+    'idle': (IOPRIO_CLASS_IDLE, 0),
+}
+
+
+class ReadBudget:
+    """A token bucket of bytes shared by all background threads. A read is never refused but the reader sleeps off
+    the debt it makes."""
+
+    def __init__(self, bytes_per_sec):
+        """
+        :param int bytes_per_sec: Also the size of the bucket, i.e., at most one second of reads can burst.
+        """
+        self.bytes_per_sec = bytes_per_sec
+        self._tokens = bytes_per_sec
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, num_bytes):
+        """
+        :param int num_bytes: Number of bytes just read.
+        :return float: Seconds to sleep before reading more.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._last_refill) * self.bytes_per_sec, self.bytes_per_sec)
+            self._last_refill = now
+            self._tokens -= num_bytes
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.bytes_per_sec
+
+
+_background_io_class = BACKGROUND_IO_CLASSES['best-effort']
+_background_nice = 10
+_read_budget = None
+_thread_state = threading.local()
+_libc = None
+_ioprio_set = None
+
+
+def configure(io_class='best-effort', nice=10, read_bytes_per_sec=0):
+    """
+    :param str io_class: One of the keys of BACKGROUND_IO_CLASSES.
+    :param int nice: Nice value to add to hashing threads. 0 to not nice them.
+    :param int read_bytes_per_sec: Cap of local reads of background threads. 0 for no cap.
+    """
+    global _background_io_class, _background_nice, _read_budget
+    _background_io_class = BACKGROUND_IO_CLASSES[io_class]
+    _background_nice = nice
+    _read_budget = ReadBudget(read_bytes_per_sec) if read_bytes_per_sec > 0 else None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+def _get_ioprio_set():
+    global _ioprio_set
+    if _ioprio_set is None:
+        syscall_nr = _SYS_IOPRIO_SET.get(platform.machine())
+        if syscall_nr is None:
+            _ioprio_set = False
+        else:
+            libc = _get_libc()
+
+            def ioprio_set(io_class, level):
+                # Who 0 is the calling thread.
+                return libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, 0, (io_class << IOPRIO_CLASS_SHIFT) | level)
+            _ioprio_set = ioprio_set
+    return _ioprio_set
+
+
+def get_thread_id():
+    """
+    :return int | None: Kernel ID of the calling thread, or None if it can't be told.
+    """
+    if hasattr(threading, 'get_native_id'):
+        return threading.get_native_id()
+    syscall_nr = _SYS_GETTID.get(platform.machine())
+    if syscall_nr is None:
+        return None
+    return _get_libc().syscall(syscall_nr)
+
+
+def _set_io_class(io_prio):
+    ioprio_set = _get_ioprio_set()
+    if ioprio_set and ioprio_set(*io_prio) != 0:
+        e = ctypes.get_errno()
+        logging.debug('Error setting I/O class of thread to %s: %s.', io_prio, os.strerror(e))
+
+
+def set_background(background):
+    """
+    Switch the I/O class of the calling thread, and whether or not its reads count against the read budget.
+    :param True | False background:
+    """
+    if getattr(_thread_state, 'background', False) == background:
+        return
+    _thread_state.background = background
+    if _background_io_class is not None:
+        _set_io_class(_background_io_class if background else IOPRIO_NORMAL)
+
+
+def init_background_thread():
+    """
+    Put the calling thread in background classes for good. Called by every job on hashing threads, and does nothing
+    after the first call on a thread.
+    """
+    if getattr(_thread_state, 'initialized', False):
+        return
+    _thread_state.initialized = True
+    set_background(True)
+    if _background_nice > 0:
+        try:
+            # On Linux the nice value is per thread.
+            tid = get_thread_id()
+            if tid is not None:
+                os.setpriority(os.PRIO_PROCESS, tid, os.getpriority(os.PRIO_PROCESS, tid) + _background_nice)
+        except OSError as e:
+            logging.debug('Error setting nice value of thread: %s.', e)
+
+
+def is_background():
+    return getattr(_thread_state, 'background', False)
+
+
+def throttle_read(num_bytes):
+    """
+    Wait if the calling thread is a background thread and it has read more than the budget allows.
+    :param int num_bytes: Number of bytes just read.
+    """
+    budget = _read_budget
+    if budget is not None and is_background():
+        delay = budget.consume(num_bytes)
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,286 @@
+"""
+od_lansync.py
+Exchange of file content between onedrived hosts on the same network, so that a file synced by many hosts is
+downloaded from OneDrive once. Hosts announce their HTTP endpoints by UDP broadcast, or are listed in config, and serve
+files by SHA-1 value. Requests and announcements are signed with a secret shared by all hosts.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+import hashlib
+import hmac
+import http.server
+import json
+import logging
+import os
+import random
+import socket
+import socketserver
+import string
+import threading
+import time
+
+import requests
+
+
+SIGNATURE_HEADER = 'X-Onedrived-Signature'
+MAX_CLOCK_SKEW_SEC = 300
+
+
+def sign(secret, *parts):
+    """
+    :param str secret:
+    :param [str | int] parts:
+    :return str: HMAC-SHA256 of the parts, in hex.
+    """
+    msg = ' '.join(str(p) for p in parts).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), msg, hashlib.sha256).hexdigest()
+
+
+def verify(secret, signature, timestamp, *parts):
+    """
+    :param str secret:
+    :param str signature:
+    :param int timestamp: Time when the message was signed. Old messages are rejected so they can't be replayed.
+    :param [str | int] parts:
+    :return True | False:
+    """
+    return abs(time.time() - timestamp) <= MAX_CLOCK_SKEW_SEC and \
+        hmac.compare_digest(signature, sign(secret, timestamp, *parts))
+
+
+def parse_peer_list(s):
+    """
+    :param str s: Comma-separated list of "host:port".
+    :return [(str, int)]:
+    """
+    peers = []
+    for p in s.split(','):
+        p = p.strip()
+        if p == '':
+            continue
+        host, port = p.rsplit(':', maxsplit=1)
+        peers.append((host, int(port)))
+    return peers
+
+
+class LanSyncRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves "HEAD /content/<SHA-1>/<size>" to tell if the host has the content and "GET" to fetch it."""
+
+    def log_message(self, fmt, *args):
+        logging.debug('LAN sync: %s - ' + fmt, self.address_string(), *args)
+
+    def _open_content(self):
+        """
+        :return (int, file | None): Status code and the opened file if found.
+        """
+        try:
+            timestamp, signature = self.headers.get(SIGNATURE_HEADER, '').split(' ')
+            if not verify(self.server.lan_sync.secret, signature, int(timestamp), self.command, self.path):
+                return 403, None
+            _, prefix, sha1_hash, size = self.path.split('/')
+            size = int(size)
+        except (ValueError, TypeError):
+            return 400, None
+        if prefix != 'content':
+            return 404, None
+        f = self.server.lan_sync.open_content(sha1_hash.upper(), size)
+        return (200, f) if f is not None else (404, None)
+
+    def _send_status(self, code, content_length=0):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(content_length))
+        self.end_headers()
+
+    def do_HEAD(self):
+        code, f = self._open_content()
+        if f is not None:
+            f.close()
+        self._send_status(code)
+
+    def do_GET(self):
+        code, f = self._open_content()
+        if f is None:
+            self._send_status(code)
+            return
+        with f:
+            self._send_status(code, os.fstat(f.fileno()).st_size)
+            self.connection.sendfile(f)
+        logging.info('LAN sync: sent "%s" to %s.', self.path, self.address_string())
+
+
+class LanSyncHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, lan_sync, server_address):
+        """
+        :param LanSync lan_sync:
+        :param (str, int) server_address:
+        """
+        super().__init__(server_address, LanSyncRequestHandler)
+        self.lan_sync = lan_sync
+
+
+class LanSync:
+    """Serves local content to peers, finds peers, and fetches content from them."""
+
+    ANNOUNCE_INTERVAL_SEC = 30
+    PEER_TIMEOUT_SEC = 100
+    REQUEST_TIMEOUT_SEC = 10
+
+    def __init__(self, context, secret, port=0, discovery_port=0, broadcast_address='', static_peers=()):
+        """
+        :param onedrived.od_context.UserContext context: Where the content is looked up.
+        :param str secret: Secret shared by all hosts.
+        :param int port: Port of the HTTP endpoint. 0 lets the OS pick one.
+        :param int discovery_port: UDP port to send and receive announcements.
+        :param str broadcast_address: Address to send announcements to. Empty string disables discovery.
+        :param [(str, int)] static_peers: Peers that are always queried.
+        """
+        self.context = context
+        self.secret = secret
+        self.discovery_port = discovery_port
+        self.broadcast_address = broadcast_address
+        self.static_peers = list(static_peers)
+        self.instance_id = ''.join(random.sample(string.ascii_letters + string.digits, 16))
+        self.server = LanSyncHTTPServer(self, ('', port))
+        self.server_port = self.server.server_address[1]
+        self._peers = dict()
+        self._peers_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._threads = []
+        self._discovery_sock = None
+
+    def start(self):
+        t = threading.Thread(name='LanSyncServer', target=self.server.serve_forever, daemon=True)
+        self._threads.append(t)
+        if self.broadcast_address != '':
+            self._discovery_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self._discovery_sock.bind(('', self.discovery_port))
+            self._discovery_sock.settimeout(1)
+            self._threads.append(threading.Thread(name='LanSyncDiscovery', target=self._run_discovery, daemon=True))
+        for t in self._threads:
+            t.start()
+        logging.info('LAN sync endpoint listening on port %d.', self.server_port)
+
+    def stop(self):
+        self._stop_event.set()
+        if len(self._threads) > 0:
+            self.server.shutdown()
+        self.server.server_close()
+        for t in self._threads:
+            t.join()
+        if self._discovery_sock is not None:
+            self._discovery_sock.close()
+
+    def open_content(self, sha1_hash, size):
+        """
+        :param str sha1_hash: SHA-1 value in upper case.
+        :param int size:
+        :return file | None: A local file with the content, opened for reading.
+        """
+        for repo in self.context.repositories:
+            for path in repo.find_unchanged_files(sha1_hash, size):
+                try:
+                    return open(path, 'rb')
+                except OSError:
+                    continue
+        cache = self.context.content_cache
+        return cache.open_file(sha1_hash) if cache is not None else None
+
+    def gen_announcement(self):
+        """
+        :return bytes:
+        """
+        timestamp = int(time.time())
+        return json.dumps({
+            'id': self.instance_id, 'port': self.server_port, 'time': timestamp,
+            'sig': sign(self.secret, timestamp, self.instance_id, self.server_port)}).encode('utf-8')
+
+    def handle_announcement(self, data, host):
+        """
+        :param bytes data:
+        :param str host: Address the announcement was sent from.
+        :return True | False: Whether or not the announcement is valid and from another host.
+        """
+        try:
+            msg = json.loads(data.decode('utf-8'))
+            peer_id, port, timestamp = msg['id'], int(msg['port']), int(msg['time'])
+            if peer_id == self.instance_id or not verify(self.secret, msg['sig'], timestamp, peer_id, port):
+                return False
+        except (UnicodeError, ValueError, KeyError, TypeError):
+            return False
+        with self._peers_lock:
+            if peer_id not in self._peers:
+                logging.info('LAN sync: found peer %s:%d.', host, port)
+            self._peers[peer_id] = (host, port, time.time() + self.PEER_TIMEOUT_SEC)
+        return True
+
+    def _run_discovery(self):
+        next_announce_time = 0
+        while not self._stop_event.is_set():
+            if time.time() >= next_announce_time:
+                try:
+                    self._discovery_sock.sendto(self.gen_announcement(), (self.broadcast_address, self.discovery_port))
+                except OSError as e:
+                    logging.error('LAN sync: error sending announcement: %s.', e)
+                next_announce_time = time.time() + self.ANNOUNCE_INTERVAL_SEC
+            try:
+                data, (host, _) = self._discovery_sock.recvfrom(4096)
+                self.handle_announcement(data, host)
+            except socket.timeout:
+                pass
+            except OSError as e:
+                if not self._stop_event.is_set():
+                    logging.error('LAN sync: error receiving announcement: %s.', e)
+
+    @property
+    def peers(self):
+        """
+        :return [(str, int)]: Addresses of static peers and peers announced recently.
+        """
+        now = time.time()
+        with self._peers_lock:
+            for k in [k for k, v in self._peers.items() if v[2] < now]:
+                del self._peers[k]
+            found = [(host, port) for host, port, _ in self._peers.values()]
+        return self.static_peers + [p for p in found if p not in self.static_peers]
+
+    def _request(self, method, peer, sha1_hash, size, **kwargs):
+        path = '/content/%s/%d' % (sha1_hash.upper(), size)
+        timestamp = int(time.time())
+        headers = {SIGNATURE_HEADER: '%d %s' % (timestamp, sign(self.secret, timestamp, method, path))}
+        return requests.request(method, 'http://%s:%d%s' % (peer[0], peer[1], path), headers=headers,
+                                timeout=self.REQUEST_TIMEOUT_SEC, allow_redirects=False, **kwargs)
+
+    def fetch_file(self, sha1_hash, size, dst_path):
+        """
+        Download content from the first peer that has it. The caller should verify the hash of the file.
+        :param str sha1_hash:
+        :param int size:
+        :param str dst_path:
+        :return (str, int) | None: Address of the peer the file was fetched from, or None if no peer has it.
+        """
+        for peer in self.peers:
+            try:
+                response = self._request('GET', peer, sha1_hash, size, stream=True)
+                try:
+                    if response.status_code != 200:
+                        if response.status_code != 404:
+                            logging.warning('LAN sync: peer %s:%d responded %d.', peer[0], peer[1],
+                                            response.status_code)
+                        continue
+                    with open(dst_path, 'wb') as f:
+                        for chunk in response.iter_content(chunk_size=1 << 20):
+                            f.write(chunk)
+                finally:
+                    response.close()
+                if os.path.getsize(dst_path) == size:
+                    return peer
+            except (requests.RequestException, OSError) as e:
+                logging.warning('LAN sync: error fetching from peer %s:%d: %s.', peer[0], peer[1], e)
+        return None
@@ -12,13 +12,19 @@ import weakref
 import click
 import daemonocle.cli
 
+from . import od_iosched
 from . import od_repo
 from . import od_task
 from . import od_threads
+from . import od_trace
 from . import od_webhook
-from .od_tasks import start_repo, merge_dir, update_subscriptions
+from .od_tasks import start_repo, apply_delta, update_subscriptions
 from .od_auth import get_authenticator_and_drives
+from .od_cache import ContentCache
 from .od_context import load_context
+from .od_fanotify import Fanotify
+from .od_hashutils import HashService
+from .od_lansync import LanSync, parse_peer_list
 from .od_watcher import LocalRepositoryWatcher
 
 
@@ -26,6 +32,7 @@ context = load_context(asyncio.get_event_loop())
 pidfile = context.config_dir + '/onedrived.pid'
 task_workers = weakref.WeakSet()
 task_pool = None
+repo_table = {}
 webhook_server = None
 webhook_worker = None
 
@@ -33,6 +40,10 @@ webhook_worker = None
 def init_task_pool_and_workers():
     global task_pool
     task_pool = od_task.TaskPool()
+    for repo in itertools.chain.from_iterable(repo_table.values()):
+        drive_config = context.get_drive(repo.drive.id)
+        task_pool.set_schedule(repo, drive_config.priority, drive_config.max_concurrent_tasks)
+        task_pool.set_journal(repo, context.config['max_tasks_in_memory'])
     for _ in range(context.config['num_workers']):
         w = od_threads.TaskWorkerThread(name='Worker-%d' % len(task_workers), task_pool=task_pool)
         w.start()
@@ -65,6 +76,27 @@ def init_webhook():
     webhook_server.start()
 
 
+def init_lan_sync():
+    try:
+        context.lan_sync = LanSync(context, context.config['lan_sync_secret'],
+                                   port=context.config['lan_sync_port'],
+                                   discovery_port=context.config['lan_sync_discovery_port'],
+                                   broadcast_address=context.config['lan_sync_broadcast_address'],
+                                   static_peers=parse_peer_list(context.config['lan_sync_peers']))
+        context.lan_sync.start()
+    except (OSError, ValueError) as e:
+        logging.error('Error starting LAN sync: %s. LAN sync is disabled.', e)
+        if context.lan_sync is not None:
+            context.lan_sync.stop()
+            context.lan_sync = None
+
+
+def shutdown_lan_sync():
+    if context.lan_sync:
+        context.lan_sync.stop()
+        context.lan_sync = None
+
+
 def shutdown_webhook():
     global webhook_server
     if webhook_server:
@@ -80,13 +112,31 @@ def shutdown_callback(code, _):
     context.loop.stop()
     shutdown_webhook()
     shutdown_workers()
+    shutdown_lan_sync()
+    if context.hash_service:
+        context.hash_service.shutdown()
+        context.hash_service = None
+    mark_clean_shutdown()
     if context and context.watcher:
         context.watcher.close()
         context.watcher = None
+    od_trace.disable_tracing()
     logging.shutdown()
     logging.info('Shut down complete.')
 
 
+def mark_clean_shutdown():
+    """
+    If no task failed, local repositories and their databases are consistent except for the unfinished tasks, which
+    are kept in task journal. So next start can skip the full merge.
+    """
+    if task_pool is None:
+        return
+    for repo in itertools.chain.from_iterable(repo_table.values()):
+        if not repo.mark_clean_shutdown():
+            logging.info('Some tasks of Drive %s failed. Next start will do a full merge.', repo.drive.id)
+
+
 def get_repo_table(ctx):
     """
     :param onedrived.od_context.UserContext ctx:
@@ -130,22 +180,24 @@ def gen_start_repo_tasks(all_accounts):
     """
     :param dict[str, [onedrived.od_repo.OneDriveLocalRepository]] all_accounts:
     """
-    if task_pool.outstanding_task_count == 0:
-        for repo in itertools.chain.from_iterable(all_accounts.values()):
-            task_pool.add_task(start_repo.StartRepositoryTask(repo, task_pool))
+    # Tasks replayed from task journal are outstanding from the start, so the count of outstanding tasks can't tell
+    # whether a Drive is being synced. A task already queued on the same path absorbs the new one.
+    for repo in itertools.chain.from_iterable(all_accounts.values()):
+        if task_pool.add_task(start_repo.StartRepositoryTask(repo, task_pool)):
             logging.info('Scheduled sync task for Drive %s of account %s.', repo.drive.id, repo.account_id)
-            if update_subscription_for_repo(repo) is None:
-                logging.warning('Failed to create webhook. Will deep sync again in %d sec.',
-                                context.config['scan_interval_sec'])
-                context.loop.call_later(context.config['scan_interval_sec'],
-                                        gen_start_repo_tasks, all_accounts)
-            else:
-                logging.info('Will use webhook to trigger sync events.')
+        if update_subscription_for_repo(repo) is None:
+            logging.warning('Failed to create webhook. Will deep sync again in %d sec.',
+                            context.config['scan_interval_sec'])
+            context.loop.call_later(context.config['scan_interval_sec'],
+                                    gen_start_repo_tasks, all_accounts)
+        else:
+            logging.info('Will use webhook to trigger sync events.')
 
 
 def delete_temp_files(all_accounts):
     """
-    Delete all onedrived temporary files from repository.
+    Delete all onedrived temporary files from repository. Must be called before task workers start, or it may delete
+    files of downloads in progress, e.g., those replayed from task journal.
     :param dict[str, [onedrived.od_repo.OneDriveLocalRepository]] all_accounts:
     :return:
     """
@@ -157,16 +209,28 @@ def delete_temp_files(all_accounts):
 
 
 def repo_updated_callback(repo):
-    if task_pool and task_pool.outstanding_task_count == 0:
-        item_request = repo.authenticator.client.item(drive=repo.drive.id, path='/')
-        task_pool.add_task(merge_dir.MergeDirectoryTask(
-            repo=repo, task_pool=task_pool, rel_path='', item_request=item_request,
-            assume_remote_unchanged=True, parent_remote_unchanged=False))
-        logging.info('Added task to check delta update for Drive %s.', repo.drive.id)
+    if task_pool:
+        # If a delta task of the Drive is still queued, it will pick up this change as well.
+        if task_pool.add_task(apply_delta.ApplyDeltaTask(repo, task_pool)):
+            logging.info('Added task to check delta update for Drive %s.', repo.drive.id)
+        else:
+            logging.debug('Delta update of Drive %s is already scheduled.', repo.drive.id)
     else:
         logging.error('Uninitialized task pool reference.')
 
 
+def get_watcher_backend():
+    """
+    :return onedrived.od_fanotify.Fanotify | None: None to use inotify.
+    """
+    if context.config['watcher_backend'] == 'fanotify':
+        try:
+            return Fanotify()
+        except OSError as e:
+            logging.error('Error initializing fanotify: %s. Use inotify instead.', e)
+    return None
+
+
 @click.command(cls=daemonocle.cli.DaemonCLI,
                daemon_params={
                    'uid': context.user_uid,
@@ -186,14 +250,32 @@ def main():
     else:
         context.set_logger(min_level=logging.INFO, path=context.config['logfile_path'])
 
+    if context.config['trace_file_path']:
+        od_trace.enable_tracing(context.config['trace_file_path'], context.config['trace_file_max_bytes'])
+    od_trace.install_stack_dump_handler(lambda: list(task_workers))
+
     if context.config['start_delay_sec'] > 0:
         logging.info('Wait for %d seconds before starting.', context.config['start_delay_sec'])
         import time
         time.sleep(context.config['start_delay_sec'])
 
     # Initialize account information.
-    all_accounts = get_repo_table(context)
+    global repo_table
+    repo_table = all_accounts = get_repo_table(context)
+    context.repositories = list(itertools.chain.from_iterable(all_accounts.values()))
     delete_temp_files(all_accounts)
+    if context.config['content_cache_max_bytes'] > 0:
+        try:
+            context.content_cache = ContentCache(context.config_dir + '/content_cache',
+                                                 context.config['content_cache_max_bytes'], context.user_uid)
+        except OSError as e:
+            logging.error('Error opening content cache: %s. Caching is disabled.', e)
+    if context.config['lan_sync_secret']:
+        init_lan_sync()
+    od_iosched.configure(context.config['background_io_class'], context.config['background_nice'],
+                         context.config['background_read_bytes_per_sec'])
+    if context.config['hash_workers'] > 0:
+        context.hash_service = HashService(context.config['hash_workers'])
 
     # Start task pool and task worker.
     init_task_pool_and_workers()
@@ -201,7 +283,7 @@ def main():
     # Start webhook.
     init_webhook()
 
-    context.watcher = LocalRepositoryWatcher(task_pool=task_pool, loop=context.loop)
+    context.watcher = LocalRepositoryWatcher(task_pool=task_pool, loop=context.loop, backend=get_watcher_backend())
 
     try:
         context.loop.call_soon(gen_start_repo_tasks, all_accounts)
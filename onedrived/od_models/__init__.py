@@ -1,4 +1,5 @@
-from . import account_profile, bidict, drive_config, path_filter, pretty_api, webhook_notification
+from . import account_profile, bidict, drive_config, path_filter, pretty_api, watch_tree, webhook_notification
 
 
-__all__ = ['account_profile', 'bidict', 'drive_config', 'path_filter', 'pretty_api', 'webhook_notification']
+__all__ = ['account_profile', 'bidict', 'drive_config', 'path_filter', 'pretty_api', 'watch_tree',
+           'webhook_notification']
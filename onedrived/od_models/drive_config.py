@@ -1,4 +1,10 @@
 from collections import namedtuple
 
 
-LocalDriveConfig = namedtuple('LocalDriveConfig', ('drive_id', 'account_id', 'ignorefile_path', 'localroot_path'))
+DEFAULT_PRIORITY = 1
+DEFAULT_MAX_CONCURRENT_TASKS = 0
+
+LocalDriveConfig = namedtuple('LocalDriveConfig', ('drive_id', 'account_id', 'ignorefile_path', 'localroot_path',
+                                                   'priority', 'max_concurrent_tasks'))
+# Drives configured before scheduling settings were added have equal priority and no cap of concurrent tasks.
+LocalDriveConfig.__new__.__defaults__ = (DEFAULT_PRIORITY, DEFAULT_MAX_CONCURRENT_TASKS)
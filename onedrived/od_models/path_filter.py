@@ -39,3 +39,7 @@ class PathFilter(zgitignore.ZgitIgnore):
     @classmethod
     def get_temp_name(cls, name):
         return cls.TMP_PREFIX + name + cls.TMP_SUFFIX
+
+    @classmethod
+    def is_temp_name(cls, name):
+        return name.startswith(cls.TMP_PREFIX) and name.endswith(cls.TMP_SUFFIX)
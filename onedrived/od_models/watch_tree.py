@@ -0,0 +1,201 @@
+"""
+watch_tree.py
+Maps inotify watch descriptors to the directories they watch. Directories are nodes linked to their parents, so moving
+a directory relinks one node and the paths of all watches under it follow. Paths are resolved when asked for.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+
+class WatchNode:
+
+    __slots__ = ('name', 'parent', 'children', 'wd', 'repo')
+
+    def __init__(self, name, parent=None, repo=None):
+        """
+        :param str name: Name of the directory, or absolute path of the repository root if parent is None.
+        :param WatchNode | None parent:
+        :param onedrived.od_repo.OneDriveLocalRepository | None repo: Only set on root nodes.
+        """
+        self.name = name
+        self.parent = parent
+        self.children = dict()
+        self.wd = None
+        self.repo = repo
+
+    @property
+    def root(self):
+        node = self
+        while node.parent is not None:
+            node = node.parent
+        return node
+
+    @property
+    def path(self):
+        names = []
+        node = self
+        while node is not None:
+            names.append(node.name)
+            node = node.parent
+        return '/'.join(reversed(names))
+
+
+class WatchTree:
+    """
+    Has the dict interface of wd -> (repo, local_abspath) used by the watcher, plus lookups by path and moves. A node
+    without wd is kept only while some node under it has one.
+    """
+
+    def __init__(self):
+        self._roots = dict()
+        self._nodes = dict()
+
+    def _get_root(self, repo, create):
+        root = self._roots.get(repo)
+        if root is None and create:
+            root = self._roots[repo] = WatchNode(repo.local_root, repo=repo)
+        return root
+
+    def _split(self, repo, local_abspath):
+        if local_abspath == repo.local_root:
+            return []
+        if not local_abspath.startswith(repo.local_root + '/'):
+            raise ValueError('Path "%s" is not under "%s".' % (local_abspath, repo.local_root))
+        return local_abspath[len(repo.local_root) + 1:].split('/')
+
+    def _find_node(self, repo, local_abspath, create=False):
+        node = self._get_root(repo, create)
+        for name in self._split(repo, local_abspath):
+            if node is None:
+                return None
+            child = node.children.get(name)
+            if child is None and create:
+                child = node.children[name] = WatchNode(name, parent=node)
+            node = child
+        return node
+
+    def _prune(self, node):
+        while node.wd is None and len(node.children) == 0:
+            if node.parent is None:
+                del self._roots[node.repo]
+                return
+            del node.parent.children[node.name]
+            node = node.parent
+
+    def __getitem__(self, wd):
+        node = self._nodes[wd]
+        return node.root.repo, node.path
+
+    def __setitem__(self, wd, value):
+        repo, local_abspath = value
+        self.add(repo, local_abspath, wd)
+
+    def __contains__(self, wd):
+        return wd in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def keys(self):
+        return self._nodes.keys()
+
+    @property
+    def repositories(self):
+        """
+        :return [onedrived.od_repo.OneDriveLocalRepository]: Repositories having any dir watched.
+        """
+        return list(self._roots.keys())
+
+    def pop(self, wd, *default):
+        node = self._nodes.pop(wd, None)
+        if node is None:
+            if len(default) > 0:
+                return default[0]
+            raise KeyError(wd)
+        value = node.root.repo, node.path
+        node.wd = None
+        self._prune(node)
+        return value
+
+    def add(self, repo, local_abspath, wd):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :param int wd: If it watches another path, the dir was moved there and the node is moved here.
+        """
+        if wd in self._nodes:
+            old_repo, old_path = self[wd]
+            if (old_repo, old_path) != (repo, local_abspath):
+                self.move(old_repo, old_path, repo, local_abspath)
+                return
+        node = self._find_node(repo, local_abspath, create=True)
+        if node.wd is not None and node.wd != wd:
+            del self._nodes[node.wd]
+        node.wd = wd
+        self._nodes[wd] = node
+
+    def find(self, repo, local_abspath):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :return int | None: Watch descriptor of the path.
+        """
+        node = self._find_node(repo, local_abspath)
+        return node.wd if node is not None else None
+
+    def pop_path(self, repo, local_abspath):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :return int | None: Watch descriptor of the path, which is no longer mapped.
+        """
+        wd = self.find(repo, local_abspath)
+        if wd is not None:
+            self.pop(wd)
+        return wd
+
+    def pop_subtree(self, repo, local_abspath):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :return [int]: Watch descriptors of the path and all paths under it, which are no longer mapped.
+        """
+        node = self._find_node(repo, local_abspath)
+        if node is None:
+            return []
+        wds = []
+        nodes = [node]
+        while len(nodes) > 0:
+            n = nodes.pop()
+            if n.wd is not None:
+                wds.append(n.wd)
+                del self._nodes[n.wd]
+                n.wd = None
+            nodes.extend(n.children.values())
+        node.children.clear()
+        self._prune(node)
+        return wds
+
+    def move(self, repo, local_abspath, new_repo, new_local_abspath):
+        """
+        Let the watches of a dir and all dirs under it follow the dir to its new path.
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :param onedrived.od_repo.OneDriveLocalRepository new_repo:
+        :param str new_local_abspath:
+        :return True | False: Whether or not any watch was moved.
+        """
+        node = self._find_node(repo, local_abspath)
+        if node is None or node.parent is None or (repo, local_abspath) == (new_repo, new_local_abspath):
+            return False
+        old_parent = node.parent
+        # Watches already at the destination are gone with the dir replaced by the move.
+        self.pop_subtree(new_repo, new_local_abspath)
+        new_parent_path, new_name = new_local_abspath.rsplit('/', maxsplit=1)
+        new_parent = self._find_node(new_repo, new_parent_path, create=True)
+        del old_parent.children[node.name]
+        node.name = new_name
+        node.parent = new_parent
+        new_parent.children[new_name] = node
+        self._prune(old_parent)
+        return True
@@ -0,0 +1,194 @@
+"""
+od_poller.py
+Polls local dirs that inotify can't watch, e.g., after fs.inotify.max_user_watches is reached. A dir is checked by its
+mtime and by the stat of its entries, so that files edited in place are found. Dirs found changed are checked more
+often, and dirs that stay unchanged less often.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+import heapq
+import itertools
+import logging
+import os
+import stat
+import threading
+import time
+
+
+class PolledDir:
+
+    __slots__ = ('mtime_ns', 'entries', 'interval', 'next_check')
+
+    def __init__(self, mtime_ns, entries, interval, next_check):
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.interval = interval
+        self.next_check = next_check
+
+
+class DirPoller:
+
+    MIN_INTERVAL_SEC = 2
+    MAX_INTERVAL_SEC = 300
+    # Work done in one poll cycle. Dirs due beyond the caps are checked in the next cycles.
+    MAX_DIRS_PER_CYCLE = 256
+    MAX_ENTRIES_PER_CYCLE = 20000
+
+    def __init__(self, loop, callback):
+        """
+        :param asyncio.AbstractEventLoop loop:
+        :param callback: Called in the loop with the repo and path of a changed dir, and whether or not any sub-dir
+            was added, removed or changed type.
+        """
+        self.loop = loop
+        self.callback = callback
+        self._lock = threading.Lock()
+        # Maps (repo, local_abspath) to PolledDir.
+        self._dirs = dict()
+        # Heap of (next_check, seq, (repo, local_abspath)). Entries outdated by later checks are skipped when popped.
+        self._queue = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    def __contains__(self, key):
+        return key in self._dirs
+
+    def __len__(self):
+        return len(self._dirs)
+
+    @staticmethod
+    def _list_entries(local_abspath):
+        """
+        :param str local_abspath:
+        :return dict[str, (int, int, int)]: Maps entry names to file type, size and mtime. Sub-dirs are polled or
+            watched on their own, so only their type is compared.
+        """
+        entries = dict()
+        with os.scandir(local_abspath) as it:
+            for entry in it:
+                entry_stat = entry.stat(follow_symlinks=False)
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    entries[entry.name] = (stat.S_IFDIR, 0, 0)
+                else:
+                    entries[entry.name] = (stat.S_IFMT(entry_stat.st_mode), entry_stat.st_size, entry_stat.st_mtime_ns)
+        return entries
+
+    @staticmethod
+    def _get_dir_names(entries):
+        return {name for name, (file_type, _, _) in entries.items() if file_type == stat.S_IFDIR}
+
+    def _push(self, key, polled_dir):
+        heapq.heappush(self._queue, (polled_dir.next_check, next(self._seq), key))
+
+    def _schedule(self):
+        with self._lock:
+            if self._timer is None and len(self._dirs) > 0:
+                self._timer = self.loop.call_later(self.MIN_INTERVAL_SEC, self.poll)
+
+    def add_dir(self, repo, local_abspath):
+        """
+        Start polling a dir. Its current state is the base of later checks.
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        """
+        # Stat the dir before listing it so that changes made in between are found by the first check.
+        mtime_ns = os.stat(local_abspath).st_mtime_ns
+        entries = self._list_entries(local_abspath)
+        with self._lock:
+            polled_dir = PolledDir(mtime_ns, entries, self.MIN_INTERVAL_SEC, time.monotonic() + self.MIN_INTERVAL_SEC)
+            self._dirs[(repo, local_abspath)] = polled_dir
+            self._push((repo, local_abspath), polled_dir)
+        self.loop.call_soon_threadsafe(self._schedule)
+
+    def remove_dir(self, repo, local_abspath):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :return True | False: Whether or not the dir was polled.
+        """
+        with self._lock:
+            return self._dirs.pop((repo, local_abspath), None) is not None
+
+    def _get_keys_under(self, repo, local_abspath):
+        return [k for k in self._dirs if k[0] is repo and (k[1] == local_abspath or
+                                                           k[1].startswith(local_abspath + '/'))]
+
+    def remove_tree(self, repo, local_abspath):
+        """
+        Stop polling a dir and all dirs under it.
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        """
+        with self._lock:
+            for k in self._get_keys_under(repo, local_abspath):
+                del self._dirs[k]
+
+    def move_tree(self, repo, local_abspath, new_repo, new_local_abspath):
+        """
+        Keep polling a moved dir and the dirs under it at their new paths.
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath:
+        :param onedrived.od_repo.OneDriveLocalRepository new_repo:
+        :param str new_local_abspath:
+        """
+        with self._lock:
+            for k in self._get_keys_under(repo, local_abspath):
+                polled_dir = self._dirs.pop(k)
+                new_key = (new_repo, new_local_abspath + k[1][len(local_abspath):])
+                self._dirs[new_key] = polled_dir
+                self._push(new_key, polled_dir)
+
+    def _check(self, local_abspath, polled_dir):
+        """
+        :param str local_abspath:
+        :param PolledDir polled_dir: Updated to the current state of the dir.
+        :return (True | False, True | False): Whether or not the dir changed, and whether or not its sub-dirs changed.
+        """
+        mtime_ns = os.stat(local_abspath).st_mtime_ns
+        entries = self._list_entries(local_abspath)
+        is_changed = mtime_ns != polled_dir.mtime_ns or entries != polled_dir.entries
+        dirs_changed = is_changed and self._get_dir_names(entries) != self._get_dir_names(polled_dir.entries)
+        polled_dir.mtime_ns, polled_dir.entries = mtime_ns, entries
+        return is_changed, dirs_changed
+
+    def poll(self):
+        """Check the dirs that are due, within the work caps of a cycle."""
+        now = time.monotonic()
+        changes = []
+        with self._lock:
+            self._timer = None
+            num_dirs = num_entries = 0
+            while len(self._queue) > 0 and self._queue[0][0] <= now and \
+                    num_dirs < self.MAX_DIRS_PER_CYCLE and num_entries < self.MAX_ENTRIES_PER_CYCLE:
+                next_check, _, key = heapq.heappop(self._queue)
+                polled_dir = self._dirs.get(key)
+                if polled_dir is None or polled_dir.next_check != next_check:
+                    continue
+                num_dirs += 1
+                try:
+                    is_changed, dirs_changed = self._check(key[1], polled_dir)
+                except OSError as e:
+                    # The parent dir, watched or polled, reports the deletion.
+                    logging.debug('Stop polling local dir "%s": %s.', key[1], e)
+                    del self._dirs[key]
+                    continue
+                num_entries += len(polled_dir.entries)
+                if is_changed:
+                    polled_dir.interval = self.MIN_INTERVAL_SEC
+                    changes.append((key[0], key[1], dirs_changed))
+                else:
+                    polled_dir.interval = min(polled_dir.interval * 2, self.MAX_INTERVAL_SEC)
+                polled_dir.next_check = now + polled_dir.interval
+                self._push(key, polled_dir)
+        self._schedule()
+        for repo, local_abspath, dirs_changed in changes:
+            self.callback(repo, local_abspath, dirs_changed)
+
+    def close(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._dirs.clear()
+            self._queue.clear()
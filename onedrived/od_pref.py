@@ -244,6 +244,8 @@ def print_saved_drives():
             click.echo('   Account:     %s (%s)' % (curr_account.account_email, curr_drive_config.account_id))
             click.echo('   Local root:  %s' % curr_drive_config.localroot_path)
             click.echo('   Ignore file: %s' % curr_drive_config.ignorefile_path)
+            click.echo('   Priority:    %d (max concurrent tasks: %d)' % (
+                curr_drive_config.priority, curr_drive_config.max_concurrent_tasks))
             click.echo()
     else:
         click.echo(' No Drive has been setup with onedrived.\n')
@@ -313,7 +315,11 @@ def read_drive_config_interactively(drive_exists, curr_drive_config):
               help='Path to a local directory to sync with the Drive.')
 @click.option('--ignore-file', type=str, required=False, default=None,
               help='Path to an ignore file specific to the Drive.')
-def set_drive(drive_id=None, email=None, local_root=None, ignore_file=None):
+@click.option('--priority', type=click.IntRange(min=1), required=False, default=None,
+              help='Number of tasks of the Drive to run before tasks of other Drives get their turn. Default: 1.')
+@click.option('--max-concurrent-tasks', type=click.IntRange(min=0), required=False, default=None,
+              help='Max number of tasks of the Drive to run at the same time. Default: 0 (no limit).')
+def set_drive(drive_id=None, email=None, local_root=None, ignore_file=None, priority=None, max_concurrent_tasks=None):
     try:
         all_drives, drive_table = print_all_drives()
         click.echo()
@@ -360,6 +366,17 @@ def set_drive(drive_id=None, email=None, local_root=None, ignore_file=None):
     click.echo(click.style(
         'Going to add/edit Drive "%s" of account "%s"...' % (drive_id, account_profile.account_email), fg='cyan'))
 
+    if drive_exists:
+        if priority is None:
+            priority = curr_drive_config.priority
+        if max_concurrent_tasks is None:
+            max_concurrent_tasks = curr_drive_config.max_concurrent_tasks
+    else:
+        if priority is None:
+            priority = drive_config.DEFAULT_PRIORITY
+        if max_concurrent_tasks is None:
+            max_concurrent_tasks = drive_config.DEFAULT_MAX_CONCURRENT_TASKS
+
     if interactive:
         local_root, ignore_file = read_drive_config_interactively(drive_exists, curr_drive_config)
     else:
@@ -382,19 +399,24 @@ def set_drive(drive_id=None, email=None, local_root=None, ignore_file=None):
                 ignore_file = context.config_dir + '/' + context.DEFAULT_IGNORE_FILENAME
             if (drive_exists and
                 local_root == curr_drive_config.localroot_path and
-                    ignore_file == curr_drive_config.ignorefile_path):
+                ignore_file == curr_drive_config.ignorefile_path and
+                priority == curr_drive_config.priority and
+                    max_concurrent_tasks == curr_drive_config.max_concurrent_tasks):
                 click.secho('No parameter was changed. Skipped operation.', fg='yellow')
                 return
         except ValueError as e:
             error(str(e))
             return
 
-    d = context.add_drive(drive_config.LocalDriveConfig(drive_id, account_id, ignore_file, local_root))
+    d = context.add_drive(drive_config.LocalDriveConfig(
+        drive_id, account_id, ignore_file, local_root, priority, max_concurrent_tasks))
     save_context(context)
     success('\nSuccessfully configured Drive %s of account %s (%s):' % (
         d.drive_id, account_profile.account_email, d.account_id))
     click.echo('  Local directory: ' + d.localroot_path)
     click.echo('  Ignore file path: ' + d.ignorefile_path)
+    click.echo('  Priority: %d' % d.priority)
+    click.echo('  Max concurrent tasks: %d' % d.max_concurrent_tasks)
 
 
 @click.command(name='del', short_help=translator['od_pref.del_drive.short_help'])
@@ -425,10 +447,15 @@ def delete_drive(drive_id=None, yes=False):
 
     if yes or click.confirm('Continue to delete Drive "%s" (its local directory will NOT be deleted)?' % drive_id,
                             abort=True):
+        db_path = get_drive_db_path(context.config_dir, drive_id)
         try:
-            os.unlink(get_drive_db_path(context.config_dir, drive_id))
+            os.unlink(db_path)
         except Exception as e:
             warning(translator['od_pref.del_drive.error_del_db_file'].format(error=str(e)))
+        # Write-ahead log of the database, if the daemon did not checkpoint it.
+        for path in (db_path + '-wal', db_path + '-shm'):
+            if os.path.exists(path):
+                os.unlink(path)
         context.delete_drive(drive_id)
         save_context(context)
         success('Successfully deleted Drive "%s" from onedrived.' % drive_id)
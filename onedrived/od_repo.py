@@ -7,22 +7,32 @@ Core component for local file management and tracking.
 
 import atexit
 import logging
+import os
 import sqlite3
+import stat
 import threading
+from collections import namedtuple
 from datetime import datetime
 from contextlib import closing
 
 from . import get_resource as _get_resource
+from . import od_trace
 from .od_models.path_filter import PathFilter as _PathFilter
 from .od_api_helper import get_item_modified_datetime, get_item_created_datetime
-from .od_dateutils import str_to_datetime, datetime_to_str
+from .od_dateutils import datetime_to_timestamp, diff_timestamps, str_to_datetime, datetime_to_str
+from .od_hashutils import quick_fingerprint
+
+
+# Columns of items table in the order ItemRecord reads them.
+_ITEM_RECORD_COLUMNS = 'id, type, name, parent_id, parent_path, etag, ctag, size, size_local, created_time, ' \
+                       'modified_time, status, sha1_hash, record_time, inode, device, fingerprint'
 
 
 class ItemRecord:
     def __init__(self, row):
         self.item_id, self.type, self.item_name, self.parent_id, self.parent_path, self.e_tag, self.c_tag, \
             self.size, self.size_local, self.created_time, self.modified_time, self.status, self.sha1_hash, \
-            self.record_time_str = row
+            self.record_time_str, self.inode, self.device, self.fingerprint = row
         self.created_time = str_to_datetime(self.created_time)
         self.modified_time = str_to_datetime(self.modified_time)
 
@@ -36,6 +46,16 @@ class ItemRecordStatus:
     OK = 0
 
 
+class RepositoryStateKey:
+    CLEAN_SHUTDOWN = 'clean_shutdown'
+    DELTA_TOKEN = 'delta_token'
+    JOURNAL_CONSISTENT = 'journal_consistent'
+
+
+# A compact record of a queued task. See onedrived.od_tasks.journal for how tasks are encoded.
+TaskJournalEntry = namedtuple('TaskJournalEntry', ('seq', 'task_type', 'rel_path', 'item_id', 'etag', 'args'))
+
+
 class RepositoryType:
     PERSONAL = 0
     BUSINESS = 1
@@ -62,8 +82,11 @@ class OneDriveLocalRepository:
         self.local_root = drive_config.localroot_path
         self.type = RepositoryType.BUSINESS if drive.drive_type == 'business' else RepositoryType.PERSONAL
         self._lock = threading.Lock()
+        # Held while a delta query is being applied.
+        self.delta_lock = threading.Lock()
         self._init_path_filter(ignore_file=drive_config.ignorefile_path)
         self._init_item_store()
+        self._init_shutdown_marker()
         self.refresh_session()
 
     @property
@@ -81,9 +104,84 @@ class OneDriveLocalRepository:
 
     def _init_item_store(self):
         self._conn = sqlite3.connect(self._item_store_path, check_same_thread=False)
-        self._conn.execute(_get_resource('data/items_db.sql', pkg_name='onedrived'))
+        # Every queued task costs a commit to task journal. In WAL mode with synchronous=NORMAL a commit appends to
+        # the log without waiting for fsync, and the database stays consistent if the process crashes.
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_get_resource('data/items_db.sql', pkg_name='onedrived'))
+        with self._conn:
+            columns = {row[1] for row in self._conn.execute('PRAGMA table_info(items)')}
+            if 'inode' not in columns:
+                # The database was created by an older version.
+                self._conn.execute('ALTER TABLE items ADD COLUMN inode INT')
+                self._conn.execute('ALTER TABLE items ADD COLUMN device INT')
+            if 'fingerprint' not in columns:
+                self._conn.execute('ALTER TABLE items ADD COLUMN fingerprint TEXT')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS items_inode ON items (inode, device)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS items_size ON items (size)')
+            # No task of last session is in memory now.
+            self._conn.execute('UPDATE task_journal SET in_memory=0')
         atexit.register(self.close)
 
+    def _init_shutdown_marker(self):
+        # The marker is cleared as soon as the repository is opened, so that it is only set again if this session
+        # also ends cleanly.
+        self.was_shut_down_cleanly = self.get_state(RepositoryStateKey.CLEAN_SHUTDOWN) == '1'
+        # Even if last session crashed, its unfinished work is in task journal, unless some task failed.
+        self.is_journal_consistent = self.get_state(RepositoryStateKey.JOURNAL_CONSISTENT) == '1'
+        self.has_failed_tasks = False
+        # Set until the first full merge of the session is queued. That merge must not trust the tags and snapshots
+        # left by last session, which may have been saved before the work under them was done.
+        self.needs_recovery = not (self.was_shut_down_cleanly or self.is_journal_consistent)
+        self.set_state(RepositoryStateKey.CLEAN_SHUTDOWN, '0')
+
+    def mark_journal_consistent(self):
+        """
+        Record that all work needed to sync the Drive has been queued, so that the task journal, delta token and local
+        dir snapshots are enough to resume syncing after a crash. Nothing is recorded if any task failed.
+        """
+        if not self.has_failed_tasks:
+            self.set_state(RepositoryStateKey.JOURNAL_CONSISTENT, '1')
+
+    def mark_task_failed(self, local_abspath=None):
+        """
+        Record that a task failed in this session, leaving some items out of sync.
+        :param str | None local_abspath: Path the failed task worked on. Directories above it are invalidated.
+        """
+        if not self.has_failed_tasks:
+            self.has_failed_tasks = True
+            self.set_state(RepositoryStateKey.JOURNAL_CONSISTENT, '0')
+        if local_abspath is not None:
+            self.invalidate_dirs(local_abspath[len(self.local_root):])
+
+    def invalidate_dirs(self, rel_path):
+        """
+        Forget the tags and snapshots of a directory and of all directories above it. The tags of a folder are saved
+        before the work under it is done, so if some of that work failed, later merges must neither prune the subtree
+        nor skip listing the remote directories down to the path.
+        :param str rel_path: Path of the directory, or of an item in it.
+        """
+        paths = [rel_path]
+        while rel_path != '':
+            rel_path = rel_path.rsplit('/', maxsplit=1)[0]
+            paths.append(rel_path)
+        with od_trace.span('invalidate_dirs', 'db'), self._lock, self._conn:
+            self._conn.executemany('DELETE FROM dir_snapshots WHERE path=?', [(p,) for p in paths])
+            self._conn.executemany('UPDATE items SET etag=NULL, ctag=NULL WHERE parent_path=? AND name=? AND type=?',
+                                   [tuple(p.rsplit('/', maxsplit=1)) + (ItemRecordType.FOLDER,)
+                                    for p in paths if p != ''])
+
+    def mark_clean_shutdown(self):
+        """
+        Record that local files, database and remote Drive were consistent when the daemon stopped. Nothing is recorded
+        if any task failed in this session, so that next start merges the whole Drive and retries the failed items.
+        :return True | False: Whether or not the marker was set.
+        """
+        if self.has_failed_tasks:
+            return False
+        self.set_state(RepositoryStateKey.CLEAN_SHUTDOWN, '1')
+        return True
+
     def refresh_session(self):
         logging.debug('Refreshing repository session.')
         self.authenticator.refresh_session(self.account_id)
@@ -98,6 +196,130 @@ class OneDriveLocalRepository:
         logging.debug('Closing database "%s".', self._item_store_path)
         self._conn.close()
 
+    def get_state(self, key, default=None):
+        """
+        :param str key: One of RepositoryStateKey.
+        :param str | None default:
+        :return str | None:
+        """
+        with self._lock:
+            rec = self._conn.execute('SELECT value FROM repo_state WHERE key=?', (key,)).fetchone()
+            return rec[0] if rec else default
+
+    def set_state(self, key, value):
+        """
+        :param str key: One of RepositoryStateKey.
+        :param str | None value: None to delete the key.
+        """
+        with od_trace.span('set_state', 'db'), self._lock, self._conn:
+            if value is None:
+                self._conn.execute('DELETE FROM repo_state WHERE key=?', (key,))
+            else:
+                self._conn.execute('INSERT INTO repo_state (key, value) VALUES (?, ?)', (key, value))
+
+    def get_dir_snapshots(self):
+        """
+        :return dict(str, int): Map relative path of every snapshotted directory to its st_mtime_ns.
+        """
+        with self._lock:
+            return dict(self._conn.execute('SELECT path, mtime_ns FROM dir_snapshots').fetchall())
+
+    def update_dir_snapshot(self, relpath, mtime_ns):
+        """
+        Record the mtime of a local directory right after it was merged.
+        :param str relpath:
+        :param int mtime_ns:
+        """
+        with od_trace.span('update_dir_snapshot', 'db'), self._lock, self._conn:
+            self._conn.execute('INSERT INTO dir_snapshots (path, mtime_ns) VALUES (?, ?)', (relpath, mtime_ns))
+
+    def delete_dir_snapshot(self, relpath):
+        """
+        Forget the snapshot of a local directory, e.g., when a merge of it starts and has yet to finish.
+        :param str relpath:
+        """
+        with od_trace.span('delete_dir_snapshot', 'db'), self._lock, self._conn:
+            self._conn.execute('DELETE FROM dir_snapshots WHERE path=?', (relpath,))
+
+    def add_journal_entry(self, task_type, rel_path, item_id=None, etag=None, args=None, in_memory=True):
+        """
+        :param str task_type:
+        :param str rel_path: Relative path of the item the task works on.
+        :param str | None item_id:
+        :param str | None etag:
+        :param str | None args: Other arguments of the task, encoded in JSON.
+        :param True | False in_memory: Whether or not the task is kept in memory.
+        :return int: Sequence number of the entry.
+        """
+        with od_trace.span('add_journal_entry', 'db'), self._lock, self._conn:
+            return self._conn.execute(
+                'INSERT INTO task_journal (task_type, rel_path, item_id, etag, args, in_memory) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (task_type, rel_path, item_id, etag, args, int(in_memory))).lastrowid
+
+    def delete_journal_entry(self, seq):
+        """
+        :param int seq:
+        """
+        with od_trace.span('delete_journal_entry', 'db'), self._lock, self._conn:
+            self._conn.execute('DELETE FROM task_journal WHERE seq=?', (seq,))
+
+    def delete_journal_entries(self, seqs):
+        """
+        Delete entries in one transaction.
+        :param [int] seqs:
+        """
+        with od_trace.span('delete_journal_entries', 'db'), self._lock, self._conn:
+            self._conn.executemany('DELETE FROM task_journal WHERE seq=?', [(seq,) for seq in seqs])
+
+    def delete_journal_entries_under(self, rel_path):
+        """
+        Delete entries of tasks on the path or its descendants which are not in memory.
+        :param str rel_path:
+        :return int: Number of deleted entries.
+        """
+        with od_trace.span('delete_journal_entries', 'db'), self._lock, self._conn:
+            return self._conn.execute('DELETE FROM task_journal WHERE in_memory=0 AND (rel_path=? OR rel_path LIKE ?)',
+                                      (rel_path, rel_path + '/%')).rowcount
+
+    def has_journal_entry_on_disk(self, rel_path):
+        """
+        :param str rel_path:
+        :return True | False: Whether or not a task on the path is in the journal but not in memory.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM task_journal WHERE rel_path=? AND in_memory=0 LIMIT 1',
+                                      (rel_path,)).fetchone() is not None
+
+    def count_journal_entries_on_disk(self):
+        """
+        :return int: Number of tasks in the journal which are not in memory.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM task_journal WHERE in_memory=0').fetchone()[0]
+
+    def load_journal_entries(self, limit):
+        """
+        Load the oldest entries which are not in memory, and mark them in memory.
+        :param int limit:
+        :return [TaskJournalEntry]:
+        """
+        with od_trace.span('load_journal_entries', 'db'), self._lock, self._conn:
+            entries = [TaskJournalEntry(*row) for row in self._conn.execute(
+                'SELECT seq, task_type, rel_path, item_id, etag, args FROM task_journal WHERE in_memory=0 '
+                'ORDER BY seq LIMIT ?', (limit,)).fetchall()]
+            self._conn.executemany('UPDATE task_journal SET in_memory=1 WHERE seq=?', [(e.seq,) for e in entries])
+            return entries
+
+    def get_item_by_id(self, item_id):
+        """
+        :param str item_id:
+        :return ItemRecord | None:
+        """
+        with self._lock:
+            q = self._conn.execute('SELECT ' + _ITEM_RECORD_COLUMNS + ' FROM items WHERE id=? LIMIT 1', (item_id,))
+            rec = q.fetchone()
+            return ItemRecord(rec) if rec else None
+
     def get_item_by_path(self, item_name, parent_relpath):
         """
         Fetch a record form database. Return None if not found.
@@ -106,21 +328,75 @@ class OneDriveLocalRepository:
         :return ItemRecord | None:
         """
         with self._lock:
-            q = self._conn.execute('SELECT id, type, name, parent_id, parent_path, etag, ctag, size, size_local, '
-                                   'created_time, modified_time, status, sha1_hash, record_time FROM items '
+            q = self._conn.execute('SELECT ' + _ITEM_RECORD_COLUMNS + ' FROM items '
                                    'WHERE name=? AND parent_path=? LIMIT 1', (item_name, parent_relpath))
             rec = q.fetchone()
             return ItemRecord(rec) if rec else None
 
+    def get_item_by_inode(self, inode, device):
+        """
+        Find the record of the item that was last synced with the given local inode.
+        :param int inode:
+        :param int device:
+        :return ItemRecord | None:
+        """
+        with self._lock:
+            q = self._conn.execute('SELECT ' + _ITEM_RECORD_COLUMNS + ' FROM items WHERE inode=? AND device=? LIMIT 1',
+                                   (inode, device))
+            rec = q.fetchone()
+            return ItemRecord(rec) if rec else None
+
+    def has_other_file_of_size(self, size, item_name, parent_relpath):
+        """
+        Tell cheaply if any recorded file could have the same content as a local file, before the file is hashed.
+        :param int size:
+        :param str item_name: Name of the local file, whose own record is not counted.
+        :param str parent_relpath:
+        :return True | False:
+        """
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM items WHERE size=? AND type=? AND NOT (parent_path=? AND name=?) '
+                                      'LIMIT 1', (size, ItemRecordType.FILE, parent_relpath, item_name)
+                                      ).fetchone() is not None
+
+    def get_items_by_hash(self, sha1_hash, size):
+        """
+        Find records of files with the given content.
+        :param str sha1_hash: SHA-1 hash in upper case, as OneDrive reports it.
+        :param int size:
+        :return [ItemRecord]:
+        """
+        with self._lock:
+            q = self._conn.execute('SELECT ' + _ITEM_RECORD_COLUMNS + ' FROM items WHERE sha1_hash=? AND size=? '
+                                   'AND type=?', (sha1_hash, size, ItemRecordType.FILE))
+            return [ItemRecord(rec) for rec in q.fetchall()]
+
+    def find_unchanged_files(self, sha1_hash, size):
+        """
+        Find local files that have the given content and have not changed since they were synced.
+        :param str sha1_hash: SHA-1 hash in upper case.
+        :param int size:
+        :return [str]: Absolute paths of the files.
+        """
+        paths = []
+        for record in self.get_items_by_hash(sha1_hash, size):
+            path = self.local_root + record.parent_path + '/' + record.item_name
+            try:
+                item_stat = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(item_stat.st_mode) and item_stat.st_size == record.size_local and \
+                    diff_timestamps(item_stat.st_mtime, datetime_to_timestamp(record.modified_time)) == 0:
+                paths.append(path)
+        return paths
+
     def get_immediate_children_of_dir(self, relpath):
         """
         :param str relpath:
         :return dict(str, ItemRecord):
         """
         with self._lock:
-            q = self._conn.execute('SELECT id, type, name, parent_id, parent_path, etag, ctag, size, size_local, '
-                                   'created_time, modified_time, status, sha1_hash, record_time FROM items '
-                                   'WHERE parent_path=?', (relpath,))
+            q = self._conn.execute('SELECT ' + _ITEM_RECORD_COLUMNS + ' FROM items WHERE parent_path=?', (relpath,))
             return {rec[2]: ItemRecord(rec) for rec in q.fetchall() if rec}
 
     def delete_item(self, item_name, parent_relpath, is_folder=False):
@@ -130,11 +406,13 @@ class OneDriveLocalRepository:
         :param str parent_relpath: Relative path of its parent item.
         :param True | False is_folder: True to indicate that the item is a folder (delete all children).
         """
-        with self._lock, self._conn, closing(self._conn.cursor()) as cursor:
+        with od_trace.span('delete_item', 'db'), self._lock, self._conn, closing(self._conn.cursor()) as cursor:
             if is_folder:
                 item_relpath = parent_relpath + '/' + item_name
                 cursor.execute('DELETE FROM items WHERE parent_path=? OR parent_path LIKE ?',
                                (item_relpath, item_relpath + '/%'))
+                cursor.execute('DELETE FROM dir_snapshots WHERE path=? OR path LIKE ?',
+                               (item_relpath, item_relpath + '/%'))
             cursor.execute('DELETE FROM items WHERE parent_path=? AND name=?', (parent_relpath, item_name))
 
     def move_item(self, item_name, parent_relpath, new_name, new_parent_relpath, is_folder=False):
@@ -145,13 +423,16 @@ class OneDriveLocalRepository:
         :param str new_parent_relpath: Relative path of its parent item.
         :param True | False is_folder: True to indicate that the item is a folder (delete all children).
         """
-        with self._lock, self._conn, closing(self._conn.cursor()) as cursor:
+        with od_trace.span('move_item', 'db'), self._lock, self._conn, closing(self._conn.cursor()) as cursor:
             if is_folder:
                 item_relpath = parent_relpath + '/' + item_name
                 cursor.execute('UPDATE items SET parent_path=? || substr(parent_path, ?) '
                                'WHERE parent_path=? OR parent_path LIKE ?',
                                (new_parent_relpath + '/' + new_name, len(item_relpath) + 1,
                                 item_relpath, item_relpath + '/%'))
+                cursor.execute('UPDATE dir_snapshots SET path=? || substr(path, ?) WHERE path=? OR path LIKE ?',
+                               (new_parent_relpath + '/' + new_name, len(item_relpath) + 1,
+                                item_relpath, item_relpath + '/%'))
             cursor.execute('UPDATE items SET parent_path=?, name=? WHERE parent_path=? AND name=?',
                            (new_parent_relpath, new_name, parent_relpath, item_name))
 
@@ -177,11 +458,23 @@ class OneDriveLocalRepository:
         modified_time, _ = get_item_modified_datetime(item)
         modified_time_str = datetime_to_str(modified_time)
         created_time_str = datetime_to_str(get_item_created_datetime(item))
-        with self._lock, self._conn:
+        fingerprint = None
+        try:
+            # The inode of local item tells where it went if it is moved while the daemon is not running.
+            local_stat = os.lstat(self.local_root + parent_relpath + '/' + item.name)
+            inode, device = local_stat.st_ino, local_stat.st_dev
+            # A positive local size means the local file has the content of the item. Its fingerprint can tell that
+            # the file changed later without hashing all of it.
+            if item_type == ItemRecordType.FILE and size_local > 0 and stat.S_ISREG(local_stat.st_mode) and \
+                    local_stat.st_size == size_local:
+                fingerprint = quick_fingerprint(self.local_root + parent_relpath + '/' + item.name)
+        except OSError:
+            inode = device = None
+        with od_trace.span('update_item', 'db'), self._lock, self._conn:
             self._conn.execute(
                 'INSERT OR REPLACE INTO items (id, type, name, parent_id, parent_path, etag, '
-                'ctag, size, size_local, created_time, modified_time, status, sha1_hash, record_time)'
-                ' VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                'ctag, size, size_local, created_time, modified_time, status, sha1_hash, record_time, inode, device, '
+                'fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
                 (item.id, item_type, item.name, parent_reference.id, parent_relpath, item.e_tag, item.c_tag,
                  item.size, size_local, created_time_str, modified_time_str, status, sha1_hash,
-                 str(datetime.utcnow().isoformat()) + 'Z'))
+                 str(datetime.utcnow().isoformat()) + 'Z', inode, device, fingerprint))
@@ -5,22 +5,50 @@ Core component for OneDrive server-client interaction management.
 :license: MIT
 """
 
+import collections
+import itertools
 import logging
 import threading
 
+from .od_tasks import journal
+
 
 class TaskPool:
     """
     An in-memory storage for od_tasks.
 
+    Tasks are queued per repository. Workers take tasks from the queues in weighted round-robin order, so that a Drive
+    with a huge backlog (e.g., its initial sync) does not starve other Drives. A queue serves as many tasks in its turn
+    as the priority of its repository, and is skipped while its repository has reached the cap of concurrent tasks.
+
+    Tasks triggered by local changes (see TaskBase.interactive) skip the queues and go to a fast lane, which workers
+    serve first, so that a change made by the user is synced in time even if a full merge has queued many tasks.
+
+    Tasks of a repository with task journal enabled are also recorded in its database until they are done, so that
+    they survive restarts. Only a bounded window of them is kept in memory; the rest wait in the journal and are loaded
+    as the window drains.
+
     Some notes:
       (1) Tried to let worker threads and inotify watcher communicate by reading/writing a "working path set" but
           because workers tend to delete path before watcher can read it.
     """
 
+    DEFAULT_SCHEDULE = (1, 0)
+
     def __init__(self):
         self.tasks_by_path = {}
-        self.queued_tasks = []
+        # Queues in round-robin order. The first queue has the current turn.
+        self._queues = collections.OrderedDict()
+        self._fast_lane = collections.deque()
+        self._schedules = {}
+        self._running_counts = collections.Counter()
+        self._turn_credits = 0
+        self._num_queued = 0
+        self._journal_windows = {}
+        # Number of tasks of each repository which are only in task journal.
+        self._num_on_disk = collections.Counter()
+        # Number of semaphore releases consumed by workers which found every queued task blocked by concurrency caps.
+        self._num_deferred = 0
         self.semaphore = threading.Semaphore(0)
         self._lock = threading.Lock()
 
@@ -28,6 +56,37 @@ class TaskPool:
         for _ in range(n):
             self.semaphore.release()
 
+    def set_schedule(self, repo, priority=1, max_concurrent_tasks=0):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param int priority: Number of tasks of the repository to run in each round.
+        :param int max_concurrent_tasks: Max number of tasks of the repository to run at the same time. 0 for no cap.
+        """
+        with self._lock:
+            self._schedules[repo] = (max(priority, 1), max(max_concurrent_tasks, 0))
+
+    def set_journal(self, repo, max_tasks_in_memory):
+        """
+        Record tasks of the repository in its task journal, and queue the tasks left in the journal by last session.
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param int max_tasks_in_memory: Max number of queued tasks of the repository to keep in memory.
+        """
+        with self._lock:
+            self._journal_windows[repo] = max(max_tasks_in_memory, 1)
+            num_replayed = repo.count_journal_entries_on_disk()
+            if num_replayed > 0:
+                logging.info('Replaying %d tasks left in task journal of Drive %s.', num_replayed, repo.drive.id)
+                self._num_on_disk[repo] += num_replayed
+                self._num_queued += num_replayed
+                self._get_queue(repo)
+        for _ in range(num_replayed):
+            self.semaphore.release()
+
+    def _get_queue(self, repo):
+        if repo not in self._queues:
+            self._queues[repo] = collections.deque()
+        return self._queues[repo]
+
     def add_task(self, task):
         """
         Add a task to internal storage. It will not add if there is already a task on the path.
@@ -37,28 +96,107 @@ class TaskPool:
         with self._lock:
             if task.local_abspath in self.tasks_by_path:
                 return False
-            self.queued_tasks.append(task)
-            self.tasks_by_path[task.local_abspath] = task
+            queue = self._fast_lane if task.interactive else self._get_queue(task.repo)
+            window = self._journal_windows.get(task.repo)
+            descriptor = journal.get_descriptor(task) if window is not None else None
+            if descriptor is not None:
+                if self._num_on_disk[task.repo] > 0 and task.repo.has_journal_entry_on_disk(descriptor[1]):
+                    return False
+                # Keep the order of tasks: once some tasks wait on disk, later ones wait as well.
+                in_memory = task.interactive or self._num_on_disk[task.repo] == 0 and len(queue) < window
+                seq = task.repo.add_journal_entry(*descriptor, in_memory=in_memory)
+                if in_memory:
+                    task.journal_seq = seq
+                else:
+                    self._num_on_disk[task.repo] += 1
+            else:
+                in_memory = True
+            if in_memory:
+                queue.append(task)
+                self.tasks_by_path[task.local_abspath] = task
+            self._num_queued += 1
         self.semaphore.release()
         return True
 
+    def _load_from_journal(self, repo, queue):
+        window = self._journal_windows[repo]
+        for entry in repo.load_journal_entries(window - len(queue)):
+            self._num_on_disk[repo] -= 1
+            task = journal.create_task(repo, self, entry)
+            if task is None or task.local_abspath in self.tasks_by_path:
+                # A task on the same path is in memory or in progress.
+                repo.delete_journal_entry(entry.seq)
+                self._num_queued -= 1
+                continue
+            task.journal_seq = entry.seq
+            queue.append(task)
+            self.tasks_by_path[task.local_abspath] = task
+
+    def _end_turn(self):
+        repo, queue = self._queues.popitem(last=False)
+        if len(queue) > 0 or self._num_on_disk[repo] > 0:
+            self._queues[repo] = queue
+        self._turn_credits = 0
+
+    def _is_capped(self, repo):
+        return 0 < self._schedules.get(repo, self.DEFAULT_SCHEDULE)[1] <= self._running_counts[repo]
+
+    def _start_task(self, task):
+        self._num_queued -= 1
+        self._running_counts[task.repo] += 1
+        del self.tasks_by_path[task.local_abspath]
+        return task
+
     def pop_task(self):
         """
-        Pop the oldest task. It's required that the caller first acquire the semaphore.
+        Pop the oldest task in the fast lane, or else the oldest task of the repository whose turn it is. It's required
+        that the caller first acquire the semaphore, and call task_done() after handling the task.
         :return onedrived.od_tasks.base.TaskBase | None: The first qualified task, or None.
         """
         # logging.debug('Getting task...')
         with self._lock:
-            ret = None
-            if len(self.queued_tasks):
-                ret = self.queued_tasks.pop(0)
-                del self.tasks_by_path[ret.local_abspath]
-            return ret
+            for task in self._fast_lane:
+                if not self._is_capped(task.repo):
+                    self._fast_lane.remove(task)
+                    return self._start_task(task)
+            for _ in range(len(self._queues)):
+                repo, queue = next(iter(self._queues.items()))
+                if self._num_on_disk[repo] > 0 and len(queue) <= self._journal_windows[repo] // 2:
+                    self._load_from_journal(repo, queue)
+                if len(queue) == 0 or self._is_capped(repo):
+                    self._end_turn()
+                    continue
+                if self._turn_credits <= 0:
+                    self._turn_credits = self._schedules.get(repo, self.DEFAULT_SCHEDULE)[0]
+                ret = queue.popleft()
+                self._turn_credits -= 1
+                if self._turn_credits == 0 or len(queue) == 0:
+                    self._end_turn()
+                return self._start_task(ret)
+            if self._num_queued > 0:
+                self._num_deferred += 1
+            return None
+
+    def task_done(self, task):
+        """
+        Record that a popped task has been handled, and wake up workers that found only capped tasks.
+        :param onedrived.od_tasks.base.TaskBase task:
+        """
+        if task.journal_seq is not None:
+            task.repo.delete_journal_entry(task.journal_seq)
+            task.journal_seq = None
+        with self._lock:
+            self._running_counts[task.repo] -= 1
+            if self._running_counts[task.repo] <= 0:
+                del self._running_counts[task.repo]
+            num_deferred, self._num_deferred = self._num_deferred, 0
+        for _ in range(num_deferred):
+            self.semaphore.release()
 
     @property
     def outstanding_task_count(self):
         with self._lock:
-            return len(self.queued_tasks)
+            return self._num_queued
 
     def has_pending_task(self, local_abspath):
         with self._lock:
@@ -86,8 +224,21 @@ class TaskPool:
 
     def remove_children_tasks(self, local_parent_path):
         p = local_parent_path + '/'
+        seqs_by_repo = collections.defaultdict(list)
         with self._lock:
-            for t in self.queued_tasks[:]:
-                if t.local_abspath.startswith(p) or t.local_abspath == local_parent_path:
-                    self.queued_tasks.remove(t)
-                    del self.tasks_by_path[t.local_abspath]
+            for queue in itertools.chain((self._fast_lane,), self._queues.values()):
+                for t in list(queue):
+                    if t.local_abspath.startswith(p) or t.local_abspath == local_parent_path:
+                        queue.remove(t)
+                        self._num_queued -= 1
+                        del self.tasks_by_path[t.local_abspath]
+                        if t.journal_seq is not None:
+                            seqs_by_repo[t.repo].append(t.journal_seq)
+            for repo in self._queues:
+                if self._num_on_disk[repo] > 0 and p.startswith(repo.local_root + '/'):
+                    num_deleted = repo.delete_journal_entries_under(local_parent_path[len(repo.local_root):])
+                    self._num_on_disk[repo] -= num_deleted
+                    self._num_queued -= num_deleted
+        # The removed tasks can no longer be popped, so their entries can be deleted without holding the lock.
+        for repo, seqs in seqs_by_repo.items():
+            repo.delete_journal_entries(seqs)
@@ -0,0 +1,286 @@
+import logging
+import os
+
+import onedrivesdk.error
+from onedrivesdk.request.item_delta import ItemDeltaRequest
+
+from . import base
+from . import merge_dir
+from .. import mkdir
+from ..od_api_helper import get_item_parent_relpath, item_request_call
+from ..od_repo import ItemRecordType, RepositoryStateKey
+
+
+def get_delta_items(repo, token):
+    """
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param str token: A saved delta token, or "latest" to skip all existing items.
+    :return ([onedrivesdk.Item], str): All items changed since the token, and the token for next query.
+    """
+    client = repo.authenticator.client
+    page = item_request_call(repo, client.item(drive=repo.drive.id, id='root').delta(token=token).get)
+    items = list(page)
+    # ItemDeltaCollectionPage.next_page_link returns the delta link by mistake. Read the attribute directly.
+    while page._next_page_link:
+        logging.debug('Paging for more delta items of Drive %s.', repo.drive.id)
+        page = item_request_call(repo, ItemDeltaRequest.get_next_page_request(page, client, None).get)
+        items.extend(page)
+    return items, page.token
+
+
+def save_latest_delta_token(repo):
+    """
+    Save the token that marks current state of the Drive so that later changes can be queried.
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    """
+    try:
+        _, token = get_delta_items(repo, 'latest')
+        repo.set_state(RepositoryStateKey.DELTA_TOKEN, token)
+    except onedrivesdk.error.OneDriveError as e:
+        logging.error('Error getting delta token of Drive %s: %s.', repo.drive.id, e)
+        repo.set_state(RepositoryStateKey.DELTA_TOKEN, None)
+
+
+class ApplyDeltaTask(base.TaskBase):
+    """
+    Query the changes of a Drive since the saved delta token and merge only the items that changed, instead of
+    merging the whole Drive. Directories changed locally (e.g., while the daemon was stopped) can be merged in the
+    same pass.
+    """
+
+    # No real file uses this name, so the task has a unique slot in task pool for each Drive. A queued task absorbs
+    # later notifications because it has not fetched the delta yet.
+    TASK_NAME = '.onedrived_delta'
+
+    def __init__(self, repo, task_pool, local_changed_dirs=(), local_new_dirs=(), local_unsynced_dirs=()):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param onedrived.od_task.TaskPool task_pool:
+        :param [str] local_changed_dirs: Relative paths of local directories whose entries have changed.
+        :param [str] local_new_dirs: Relative paths of local directories which have no remote counterpart.
+        :param [str] local_unsynced_dirs: Relative paths of local directories which need a full merge with remote.
+        """
+        super().__init__(repo, task_pool)
+        self.local_abspath = repo.local_root + '/' + self.TASK_NAME
+        self.local_changed_dirs = set(local_changed_dirs)
+        self.local_new_dirs = set(local_new_dirs)
+        self.local_unsynced_dirs = set(local_unsynced_dirs)
+
+    def __repr__(self):
+        return type(self).__name__ + '(drive=%s, local_changed=%d, local_new=%d)' % (
+            self.repo.drive.id, len(self.local_changed_dirs), len(self.local_new_dirs))
+
+    def _get_item_request(self, rel_path):
+        if rel_path == '':
+            return self.repo.authenticator.client.item(drive=self.repo.drive.id, id='root')
+        return self.repo.authenticator.client.item(drive=self.repo.drive.id, path=rel_path)
+
+    def _get_merge_task(self, rel_path, deep_merge=False, local_only=False):
+        return merge_dir.MergeDirectoryTask(
+            repo=self.repo, task_pool=self.task_pool, rel_path=rel_path,
+            item_request=self._get_item_request(rel_path), deep_merge=deep_merge,
+            assume_remote_unchanged=local_only, parent_remote_unchanged=local_only)
+
+    def _fall_back_to_full_merge(self):
+        logging.info('Fall back to merging the whole Drive %s.', self.repo.drive.id)
+        save_latest_delta_token(self.repo)
+        self.task_pool.add_task(self._get_merge_task('', deep_merge=True))
+
+    def _handle_deleted_item(self, item, gone_records):
+        record = self.repo.get_item_by_id(item.id)
+        if record is None:
+            return
+        if record.type == ItemRecordType.FILE:
+            gone_records.setdefault(record.parent_path, {})[record.item_name] = record
+            return
+        # Merging the parent dir does not handle sub-dirs, so delete the local dir here.
+        item_local_abspath = self.repo.local_root + record.parent_path + '/' + record.item_name
+        if os.path.isdir(item_local_abspath):
+            logging.info('Remote dir "%s" was deleted. Delete local dir.', item_local_abspath)
+            # Records of the files are needed to cache their content.
+            merge_dir.trash_local_item(self.repo, record.parent_path, record.item_name)
+        self.repo.delete_item(record.item_name, record.parent_path, is_folder=True)
+
+    def _handle_file_item(self, item, parent_relpath, changed_files, gone_records):
+        record = self.repo.get_item_by_id(item.id)
+        if record is not None and (record.parent_path, record.item_name) != (parent_relpath, item.name) and \
+                not merge_dir.move_local_item(self.repo, record, parent_relpath, item.name):
+            # The file was moved or renamed remotely but the local file can't follow. It's gone from its old path.
+            gone_records.setdefault(record.parent_path, {})[record.item_name] = record
+        changed_files.setdefault(parent_relpath, []).append(item)
+
+    def _handle_folder_item(self, item, parent_relpath, dirs_to_deep_merge):
+        item_relpath = parent_relpath + '/' + item.name
+        item_local_abspath = self.repo.local_root + item_relpath
+        record = self.repo.get_item_by_id(item.id)
+        if record is not None and (record.parent_path, record.item_name) != (parent_relpath, item.name):
+            if not merge_dir.move_local_item(self.repo, record, parent_relpath, item.name):
+                # The folder was moved or renamed remotely but the local dir can't follow. Merge both parents.
+                dirs_to_deep_merge.update((record.parent_path, parent_relpath))
+                return
+            old_relpath = record.parent_path + '/' + record.item_name
+            for dirs in (self.local_changed_dirs, self.local_new_dirs, dirs_to_deep_merge):
+                self._remap_dirs(dirs, old_relpath, item_relpath)
+        if not os.path.exists(item_local_abspath):
+            if not os.path.isdir(self.repo.local_root + parent_relpath):
+                # The parent was not created locally. Let a merge of the closest local ancestor sort it out.
+                dirs_to_deep_merge.add(self._get_local_ancestor(parent_relpath))
+                return
+            logging.debug('Create directory "%s" added remotely.', item_local_abspath)
+            mkdir(item_local_abspath, uid=self.repo.context.user_uid, exist_ok=True)
+        elif not os.path.isdir(item_local_abspath):
+            dirs_to_deep_merge.add(parent_relpath)
+            return
+        elif record is None:
+            # The local dir was not synced before and may contain local-only items.
+            self.local_changed_dirs.add(item_relpath)
+        self.repo.update_item(item, parent_relpath, 0)
+        self.local_new_dirs.discard(item_relpath)
+
+    @staticmethod
+    def _remap_dirs(dirs, old_relpath, new_relpath):
+        """
+        Update paths in a set of directories after a directory was moved.
+        :param set(str) dirs:
+        :param str old_relpath:
+        :param str new_relpath:
+        """
+        for rel_path in [p for p in dirs if p == old_relpath or p.startswith(old_relpath + '/')]:
+            dirs.remove(rel_path)
+            dirs.add(new_relpath + rel_path[len(old_relpath):])
+
+    def _get_local_ancestor(self, rel_path):
+        while rel_path != '' and not os.path.isdir(self.repo.local_root + rel_path):
+            rel_path = rel_path.rsplit('/', maxsplit=1)[0]
+        return rel_path
+
+    @staticmethod
+    def _is_covered(rel_path, dirs_to_deep_merge):
+        return any(rel_path == p or rel_path.startswith(p + '/') for p in dirs_to_deep_merge)
+
+    def _get_parent_relpath(self, item, relpaths_by_id):
+        """
+        Delta API may leave out the path of the parent of an item, so look the parent up by ID among folders of the
+        same delta, and then among records.
+        :param onedrivesdk.Item item:
+        :param dict(str, str) relpaths_by_id: Relative paths of folders seen earlier in the delta, keyed by ID.
+        :return str | None: None if the parent is unknown.
+        """
+        parent_relpath = get_item_parent_relpath(item)
+        if parent_relpath is not None or item.parent_reference is None:
+            return parent_relpath
+        parent_id = item.parent_reference.id
+        if parent_id in relpaths_by_id:
+            return relpaths_by_id[parent_id]
+        record = self.repo.get_item_by_id(parent_id)
+        if record is not None and record.type == ItemRecordType.FOLDER:
+            return record.parent_path + '/' + record.item_name
+        return None
+
+    def _apply(self, items, dirs_to_deep_merge):
+        """
+        Apply remote folder changes to local repository and collect remote file changes by directory. Folders are
+        handled first so that files have their parents, and files moved along with their folders are in place.
+        :param [onedrivesdk.Item] items:
+        :param set(str) dirs_to_deep_merge: Collects directories whose changes can't be resolved from delta items.
+        :return (dict(str, [onedrivesdk.Item]), dict(str, dict(str, onedrived.od_repo.ItemRecord))):
+            Changed remote files and records of remote files that are gone, both keyed by parent directory.
+        """
+        changed_files = {}
+        gone_records = {}
+        folder_items = []
+        file_items = []
+        relpaths_by_id = {}
+        for item in items:
+            if item.deleted is not None:
+                self._handle_deleted_item(item, gone_records)
+                continue
+            if 'root' in item._prop_dict:
+                relpaths_by_id[item.id] = ''
+                continue
+            parent_relpath = self._get_parent_relpath(item, relpaths_by_id)
+            if parent_relpath is None:
+                logging.warning('Parent of remote item "%s" (%s) is unknown. Merge the whole Drive %s.',
+                                item.name, item.id, self.repo.drive.id)
+                dirs_to_deep_merge.add('')
+                continue
+            is_folder = item.folder is not None
+            if is_folder:
+                relpaths_by_id[item.id] = parent_relpath + '/' + item.name
+            if self.repo.path_filter.should_ignore(parent_relpath + '/' + item.name, is_folder):
+                continue
+            if is_folder:
+                folder_items.append((parent_relpath, item))
+            elif item.file is not None:
+                file_items.append((parent_relpath, item))
+
+        folder_items.sort(key=lambda t: t[0].count('/'))
+        for parent_relpath, item in folder_items:
+            try:
+                self._handle_folder_item(item, parent_relpath, dirs_to_deep_merge)
+            except OSError as e:
+                logging.error('Error handling remote dir "%s/%s": %s.', parent_relpath, item.name, e)
+                dirs_to_deep_merge.add(parent_relpath)
+        for parent_relpath, item in file_items:
+            self._handle_file_item(item, parent_relpath, changed_files, gone_records)
+        return changed_files, gone_records
+
+    def _queue_remote_changes(self, rel_path, remote_items, gone_records):
+        """
+        Queue a task to merge remote changes under a directory. If a task on the directory is already queued, hand
+        the changes over to it.
+        """
+        task = merge_dir.MergeRemoteChangesTask(
+            self.repo, self.task_pool, rel_path, self._get_item_request(rel_path), remote_items, gone_records)
+        while not self.task_pool.add_task(task):
+            pending_task = self.task_pool.has_pending_task(task.local_abspath)
+            if isinstance(pending_task, merge_dir.MergeDirectoryTask):
+                if pending_task.absorb_remote_changes(remote_items, gone_records):
+                    return
+            elif pending_task:
+                logging.info('Remote changes under "%s" are left to %s.', task.local_abspath, pending_task)
+                return
+
+    def _schedule_tasks(self, dirs_to_deep_merge, changed_files, gone_records):
+        remote_changed_dirs = set(changed_files) | set(gone_records)
+        for rel_path in sorted(dirs_to_deep_merge):
+            if not any(rel_path.startswith(p + '/') for p in dirs_to_deep_merge):
+                self.task_pool.add_task(self._get_merge_task(rel_path, deep_merge=True))
+        for rel_path in sorted(self.local_changed_dirs):
+            if not self._is_covered(rel_path, dirs_to_deep_merge):
+                # If the dir changed on both sides, list the remote dir too.
+                self.task_pool.add_task(
+                    self._get_merge_task(rel_path, local_only=rel_path not in remote_changed_dirs))
+        for rel_path in sorted(remote_changed_dirs - self.local_changed_dirs):
+            if not self._is_covered(rel_path, dirs_to_deep_merge):
+                if os.path.isdir(self.repo.local_root + rel_path):
+                    self._queue_remote_changes(
+                        rel_path, changed_files.get(rel_path, ()), gone_records.get(rel_path, {}))
+                else:
+                    self.task_pool.add_task(self._get_merge_task(self._get_local_ancestor(rel_path), deep_merge=True))
+        for rel_path in sorted(self.local_new_dirs):
+            if not self._is_covered(rel_path, dirs_to_deep_merge):
+                parent_relpath, item_name = rel_path.rsplit('/', maxsplit=1)
+                self.task_pool.add_task(merge_dir.CreateFolderTask(
+                    self.repo, self.task_pool, item_name, parent_relpath, upload_if_success=True))
+
+    def handle(self):
+        # Delta tasks of the same Drive share the token, so they must not run at the same time.
+        with self.repo.delta_lock:
+            token = self.repo.get_state(RepositoryStateKey.DELTA_TOKEN)
+            if token is None:
+                logging.info('No delta token is saved for Drive %s.', self.repo.drive.id)
+                return self._fall_back_to_full_merge()
+
+            logging.info('Fetching changes of Drive %s since last delta token.', self.repo.drive.id)
+            try:
+                items, new_token = get_delta_items(self.repo, token)
+            except onedrivesdk.error.OneDriveError as e:
+                logging.error('Error fetching delta of Drive %s: %s.', self.repo.drive.id, e)
+                return self._fall_back_to_full_merge()
+
+            logging.info('Delta of Drive %s has %d items.', self.repo.drive.id, len(items))
+            dirs_to_deep_merge = set(self.local_unsynced_dirs)
+            changed_files, gone_records = self._apply(items, dirs_to_deep_merge)
+            self._schedule_tasks(dirs_to_deep_merge, changed_files, gone_records)
+            self.repo.set_state(RepositoryStateKey.DELTA_TOKEN, new_token)
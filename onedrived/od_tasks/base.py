@@ -7,6 +7,11 @@ class TaskBase:
         """
         self.repo = repo
         self.task_pool = task_pool
+        # Sequence number of the task in task journal of the repository, if recorded.
+        self.journal_seq = None
+        # Whether or not the task syncs a change just made locally. Interactive tasks go before others and run in the
+        # normal I/O class, while others run in the background classes (see onedrived.od_iosched).
+        self.interactive = False
 
     @property
     def local_abspath(self):
@@ -24,6 +24,13 @@ class DeleteRemoteItemTask(update_item_base.UpdateItemTaskBase):
         return type(self).__name__ + '(%s, is_folder=%s)' % (self.local_abspath, self.is_folder)
 
     def handle(self):
+        if self.item_id is not None:
+            record = self.repo.get_item_by_id(self.item_id)
+            if record is not None and (record.parent_path, record.item_name) != (self.parent_relpath, self.item_name):
+                # E.g., the local item was found moved after this task was queued, and so was the remote item.
+                logging.info('Item %s was moved to "%s/%s". Skip deleting it.',
+                             self.item_id, record.parent_path, record.item_name)
+                return True
         logging.info('Deleting remote item "%s".', self.rel_path)
         item_request = self.get_item_request()
         try:
@@ -31,6 +38,14 @@ class DeleteRemoteItemTask(update_item_base.UpdateItemTaskBase):
             self.repo.delete_item(self.item_name, self.parent_relpath, self.is_folder)
             logging.info('Deleted remote item "%s".', self.rel_path)
             return True
-        except (onedrivesdk.error.OneDriveError, OSError) as e:
+        except onedrivesdk.error.OneDriveError as e:
+            if e.code != onedrivesdk.error.ErrorCode.ItemNotFound:
+                logging.error('Error deleting item "%s": %s.', self.rel_path, e)
+                return False
+            # The remote item is already gone, which is what we want.
+            logging.info('Remote item "%s" no longer exists. Delete its record.', self.rel_path)
+            self.repo.delete_item(self.item_name, self.parent_relpath, self.is_folder)
+            return True
+        except OSError as e:
             logging.error('Error deleting item "%s": %s.', self.rel_path, e)
             return False
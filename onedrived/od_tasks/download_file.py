@@ -5,39 +5,147 @@ import onedrivesdk.error
 
 from . import base
 from .. import fix_owner_and_timestamp
-from ..od_api_helper import get_item_modified_datetime
+from ..od_api_helper import get_item_modified_datetime, get_item_parent_relpath
 from ..od_api_helper import item_request_call
 from ..od_dateutils import datetime_to_timestamp
+from ..od_fileutils import clone_file
 from ..od_hashutils import sha1_value
 
 
 class DownloadFileTask(base.TaskBase):
 
-    def __init__(self, repo, task_pool, remote_item, parent_relpath):
+    def __init__(self, repo, task_pool, remote_item, parent_relpath, has_full_metadata=True):
         """
         :param onedrived.od_repo.OneDriveLocalRepository repo:
         :param onedrived.od_task.TaskPool task_pool:
         :param onedrivesdk.model.item.Item remote_item:
         :param str parent_relpath:
+        :param True | False has_full_metadata: If False, remote_item only has ID and name, and full metadata will be
+            fetched before downloading.
         """
         super().__init__(repo, task_pool)
         self.remote_item = remote_item
         self.parent_relpath = parent_relpath
         self.local_abspath = repo.local_root + parent_relpath + '/' + remote_item.name
+        self.has_full_metadata = has_full_metadata
 
     def __repr__(self):
         return type(self).__name__ + '(%s)' % self.local_abspath
 
+    def _fetch_metadata(self):
+        """
+        :return True | False: Whether or not the item is still a file at the same path.
+        """
+        item_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, id=self.remote_item.id)
+        try:
+            item = item_request_call(self.repo, item_request.get)
+        except onedrivesdk.error.OneDriveError as e:
+            if e.code != onedrivesdk.error.ErrorCode.ItemNotFound:
+                raise
+            item = None
+        if item is None or item.file is None or item.name != self.remote_item.name or \
+                get_item_parent_relpath(item) != self.parent_relpath:
+            # Later delta queries or merges will sync the item at its new path.
+            logging.info('Remote item "%s" is no longer a file at "%s". Skip downloading.',
+                         self.remote_item.id, self.local_abspath)
+            return False
+        self.remote_item = item
+        self.has_full_metadata = True
+        return True
+
+    def _find_local_duplicate(self, sha1_hash):
+        """
+        Find a local file that has the content of the remote item, in this Drive or another Drive being synced.
+        :param str sha1_hash:
+        :return str | None: Absolute path of the local file.
+        """
+        repos = [self.repo] + [r for r in self.repo.context.repositories if r is not self.repo]
+        for repo in repos:
+            for path in repo.find_unchanged_files(sha1_hash, self.remote_item.size):
+                if path != self.local_abspath:
+                    return path
+        return None
+
+    def _copy_local_duplicate(self, sha1_hash, tmp_path):
+        """
+        :param str sha1_hash:
+        :param str tmp_path:
+        :return True | False: Whether or not the content was copied from a local file to tmp_path.
+        """
+        src_path = self._find_local_duplicate(sha1_hash)
+        if src_path is None:
+            return False
+        try:
+            method = clone_file(src_path, tmp_path)
+            if sha1_value(tmp_path) == sha1_hash:
+                logging.info('Copied file "%s" from local file "%s" by %s.', self.local_abspath, src_path, method)
+                return True
+            logging.warning('Local file "%s" has changed. Download file "%s" instead.', src_path, self.local_abspath)
+        except OSError as e:
+            logging.error('Error copying local file "%s": %s. Download file "%s" instead.',
+                          src_path, e, self.local_abspath)
+        return False
+
+    def _copy_cached_content(self, sha1_hash, tmp_path):
+        """
+        :param str sha1_hash:
+        :param str tmp_path:
+        :return True | False: Whether or not the content was copied from content cache to tmp_path.
+        """
+        cache = self.repo.context.content_cache
+        if cache is None:
+            return False
+        try:
+            method = cache.copy_file(sha1_hash, tmp_path)
+            if method is None:
+                return False
+            if sha1_value(tmp_path) == sha1_hash:
+                logging.info('Restored file "%s" from content cache by %s.', self.local_abspath, method)
+                return True
+            logging.warning('Cached content of file "%s" is corrupt. Download it instead.', self.local_abspath)
+            cache.remove(sha1_hash)
+        except OSError as e:
+            logging.error('Error copying cached content of file "%s": %s. Download it instead.', self.local_abspath, e)
+        return False
+
+    def _fetch_from_peers(self, sha1_hash, tmp_path):
+        """
+        :param str sha1_hash:
+        :param str tmp_path:
+        :return True | False: Whether or not the content was fetched from a LAN sync peer to tmp_path.
+        """
+        lan_sync = self.repo.context.lan_sync
+        if lan_sync is None:
+            return False
+        peer = lan_sync.fetch_file(sha1_hash, self.remote_item.size, tmp_path)
+        if peer is None:
+            return False
+        if sha1_value(tmp_path) == sha1_hash:
+            logging.info('Fetched file "%s" from LAN peer %s:%d.', self.local_abspath, peer[0], peer[1])
+            return True
+        logging.warning('File "%s" fetched from LAN peer %s:%d has wrong hash. Download it instead.',
+                        self.local_abspath, peer[0], peer[1])
+        return False
+
     def handle(self):
         logging.info('Downloading file "%s" to "%s".', self.remote_item.id, self.local_abspath)
         try:
+            if not self.has_full_metadata and not self._fetch_metadata():
+                return True
             tmp_name = self.repo.path_filter.get_temp_name(self.remote_item.name)
             tmp_path = self.repo.local_root + self.parent_relpath + '/' + tmp_name
             item_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, id=self.remote_item.id)
             item_mtime, item_mtime_editable = get_item_modified_datetime(self.remote_item)
-            item_request_call(self.repo, item_request.download, tmp_path)
             hashes = self.remote_item.file.hashes
-            if hashes is None or hashes.sha1_hash is None or hashes.sha1_hash == sha1_value(tmp_path):
+            sha1_hash = hashes.sha1_hash if hashes is not None else None
+            if sha1_hash is not None and (self._copy_local_duplicate(sha1_hash, tmp_path) or
+                                          self._copy_cached_content(sha1_hash, tmp_path) or
+                                          self._fetch_from_peers(sha1_hash, tmp_path)):
+                verified = True
+            else:
+                item_request_call(self.repo, item_request.download, tmp_path)
+                verified = sha1_hash is None or sha1_hash == sha1_value(tmp_path)
+            if verified:
                 item_size_local = os.path.getsize(tmp_path)
                 os.rename(tmp_path, self.local_abspath)
                 fix_owner_and_timestamp(self.local_abspath, self.repo.context.user_uid,
@@ -0,0 +1,101 @@
+"""
+journal.py
+
+Encode queued tasks to compact task journal entries and restore tasks from them. Tasks which are not encoded here
+(e.g., delta queries and subscription updates) are created again when the daemon starts.
+"""
+
+import json
+import logging
+
+import onedrivesdk
+
+from . import delete_item, download_file, merge_dir, move_item, rescan_dir, update_mtime, upload_file, upload_tree
+
+
+def _get_item_request(repo, rel_path):
+    if rel_path == '':
+        return repo.authenticator.client.item(drive=repo.drive.id, id='root')
+    return repo.authenticator.client.item(drive=repo.drive.id, path=rel_path)
+
+
+def _split_path(rel_path):
+    return rel_path.rsplit('/', maxsplit=1)
+
+
+def _describe(task_type, rel_path, item_id=None, etag=None, args=None):
+    return task_type, rel_path, item_id, etag, json.dumps(args, sort_keys=True) if args else None
+
+
+def get_descriptor(task):
+    """
+    :param onedrived.od_tasks.base.TaskBase task:
+    :return (str, str, str | None, str | None, str | None) | None: Task type, relative path, item ID, eTag and other
+        arguments (in JSON) of the task. None if the task is not journaled.
+    """
+    task_type = type(task)
+    if task_type is download_file.DownloadFileTask:
+        item = task.remote_item
+        return _describe('download', task.parent_relpath + '/' + item.name, item.id, item.e_tag)
+    if task_type is upload_file.UploadFileTask:
+        return _describe('upload', task.rel_path)
+    if task_type is update_mtime.UpdateTimestampTask:
+        return _describe('update_mtime', task.rel_path, task.item_id, args={'is_folder': task.is_folder})
+    if task_type is delete_item.DeleteRemoteItemTask:
+        return _describe('delete', task.rel_path, task.item_id, args={'is_folder': task.is_folder})
+    if task_type is move_item.MoveItemTask:
+        return _describe('move', task.rel_path, task.item_id, args={
+            'is_folder': task.is_folder, 'new_parent_relpath': task.new_parent_relpath, 'new_name': task.new_name})
+    if task_type is upload_tree.UploadTreeTask:
+        return _describe('upload_tree', task.rel_path)
+    if task_type is rescan_dir.RescanLocalDirTask:
+        return _describe('rescan_dir', task.rel_path)
+    if task_type is merge_dir.CreateFolderTask:
+        return _describe('create_folder', task.parent_relpath + '/' + task.item_name, args={
+            'upload_if_success': task.upload_if_success, 'abort_if_local_gone': task.abort_if_local_gone})
+    if task_type is merge_dir.MergeDirectoryTask or task_type is merge_dir.MergeRemoteChangesTask:
+        # A queued merge task may absorb remote changes after it is recorded, and remote items are too large to
+        # record. A replayed merge lists the remote dir to find the same changes.
+        args = {'deep_merge': task.deep_merge}
+        if not task.allow_prune:
+            args['allow_prune'] = False
+        return _describe('merge_dir', task.rel_path, args=args)
+    return None
+
+
+def create_task(repo, task_pool, entry):
+    """
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param onedrived.od_task.TaskPool task_pool:
+    :param onedrived.od_repo.TaskJournalEntry entry:
+    :return onedrived.od_tasks.base.TaskBase | None: None if the entry is not valid.
+    """
+    try:
+        args = json.loads(entry.args) if entry.args else {}
+        if entry.task_type == 'merge_dir':
+            return merge_dir.MergeDirectoryTask(repo, task_pool, entry.rel_path,
+                                                _get_item_request(repo, entry.rel_path), **args)
+        if entry.task_type == 'rescan_dir':
+            return rescan_dir.RescanLocalDirTask(repo, task_pool, entry.rel_path)
+        parent_relpath, item_name = _split_path(entry.rel_path)
+        if entry.task_type == 'download':
+            # Only ID, name and eTag are recorded. The task fetches full metadata before downloading.
+            item = onedrivesdk.Item({'id': entry.item_id, 'name': item_name, 'eTag': entry.etag})
+            return download_file.DownloadFileTask(repo, task_pool, item, parent_relpath, has_full_metadata=False)
+        if entry.task_type == 'upload':
+            return upload_file.UploadFileTask(repo, task_pool, _get_item_request(repo, parent_relpath),
+                                              parent_relpath, item_name)
+        if entry.task_type == 'update_mtime':
+            return update_mtime.UpdateTimestampTask(repo, task_pool, parent_relpath, item_name, entry.item_id, **args)
+        if entry.task_type == 'delete':
+            return delete_item.DeleteRemoteItemTask(repo, task_pool, parent_relpath, item_name, entry.item_id, **args)
+        if entry.task_type == 'move':
+            return move_item.MoveItemTask(repo, task_pool, parent_relpath, item_name, item_id=entry.item_id, **args)
+        if entry.task_type == 'upload_tree':
+            return upload_tree.UploadTreeTask(repo, task_pool, item_name, parent_relpath)
+        if entry.task_type == 'create_folder':
+            return merge_dir.CreateFolderTask(repo, task_pool, item_name, parent_relpath, **args)
+        raise ValueError('Unknown task type "%s".' % entry.task_type)
+    except (TypeError, ValueError) as e:
+        logging.error('Invalid task journal entry %s: %s.', entry, e)
+        return None
@@ -0,0 +1,77 @@
+import logging
+import os
+
+from ..od_dateutils import datetime_to_timestamp, diff_timestamps
+from ..od_repo import ItemRecordType
+
+
+def is_dir_changed(repo, rel_path, files):
+    """
+    Editing a file in place does not change the mtime of its directory, so compare files with their records.
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param str rel_path:
+    :param [os.DirEntry] files:
+    :return True | False:
+    """
+    records = repo.get_immediate_children_of_dir(rel_path)
+    for entry in files:
+        if repo.path_filter.should_ignore(rel_path + '/' + entry.name, False):
+            continue
+        record = records.get(entry.name)
+        if record is None or record.type != ItemRecordType.FILE:
+            return True
+        stat = entry.stat()
+        if stat.st_size != record.size_local or \
+                diff_timestamps(stat.st_mtime, datetime_to_timestamp(record.modified_time)) != 0:
+            return True
+    return False
+
+
+def scan_local_dirs(repo, rel_path=''):
+    """
+    Walk local directories under a path, watch them and compare them with snapshots and records taken at last merge.
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param str rel_path: Relative path of the directory to start from. It must have a record unless it is the root.
+    :return ([str], [str], [str]): Relative paths of directories changed locally, directories whose last merge did
+        not finish, and new directories. New directories are not descended into.
+    """
+    watcher = repo.context.watcher
+    snapshots = repo.get_dir_snapshots()
+    changed_dirs = []
+    unsynced_dirs = []
+    new_dirs = []
+    visited = set()
+    dirs_to_scan = [(rel_path, os.stat(repo.local_root + rel_path))]
+    while len(dirs_to_scan) > 0:
+        rel_path, stat = dirs_to_scan.pop()
+        if (stat.st_dev, stat.st_ino) in visited:
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+        snapshot = snapshots.get(rel_path)
+        if snapshot is None and rel_path != '':
+            parent_relpath, item_name = rel_path.rsplit('/', maxsplit=1)
+            if repo.get_item_by_path(item_name, parent_relpath) is None:
+                new_dirs.append(rel_path)
+                continue
+        local_abspath = repo.local_root + rel_path
+        if watcher is not None:
+            watcher.add_watch(repo, local_abspath)
+        files = []
+        try:
+            with os.scandir(local_abspath) as it:
+                for entry in it:
+                    child_relpath = rel_path + '/' + entry.name
+                    if entry.is_dir():
+                        if not repo.path_filter.should_ignore(child_relpath, True):
+                            dirs_to_scan.append((child_relpath, entry.stat()))
+                    elif entry.is_file() and not repo.path_filter.is_temp_name(entry.name):
+                        files.append(entry)
+            if snapshot is None:
+                # The directory was never fully merged, possibly because of an error.
+                unsynced_dirs.append(rel_path)
+            elif snapshot != stat.st_mtime_ns or is_dir_changed(repo, rel_path, files):
+                changed_dirs.append(rel_path)
+        except OSError as e:
+            logging.error('Error scanning local dir "%s": %s.', local_abspath, e)
+            unsynced_dirs.append(rel_path)
+    return changed_dirs, unsynced_dirs, new_dirs
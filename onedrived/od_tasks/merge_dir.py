@@ -1,19 +1,22 @@
+import collections
 import itertools
 import logging
 import os
 import shutil
+import stat
+import threading
 
 import onedrivesdk.error
 from onedrivesdk import Item, Folder, ChildrenCollectionRequest
 from send2trash import send2trash
 
 from . import base
-from . import delete_item, download_file, upload_file
+from . import delete_item, download_file, local_scan, move_item, upload_file
 from .. import mkdir, fix_owner_and_timestamp
-from ..od_api_helper import get_item_modified_datetime, item_request_call
+from ..od_api_helper import get_item_modified_datetime, get_item_parent_relpath, item_request_call
 from ..od_dateutils import datetime_to_timestamp, diff_timestamps
-from ..od_hashutils import hash_match, sha1_value
-from ..od_repo import ItemRecordType
+from ..od_hashutils import hash_match, quick_fingerprint, sha1_value
+from ..od_repo import ItemRecordType, RepositoryType
 
 
 def rename_with_suffix(parent_abspath, name, host_name):
@@ -40,6 +43,130 @@ def rename_with_suffix(parent_abspath, name, host_name):
     return new_name
 
 
+def move_local_item(repo, record, new_parent_relpath, new_name):
+    """
+    Move a local item along with its remote item, which was moved or renamed after the record was created. Nothing is
+    done if the local item is not the one on record or the new path is taken.
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param onedrived.od_repo.ItemRecord record:
+    :param str new_parent_relpath:
+    :param str new_name:
+    :return True | False: Whether or not the local item and its record were moved.
+    """
+    is_folder = record.type == ItemRecordType.FOLDER
+    old_parent_abspath = repo.local_root + record.parent_path
+    new_parent_abspath = repo.local_root + new_parent_relpath
+    old_abspath = old_parent_abspath + '/' + record.item_name
+    new_abspath = new_parent_abspath + '/' + new_name
+    if repo.path_filter.should_ignore(new_parent_relpath + '/' + new_name, is_folder):
+        return False
+    watcher = repo.context.watcher
+    try:
+        item_stat = os.lstat(old_abspath)
+        if is_folder:
+            if not stat.S_ISDIR(item_stat.st_mode):
+                return False
+        elif not stat.S_ISREG(item_stat.st_mode) or item_stat.st_size != record.size_local or \
+                diff_timestamps(item_stat.st_mtime, datetime_to_timestamp(record.modified_time)) != 0:
+            return False
+        if os.path.lexists(new_abspath) or not os.path.isdir(new_parent_abspath):
+            return False
+        # The move is not a local change to sync.
+        unwatched_dirs = [d for d in {old_parent_abspath, new_parent_abspath} if watcher.rm_watch(repo, d)]
+        try:
+            os.rename(old_abspath, new_abspath)
+        finally:
+            for d in unwatched_dirs:
+                watcher.add_watch(repo, d)
+    except OSError as e:
+        logging.error('Error moving local item "%s" to "%s": %s.', old_abspath, new_abspath, e)
+        return False
+    logging.info('Remote item %s was moved. Move local item "%s" to "%s".', record.item_id, old_abspath, new_abspath)
+    repo.move_item(record.item_name, record.parent_path, new_name, new_parent_relpath, is_folder=is_folder)
+    if is_folder:
+        # Inotify keeps watching the moved dir. Adding it again relinks the watches under it to the new path.
+        watcher.add_watch(repo, new_abspath)
+    return True
+
+
+def _cache_file_content(repo, record, path):
+    """
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param onedrived.od_repo.ItemRecord | None record:
+    :param str path:
+    """
+    if record is None or record.type != ItemRecordType.FILE or not record.sha1_hash:
+        return
+    try:
+        item_stat = os.lstat(path)
+        # Only the content on record is known to have the recorded hash.
+        if stat.S_ISREG(item_stat.st_mode) and item_stat.st_size == record.size_local and \
+                diff_timestamps(item_stat.st_mtime, datetime_to_timestamp(record.modified_time)) == 0:
+            repo.context.content_cache.add_file(path, record.sha1_hash)
+    except OSError as e:
+        logging.error('Error caching content of file "%s": %s.', path, e)
+
+
+def trash_local_item(repo, parent_relpath, item_name):
+    """
+    Send a local item to trash. If content cache is enabled, files under it that are unchanged since last sync are kept
+    in the cache first so that they need not be downloaded again if the remote items are restored.
+    :param onedrived.od_repo.OneDriveLocalRepository repo:
+    :param str parent_relpath:
+    :param str item_name:
+    """
+    rel_path = parent_relpath + '/' + item_name
+    item_local_abspath = repo.local_root + rel_path
+    if repo.context.content_cache is not None:
+        if os.path.isdir(item_local_abspath) and not os.path.islink(item_local_abspath):
+            for dir_abspath, _, file_names in os.walk(item_local_abspath):
+                records = repo.get_immediate_children_of_dir(rel_path + dir_abspath[len(item_local_abspath):])
+                for name in file_names:
+                    _cache_file_content(repo, records.get(name), dir_abspath + '/' + name)
+        else:
+            _cache_file_content(repo, repo.get_item_by_path(item_name, parent_relpath), item_local_abspath)
+    send2trash(item_local_abspath)
+
+
+def list_local_names(local_abspath):
+    """
+    List all names under a local directory.
+    Try resolving naming conflict (same name case-INsensitive) as it goes.
+    :param str local_abspath:
+    :return [str]: A list of entry names.
+    """
+    # TODO: This logic can be improved if remote info is provided.
+    ents_orig = os.listdir(local_abspath)
+    ents_lower = [s.lower() for s in ents_orig]
+    ents_lower_uniq = set(ents_lower)
+    if len(ents_orig) == len(ents_lower_uniq):
+        return set(ents_orig)
+    ents_ret = set()
+    ents_ret_lower = set()
+    for ent, ent_lower in zip(ents_orig, ents_lower):
+        ent_abspath = local_abspath + '/' + ent
+        if ent_lower in ents_ret_lower:
+            ent_name, ent_ext = os.path.splitext(ent)
+            count = 1
+            new_ent = ent_name + ' ' + str(count) + ent_ext
+            new_ent_lower = new_ent.lower()
+            while new_ent_lower in ents_ret_lower or new_ent_lower in ents_lower_uniq:
+                count += 1
+                new_ent = ent_name + ' ' + str(count) + ent_ext
+                new_ent_lower = new_ent.lower()
+            try:
+                shutil.move(ent_abspath, local_abspath + '/' + new_ent)
+                ents_ret.add(new_ent)
+                ents_ret_lower.add(new_ent_lower)
+            except (IOError, OSError) as e:
+                logging.error('Error occurred when solving name conflict of "%s": %s.', ent_abspath, e)
+                continue
+        else:
+            ents_ret.add(ent)
+            ents_ret_lower.add(ent_lower)
+    return ents_ret
+
+
 def get_os_stat(path):
     try:
         return os.stat(path)
@@ -50,7 +177,7 @@ def get_os_stat(path):
 class MergeDirectoryTask(base.TaskBase):
 
     def __init__(self, repo, task_pool, rel_path, item_request, deep_merge=True,
-                 assume_remote_unchanged=False, parent_remote_unchanged=False):
+                 assume_remote_unchanged=False, parent_remote_unchanged=False, allow_prune=True):
         """
         :param onedrived.od_repo.OneDriveLocalRepository repo:
         :param onedrived.od_task.TaskPool task_pool:
@@ -60,6 +187,8 @@ class MergeDirectoryTask(base.TaskBase):
         :param True | False assume_remote_unchanged: If True, assume there is no change in remote repository.
             Can be set True if ctag and etag of the folder Item match its database record.
         :param True | False parent_remote_unchanged: If parent remote dir item wasn't changed.
+        :param True | False allow_prune: If False, sub-directories are never pruned, e.g., in a recovery merge, because
+            tags and snapshots of the subtree may have been saved before work under them was done.
         """
         super().__init__(repo, task_pool)
         self.rel_path = rel_path
@@ -68,6 +197,11 @@ class MergeDirectoryTask(base.TaskBase):
         self.deep_merge = deep_merge
         self.assume_remote_unchanged = assume_remote_unchanged
         self.parent_remote_unchanged = parent_remote_unchanged
+        self.allow_prune = allow_prune
+        self._started = False
+        self._started_lock = threading.Lock()
+        # SHA-1 values of local files being computed by the hash service, by path.
+        self._sha1_futures = dict()
 
     def __repr__(self):
         return type(self).__name__ + '(%s, deep=%s, remote_unchanged=%s, parent_remote_unchanged=%s)' % (
@@ -79,49 +213,118 @@ class MergeDirectoryTask(base.TaskBase):
         Try resolving naming conflict (same name case-INsensitive) as it goes.
         :return [str]: A list of entry names.
         """
-        # TODO: This logic can be improved if remote info is provided.
-        ents_orig = os.listdir(self.local_abspath)
-        ents_lower = [s.lower() for s in ents_orig]
-        ents_lower_uniq = set(ents_lower)
-        if len(ents_orig) == len(ents_lower_uniq):
-            return set(ents_orig)
-        ents_ret = set()
-        ents_ret_lower = set()
-        for ent, ent_lower in zip(ents_orig, ents_lower):
-            ent_abspath = self.local_abspath + '/' + ent
-            if ent_lower in ents_ret_lower:
-                ent_name, ent_ext = os.path.splitext(ent)
-                count = 1
-                new_ent = ent_name + ' ' + str(count) + ent_ext
-                new_ent_lower = new_ent.lower()
-                while new_ent_lower in ents_ret_lower or new_ent_lower in ents_lower_uniq:
-                    count += 1
-                    new_ent = ent_name + ' ' + str(count) + ent_ext
-                    new_ent_lower = new_ent.lower()
-                try:
-                    shutil.move(ent_abspath, self.local_abspath + '/' + new_ent)
-                    ents_ret.add(new_ent)
-                    ents_ret_lower.add(new_ent_lower)
-                except (IOError, OSError) as e:
-                    logging.error('Error occurred when solving name conflict of "%s": %s.', ent_abspath, e)
-                    continue
-            else:
-                ents_ret.add(ent)
-                ents_ret_lower.add(ent_lower)
-        return ents_ret
+        return list_local_names(self.local_abspath)
+
+    def absorb_remote_changes(self, remote_items, gone_records):
+        """
+        Let this queued task also merge remote changes of items under the directory, which it does by listing the
+        remote directory. Fail if the task has started.
+        :param [onedrivesdk.model.item.Item] remote_items:
+        :param dict(str, onedrived.od_repo.ItemRecord) gone_records:
+        :return True | False:
+        """
+        with self._started_lock:
+            if self._started:
+                return False
+            self.assume_remote_unchanged = False
+            return True
+
+    def _mark_started(self):
+        with self._started_lock:
+            self._started = True
+
+    def _prefetch_sha1_values(self, remote_items, all_records):
+        """
+        Start hashing the local files whose size matches their remote item or record but whose mtime does not. The
+        merge compares hashes of such files, and this way they are hashed in parallel instead of one by one.
+        :param [onedrivesdk.model.item.Item] remote_items:
+        :param dict(str, onedrived.od_repo.ItemRecord) all_records:
+        """
+        hash_service = self.repo.context.hash_service
+        if hash_service is None or self.interactive:
+            # Hashing threads are background threads, so a merge of a local change hashes on its own thread.
+            return
+        known_attrs = collections.defaultdict(list)
+        for remote_item in remote_items:
+            if remote_item.folder is None:
+                known_attrs[remote_item.name].append(
+                    (remote_item.size, datetime_to_timestamp(get_item_modified_datetime(remote_item)[0]),
+                     self._get_remote_sha1_hash(remote_item)))
+        for name, record in all_records.items():
+            if record.type == ItemRecordType.FILE:
+                known_attrs[name].append(
+                    (record.size_local, datetime_to_timestamp(record.modified_time), record.sha1_hash))
+        paths = []
+        for name, attrs in known_attrs.items():
+            path = self.local_abspath + '/' + name
+            try:
+                item_stat = os.lstat(path)
+                if stat.S_ISREG(item_stat.st_mode) and any(
+                        item_stat.st_size == size and diff_timestamps(item_stat.st_mtime, mtime) != 0 and
+                        not self._fingerprint_differs(path, sha1_hash, all_records.get(name))
+                        for size, mtime, sha1_hash in attrs):
+                    paths.append(path)
+            except OSError:
+                continue
+        if len(paths) > 0:
+            logging.debug('Hash %d files under "%s" in parallel.', len(paths), self.local_abspath)
+            self._sha1_futures = hash_service.submit_batch(paths)
+
+    def _get_sha1_value(self, local_abspath):
+        future = self._sha1_futures.pop(local_abspath, None)
+        if future is not None:
+            return future.result()
+        return sha1_value(local_abspath)
+
+    @staticmethod
+    def _get_remote_sha1_hash(remote_item):
+        try:
+            return remote_item.file.hashes.sha1_hash
+        except AttributeError:
+            return None
+
+    @staticmethod
+    def _fingerprint_differs(local_abspath, sha1_hash, item_record):
+        """
+        :param str local_abspath:
+        :param str | None sha1_hash:
+        :param onedrived.od_repo.ItemRecord | None item_record:
+        :return True | False: True if the fingerprint of the local file proves that it does not have the content of
+            the record, whose hash is sha1_hash. False if the full hash has to tell.
+        """
+        return (item_record is not None and item_record.fingerprint is not None and
+                sha1_hash is not None and item_record.sha1_hash == sha1_hash and
+                quick_fingerprint(local_abspath) != item_record.fingerprint)
+
+    def _local_content_matches(self, local_abspath, sha1_hash, item_record):
+        """
+        Compare a local file with the SHA-1 hash of an item. The fingerprint of the record is compared first, if the
+        item has the content of the record, so that a changed file is usually found without reading all of it.
+        :param str local_abspath:
+        :param str | None sha1_hash:
+        :param onedrived.od_repo.ItemRecord | None item_record:
+        :return True | False:
+        """
+        if not sha1_hash or self._fingerprint_differs(local_abspath, sha1_hash, item_record):
+            return False
+        return sha1_hash == self._get_sha1_value(local_abspath)
 
     def handle(self):
+        self._mark_started()
+
         if not os.path.isdir(self.local_abspath):
             logging.error('Error: Local path "%s" is not a directory.' % self.local_abspath)
-            return
+            return False
 
         self.repo.context.watcher.rm_watch(self.repo, self.local_abspath)
+        # Without a snapshot, the directory is not pruned from later merges in case this one does not finish.
+        self.repo.delete_dir_snapshot(self.rel_path)
 
         try:
             all_local_items = self.list_local_names()
         except (IOError, OSError) as e:
             logging.error('Error merging dir "%s": %s.', self.local_abspath, e)
-            return
+            return False
 
         all_records = self.repo.get_immediate_children_of_dir(self.rel_path)
 
@@ -146,9 +349,12 @@ class MergeDirectoryTask(base.TaskBase):
                             self.repo.authenticator.client).get)
                     all_remote_items = itertools.chain(
                         all_remote_items, remote_item_page)
+                all_remote_items = list(all_remote_items)
             except onedrivesdk.error.OneDriveError as e:
                 logging.error('Encountered API Error: %s. Skip directory "%s".', e, self.rel_path)
-                return
+                return False
+
+            self._prefetch_sha1_values(all_remote_items, all_records)
 
             for remote_item in all_remote_items:
                 remote_is_folder = remote_item.folder is not None
@@ -157,16 +363,49 @@ class MergeDirectoryTask(base.TaskBase):
                     self._handle_remote_item(remote_item, all_local_items, all_records)
                 else:
                     logging.debug('Ignored remote path "%s/%s".', self.rel_path, remote_item.name)
+        else:
+            self._prefetch_sha1_values([], all_records)
 
         for n in all_local_items:
             self._handle_local_item(n, all_records)
 
         for rec_name, rec in all_records.items():
-            logging.info('Record for item %s (%s/%s) is dead. Delete it it.', rec.item_id, rec.parent_path, rec_name)
-            self.repo.delete_item(rec_name, rec.parent_path, is_folder=rec.type == ItemRecordType.FOLDER)
+            self._handle_dead_record(rec_name, rec)
+
+        for future in self._sha1_futures.values():
+            # Files that turned out not to need hashing.
+            future.cancel()
+        self._sha1_futures.clear()
 
         self.repo.context.watcher.add_watch(self.repo, self.local_abspath)
 
+        try:
+            # Used on next startup to tell if the directory was changed while the daemon was not running.
+            self.repo.update_dir_snapshot(self.rel_path, os.stat(self.local_abspath).st_mtime_ns)
+        except OSError as e:
+            logging.error('Error taking snapshot of dir "%s": %s.', self.local_abspath, e)
+
+    def _handle_dead_record(self, rec_name, rec):
+        """
+        Handle a record that matches neither a remote item nor a local item.
+        :param str rec_name:
+        :param onedrived.od_repo.ItemRecord rec:
+        """
+        is_folder = rec.type == ItemRecordType.FOLDER
+        if os.path.lexists(self.local_abspath + '/' + rec_name):
+            # The item appeared after the directory was listed, e.g., a download finished in between.
+            return
+        if self.assume_remote_unchanged and self.parent_remote_unchanged:
+            # Remote items were not listed, so the remote item is assumed to still exist. The local one was deleted
+            # after the record was created.
+            logging.info('Local item "%s/%s" was deleted after last sync. Delete remote item.', self.rel_path, rec_name)
+            self.task_pool.add_task(delete_item.DeleteRemoteItemTask(
+                repo=self.repo, task_pool=self.task_pool, parent_relpath=self.rel_path,
+                item_name=rec_name, item_id=rec.item_id, is_folder=is_folder))
+        else:
+            logging.info('Record for item %s (%s/%s) is dead. Delete it.', rec.item_id, rec.parent_path, rec_name)
+            self.repo.delete_item(rec_name, rec.parent_path, is_folder=is_folder)
+
     def _rename_local_and_download_remote(self, remote_item, all_local_items):
         all_local_items.add(rename_with_suffix(self.local_abspath, remote_item.name, self.repo.context.host_name))
         self.task_pool.add_task(
@@ -187,7 +426,7 @@ class MergeDirectoryTask(base.TaskBase):
             # Remote item is a file yet the local item is a folder.
             if item_record and item_record.type == ItemRecordType.FOLDER:
                 # TODO: Use the logic in handle_local_folder to solve this.
-                send2trash(item_local_abspath)
+                trash_local_item(self.repo, self.rel_path, remote_item.name)
                 self.repo.delete_item(remote_item.name, self.rel_path, True)
             else:
                 # When db record does not exist or says the path is a file, then it does not agree with local inode
@@ -200,10 +439,7 @@ class MergeDirectoryTask(base.TaskBase):
         local_mtime_ts = item_stat.st_mtime if item_stat else None
         remote_mtime_ts = datetime_to_timestamp(remote_mtime)
         record_mtime_ts = datetime_to_timestamp(item_record.modified_time)
-        try:
-            remote_sha1_hash = remote_item.file.hashes.sha1_hash
-        except AttributeError:
-            remote_sha1_hash = None
+        remote_sha1_hash = self._get_remote_sha1_hash(remote_item)
 
         if (remote_item.id == item_record.item_id and remote_item.c_tag == item_record.c_tag or
             remote_item.size == item_record.size and
@@ -217,7 +453,7 @@ class MergeDirectoryTask(base.TaskBase):
                     self.repo, self.task_pool, self.rel_path, remote_item.name, remote_item.id, False))
             elif (item_stat.st_size == item_record.size_local and
                   (diff_timestamps(local_mtime_ts, record_mtime_ts) == 0 or
-                   remote_sha1_hash and remote_sha1_hash == sha1_value(item_local_abspath))):
+                   self._local_content_matches(item_local_abspath, remote_sha1_hash, item_record))):
                 # If the local file matches the database record (i.e., same mtime timestamp or same content),
                 # simply return. This is the best case.
                 if diff_timestamps(local_mtime_ts, remote_mtime_ts) != 0:
@@ -247,7 +483,7 @@ class MergeDirectoryTask(base.TaskBase):
                     download_file.DownloadFileTask(self.repo, self.task_pool, remote_item, self.rel_path))
             elif item_stat.st_size == item_record.size_local and \
                     (diff_timestamps(local_mtime_ts, record_mtime_ts) == 0 or
-                     item_record.sha1_hash and item_record.sha1_hash == sha1_value(item_local_abspath)):
+                     self._local_content_matches(item_local_abspath, item_record.sha1_hash, item_record)):
                 # Local file agrees with database record. This means that the remote file is strictly newer.
                 # The local file can be safely overwritten.
                 logging.debug('Local file "%s" agrees with db record but remote item is different. Overwrite local.',
@@ -258,7 +494,7 @@ class MergeDirectoryTask(base.TaskBase):
                 # So both the local file and remote file have been changed after the record was created.
                 equal_ts = diff_timestamps(local_mtime_ts, remote_mtime_ts) == 0
                 if (item_stat.st_size == remote_item.size and (
-                        (equal_ts or remote_sha1_hash and remote_sha1_hash == sha1_value(item_local_abspath)))):
+                        (equal_ts or self._local_content_matches(item_local_abspath, remote_sha1_hash, item_record)))):
                     # Fortunately the two files seem to be the same.
                     # Here the logic is written as if there is no size mismatch issue.
                     logging.debug(
@@ -302,7 +538,7 @@ class MergeDirectoryTask(base.TaskBase):
             equal_attr = remote_item.size == item_stat.st_size and equal_ts
             # Because of the size mismatch issue, we can't use size not being equal as a shortcut for hash not being
             # equal. When the bug is fixed we can do it.
-            if equal_attr or hash_match(item_local_abspath, remote_item):
+            if equal_attr or hash_match(item_local_abspath, remote_item, self._get_sha1_value):
                 if not equal_ts:
                     logging.info('Local file "%s" has same content but wrong timestamp. '
                                  'Remote: mtime=%s, w=%s, ts=%s, size=%d. '
@@ -320,6 +556,37 @@ class MergeDirectoryTask(base.TaskBase):
         return record and record.type == ItemRecordType.FOLDER and record.size == remote_item.size and \
             record.c_tag == remote_item.c_tag and record.e_tag == remote_item.e_tag
 
+    def _prune_subtree(self, rel_path):
+        """
+        Try merging a sub-directory whose remote subtree is known unchanged without walking the remote subtree. On
+        OneDrive Personal the tags of a folder change whenever any item under it changes, so it is enough that the
+        tags of the sub-directory match its record. Only the local directories changed since their last merge are then
+        merged, and they are merged without listing remote directories.
+        :param str rel_path: Relative path of the sub-directory.
+        :return True | False: Whether or not the subtree was pruned. If False, the caller should merge it.
+        """
+        if not self.allow_prune or self.repo.type != RepositoryType.PERSONAL:
+            return False
+        try:
+            changed_dirs, unsynced_dirs, new_dirs = local_scan.scan_local_dirs(self.repo, rel_path)
+        except OSError as e:
+            logging.error('Error scanning local dir "%s": %s.', self.repo.local_root + rel_path, e)
+            return False
+        if len(unsynced_dirs) > 0:
+            # Some merge under the subtree did not finish, so records under it can't be trusted.
+            return False
+        logging.debug('Remote subtree "%s" is unchanged. Merge %d local dirs changed and %d new under it.',
+                      rel_path, len(changed_dirs), len(new_dirs))
+        for p in changed_dirs:
+            self.task_pool.add_task(MergeDirectoryTask(
+                repo=self.repo, task_pool=self.task_pool, rel_path=p,
+                item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, path=p),
+                deep_merge=False, assume_remote_unchanged=True, parent_remote_unchanged=True))
+        for p in new_dirs:
+            parent_relpath, item_name = p.rsplit('/', maxsplit=1)
+            self.task_pool.add_task(CreateFolderTask(self.repo, self.task_pool, item_name, parent_relpath, True, True))
+        return True
+
     def _handle_remote_folder(self, remote_item, item_local_abspath, record, all_local_items):
         if not self.deep_merge:
             return
@@ -354,14 +621,53 @@ class MergeDirectoryTask(base.TaskBase):
 
             # The database is temporarily corrupted until the whole dir is merged. But unfortunately we returned early.
             self.repo.update_item(remote_item, self.rel_path, 0)
+            item_relpath = self.rel_path + '/' + remote_item.name
+            if remote_dir_matches_record and self._prune_subtree(item_relpath):
+                return
             self.task_pool.add_task(MergeDirectoryTask(
-                repo=self.repo, task_pool=self.task_pool, rel_path=self.rel_path + '/' + remote_item.name,
+                repo=self.repo, task_pool=self.task_pool, rel_path=item_relpath,
                 item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, id=remote_item.id),
                 assume_remote_unchanged=remote_dir_matches_record,
-                parent_remote_unchanged=self.assume_remote_unchanged))
+                parent_remote_unchanged=self.assume_remote_unchanged, allow_prune=self.allow_prune))
         except OSError as e:
             logging.error('Error occurred when merging directory "%s": %s', item_local_abspath, e)
 
+    def _follow_remote_move(self, remote_item, all_local_items, all_records):
+        """
+        If a remote item with no record under this directory is known by its ID, it was moved or renamed remotely.
+        Move the local item accordingly so that it needs no transfer.
+        :param onedrivesdk.model.item.Item remote_item:
+        :param [str] all_local_items:
+        :param dict(str, onedrived.od_repo.ItemRecord) all_records:
+        :return onedrived.od_repo.ItemRecord | None: The record of the item at its new path.
+        """
+        record = self.repo.get_item_by_id(remote_item.id)
+        if record is None or (record.type == ItemRecordType.FOLDER) != (remote_item.folder is not None) or \
+                not move_local_item(self.repo, record, self.rel_path, remote_item.name):
+            return None
+        if record.parent_path == self.rel_path:
+            all_local_items.discard(record.item_name)
+            all_records.pop(record.item_name, None)
+        return self.repo.get_item_by_id(remote_item.id)
+
+    def _follow_remote_folder(self, record):
+        """
+        A remote folder may be gone from this directory because it was moved elsewhere. If so, move the local folder to
+        the new path instead of deleting it.
+        :param onedrived.od_repo.ItemRecord record:
+        :return True | False: Whether or not the local folder was moved.
+        """
+        try:
+            item = item_request_call(
+                self.repo, self.repo.authenticator.client.item(drive=self.repo.drive.id, id=record.item_id).get)
+        except onedrivesdk.error.OneDriveError:
+            return False
+        parent_relpath = get_item_parent_relpath(item)
+        if parent_relpath is None or item.deleted is not None or item.folder is None:
+            return False
+        # The record keeps old tags, so the folder will be merged when its new parent is merged.
+        return move_local_item(self.repo, record, parent_relpath, item.name)
+
     def _handle_remote_item(self, remote_item, all_local_items, all_records):
         """
         :param onedrivesdk.model.item.Item remote_item:
@@ -372,9 +678,11 @@ class MergeDirectoryTask(base.TaskBase):
         # on local file system. For the case of handling a remote item, the last two may be missing.
         item_local_abspath = self.local_abspath + '/' + remote_item.name
         record = all_records.pop(remote_item.name, None)
+        if record is None:
+            record = self._follow_remote_move(remote_item, all_local_items, all_records)
 
         try:
-            stat = get_os_stat(item_local_abspath)
+            item_stat = get_os_stat(item_local_abspath)
         except OSError as e:
             logging.error('Error occurred when accessing path "%s": %s.', item_local_abspath, e)
             return
@@ -383,7 +691,7 @@ class MergeDirectoryTask(base.TaskBase):
             return self._handle_remote_folder(remote_item, item_local_abspath, record, all_local_items)
 
         if remote_item.file is None:
-            if stat:
+            if item_stat:
                 logging.info('Remote item "%s/%s" is neither a file nor a directory yet local counterpart exists. '
                              'Rename local item.', self.rel_path, remote_item.name)
                 try:
@@ -398,9 +706,33 @@ class MergeDirectoryTask(base.TaskBase):
             return
 
         if record is None:
-            self._handle_remote_file_without_record(remote_item, stat, item_local_abspath, all_local_items)
+            self._handle_remote_file_without_record(remote_item, item_stat, item_local_abspath, all_local_items)
         else:
-            self._handle_remote_file_with_record(remote_item, record, stat, item_local_abspath, all_local_items)
+            self._handle_remote_file_with_record(remote_item, record, item_stat, item_local_abspath, all_local_items)
+
+    def _move_from_record(self, item_name, item_stat, is_folder):
+        """
+        If a local item with no record is an item synced before and then moved while the daemon was not running,
+        move the remote item as well instead of uploading it again.
+        :param str item_name:
+        :param posix.stat_result item_stat:
+        :param True | False is_folder:
+        :return True | False: Whether or not the remote item was moved.
+        """
+        record = self.repo.get_item_by_inode(item_stat.st_ino, item_stat.st_dev)
+        if record is None or (record.type == ItemRecordType.FOLDER) != is_folder or \
+                (record.parent_path, record.item_name) == (self.rel_path, item_name) or \
+                os.path.lexists(self.repo.local_root + record.parent_path + '/' + record.item_name):
+            return False
+        if not is_folder and (item_stat.st_size != record.size_local or
+                              diff_timestamps(item_stat.st_mtime, datetime_to_timestamp(record.modified_time)) != 0):
+            # The file was also edited. Uploading it is no more work than moving it and uploading it.
+            return False
+        logging.info('Local item "%s/%s" seems moved to "%s/%s" after last sync. Move the remote item.',
+                     record.parent_path, record.item_name, self.rel_path, item_name)
+        return move_item.MoveItemTask(
+            repo=self.repo, task_pool=self.task_pool, parent_relpath=record.parent_path, item_name=record.item_name,
+            new_parent_relpath=self.rel_path, new_name=item_name, item_id=record.item_id, is_folder=is_folder).handle()
 
     def _handle_local_folder(self, item_name, item_record, item_local_abspath):
         """
@@ -418,12 +750,15 @@ class MergeDirectoryTask(base.TaskBase):
         if item_record is not None and item_record.type == ItemRecordType.FOLDER:
             if self.assume_remote_unchanged:
                 rel_path = self.rel_path + '/' + item_name
+                if self.parent_remote_unchanged and self._prune_subtree(rel_path):
+                    return
                 self.task_pool.add_task(MergeDirectoryTask(
                     repo=self.repo, task_pool=self.task_pool, rel_path=rel_path,
                     item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, path=rel_path),
-                    assume_remote_unchanged=True, parent_remote_unchanged=self.assume_remote_unchanged))
-            else:
-                send2trash(item_local_abspath)
+                    assume_remote_unchanged=True, parent_remote_unchanged=self.assume_remote_unchanged,
+                    allow_prune=self.allow_prune))
+            elif not self._follow_remote_folder(item_record):
+                trash_local_item(self.repo, self.rel_path, item_name)
                 self.repo.delete_item(item_name, self.rel_path, True)
             return
             # try:
@@ -458,8 +793,17 @@ class MergeDirectoryTask(base.TaskBase):
                     logging.error('Failed to delete outdated remote directory "%s/%s" of Drive %s.',
                                   self.rel_path, item_name, self.repo.drive.id)
                     # Keep the record so that the branch can be revisited next time.
+                    self.repo.mark_task_failed(item_local_abspath)
                     return
 
+        if item_record is None and self._move_from_record(item_name, os.lstat(item_local_abspath), True):
+            rel_path = self.rel_path + '/' + item_name
+            self.task_pool.add_task(MergeDirectoryTask(
+                repo=self.repo, task_pool=self.task_pool, rel_path=rel_path,
+                item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, path=rel_path),
+                allow_prune=self.allow_prune))
+            return
+
         # Either we decide to upload the item above, or the folder does not exist remotely and we have no reference
         # whether it existed remotely or not in the past. Better upload it back.
         logging.info('Local directory "%s" seems new. Upload it.', item_local_abspath)
@@ -491,7 +835,7 @@ class MergeDirectoryTask(base.TaskBase):
             record_ts = datetime_to_timestamp(item_record.modified_time)
             equal_ts = diff_timestamps(item_stat.st_mtime, record_ts) == 0
             if item_stat.st_size == item_record.size_local and \
-                    (equal_ts or item_record.sha1_hash and item_record.sha1_hash == sha1_value(item_local_abspath)):
+                    (equal_ts or self._local_content_matches(item_local_abspath, item_record.sha1_hash, item_record)):
                 # Local file matches record.
                 if self.assume_remote_unchanged:
                     if not equal_ts:
@@ -499,7 +843,7 @@ class MergeDirectoryTask(base.TaskBase):
                 else:
                     logging.debug('Local file "%s" used to exist remotely but not found. Delete it.',
                                   item_local_abspath)
-                    send2trash(item_local_abspath)
+                    trash_local_item(self.repo, self.rel_path, item_name)
                     self.repo.delete_item(item_record.item_name, item_record.parent_path, False)
                 return
             logging.debug('Local file "%s" is different from when it was last synced. Upload it.', item_local_abspath)
@@ -514,8 +858,11 @@ class MergeDirectoryTask(base.TaskBase):
                     logging.error('Failed to delete outdated remote directory "%s/%s" of Drive %s.',
                                   self.rel_path, item_name, self.repo.drive.id)
                     # Keep the record so that the branch can be revisited next time.
+                    self.repo.mark_task_failed(item_local_abspath)
                     return
             logging.debug('Local file "%s" is new to OneDrive. Upload it.', item_local_abspath)
+        elif self._move_from_record(item_name, item_stat, False):
+            return
 
         self.task_pool.add_task(upload_file.UploadFileTask(
             self.repo, self.task_pool, self.item_request, self.rel_path, item_name))
@@ -531,8 +878,8 @@ class MergeDirectoryTask(base.TaskBase):
         try:
             if os.path.isfile(item_local_abspath):
                 # stat can be None because the function can be called long after dir is listed.
-                stat = get_os_stat(item_local_abspath)
-                self._handle_local_file(item_name, record, stat, item_local_abspath)
+                item_stat = get_os_stat(item_local_abspath)
+                self._handle_local_file(item_name, record, item_stat, item_local_abspath)
             elif os.path.isdir(item_local_abspath):
                 self._handle_local_folder(item_name, record, item_local_abspath)
             else:
@@ -543,6 +890,81 @@ class MergeDirectoryTask(base.TaskBase):
             logging.error('Error occurred when accessing path "%s": %s.', item_local_abspath, e)
 
 
+class MergeRemoteChangesTask(MergeDirectoryTask):
+    """
+    Merge remote changes of items under a directory, as reported by delta API, without listing the remote directory.
+    Sub-directories are not handled.
+    """
+
+    def __init__(self, repo, task_pool, rel_path, item_request, remote_items=(), gone_records=None):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param onedrived.od_task.TaskPool task_pool:
+        :param str rel_path:
+        :param onedrivesdk.request.item_request_builder.ItemRequestBuilder item_request:
+        :param [onedrivesdk.model.item.Item] remote_items: Remote files that were added or changed in the directory.
+        :param dict(str, onedrived.od_repo.ItemRecord) | None gone_records: Records of items deleted from or moved out
+            of the directory remotely.
+        """
+        super().__init__(repo, task_pool, rel_path, item_request, deep_merge=False)
+        self.remote_items = {}
+        self.gone_records = {}
+        self._add_changes(remote_items, gone_records or {})
+
+    def __repr__(self):
+        return type(self).__name__ + '(%s, changed=%d, gone=%d)' % (
+            self.local_abspath, len(self.remote_items), len(self.gone_records))
+
+    def _add_changes(self, remote_items, gone_records):
+        for rec_name, rec in gone_records.items():
+            self.remote_items.pop(rec_name, None)
+            self.gone_records[rec_name] = rec
+        for remote_item in remote_items:
+            # A remote item at the same path supersedes the record of the item moved away.
+            self.gone_records.pop(remote_item.name, None)
+            self.remote_items[remote_item.name] = remote_item
+
+    def absorb_remote_changes(self, remote_items, gone_records):
+        with self._started_lock:
+            if self._started:
+                return False
+            self._add_changes(remote_items, gone_records)
+            return True
+
+    def handle(self):
+        self._mark_started()
+
+        if not os.path.isdir(self.local_abspath):
+            # Merge the closest local ancestor so that the changes are not lost.
+            rel_path = self.rel_path
+            while rel_path != '' and not os.path.isdir(self.repo.local_root + rel_path):
+                rel_path = rel_path.rsplit('/', maxsplit=1)[0]
+            logging.info('Local dir "%s" does not exist. Merge "%s" instead.', self.local_abspath, rel_path)
+            self.task_pool.add_task(MergeDirectoryTask(
+                repo=self.repo, task_pool=self.task_pool, rel_path=rel_path,
+                item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, path=rel_path or '/')))
+            return
+
+        self.repo.context.watcher.rm_watch(self.repo, self.local_abspath)
+
+        all_local_items = set()
+        for remote_item in self.remote_items.values():
+            record = self.repo.get_item_by_path(remote_item.name, self.rel_path)
+            self._handle_remote_item(remote_item, all_local_items, {remote_item.name: record})
+
+        # Local items renamed because of conflicts.
+        for n in all_local_items:
+            self._handle_local_item(n, {})
+
+        for rec_name, rec in self.gone_records.items():
+            if os.path.lexists(self.local_abspath + '/' + rec_name):
+                self._handle_local_item(rec_name, {rec_name: rec})
+            else:
+                self.repo.delete_item(rec_name, rec.parent_path, is_folder=rec.type == ItemRecordType.FOLDER)
+
+        self.repo.context.watcher.add_watch(self.repo, self.local_abspath)
+
+
 class CreateFolderTask(base.TaskBase):
 
     def __init__(self, repo, task_pool, item_name, parent_relpath, upload_if_success=True, abort_if_local_gone=True):
@@ -577,17 +999,23 @@ class CreateFolderTask(base.TaskBase):
         else:
             return self.repo.authenticator.client.item(drive=self.repo.drive.id, path=self.parent_relpath)
 
+    def create_remote_folder(self):
+        """
+        :return onedrivesdk.model.item.Item: The created remote folder.
+        """
+        item = self._get_folder_pseudo_item(self.item_name)
+        item = item_request_call(self.repo, self._get_item_request().children.add, item)
+        self.repo.update_item(item, self.parent_relpath, 0)
+        logging.info('Created remote item for local dir "%s".', self.local_abspath)
+        return item
+
     def handle(self):
         logging.info('Creating remote item for local dir "%s".', self.local_abspath)
         try:
             if self.abort_if_local_gone and not os.path.isdir(self.local_abspath):
                 logging.warning('Local dir "%s" is gone. Skip creating remote item for it.', self.local_abspath)
                 return
-            item = self._get_folder_pseudo_item(self.item_name)
-            item_request = self._get_item_request()
-            item = item_request_call(self.repo, item_request.children.add, item)
-            self.repo.update_item(item, self.parent_relpath, 0)
-            logging.info('Created remote item for local dir "%s".', self.local_abspath)
+            item = self.create_remote_folder()
             if self.upload_if_success:
                 logging.info('Adding task to merge "%s" after remote item was created.', self.local_abspath)
                 self.task_pool.add_task(MergeDirectoryTask(
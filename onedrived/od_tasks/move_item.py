@@ -67,7 +67,7 @@ class MoveItemTask(update_mtime.UpdateTimestampTask):
             self.repo.move_item(item_name=self.item_name, parent_relpath=self.parent_relpath,
                                 new_name=self.new_name, new_parent_relpath=self.new_parent_relpath,
                                 is_folder=self.is_folder)
-            self.update_timestamp_and_record(item, item_stat)
+            self.update_timestamp_and_record(item, item_stat, self.new_parent_relpath)
             return True
         except (onedrivesdk.error.OneDriveError, OSError) as e:
             logging.error('Error moving item "%s" to "%s": %s.', self.rel_path, self.new_relpath, e)
@@ -0,0 +1,58 @@
+import logging
+import os
+
+from . import base, local_scan, merge_dir, upload_tree
+
+
+class RescanLocalDirTask(base.TaskBase):
+    """
+    Find local changes under a dir whose inotify events may have been lost, e.g., when the kernel event queue
+    overflowed. The local tree is compared with dir snapshots and records, without asking the server, and only the dirs
+    found changed are merged.
+    """
+
+    def __init__(self, repo, task_pool, rel_path):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param onedrived.od_task.TaskPool task_pool:
+        :param str rel_path: Relative path of the dir to scan.
+        """
+        super().__init__(repo, task_pool)
+        self.rel_path = rel_path
+        self.local_abspath = repo.local_root + rel_path
+
+    def __repr__(self):
+        return type(self).__name__ + '(%s)' % self.local_abspath
+
+    def _get_scan_root(self):
+        """
+        :return str: The dir itself, or its closest ancestor that exists and has a record. A scan must start from such
+            a dir so that it can tell new dirs from changed ones.
+        """
+        rel_path = self.rel_path
+        while rel_path != '':
+            parent_relpath, item_name = rel_path.rsplit('/', maxsplit=1)
+            if os.path.isdir(self.repo.local_root + rel_path) and \
+                    self.repo.get_item_by_path(item_name, parent_relpath) is not None:
+                break
+            rel_path = parent_relpath
+        return rel_path
+
+    def handle(self):
+        rel_path = self._get_scan_root()
+        try:
+            changed_dirs, unsynced_dirs, new_dirs = local_scan.scan_local_dirs(self.repo, rel_path)
+        except OSError as e:
+            logging.error('Error scanning local dir "%s": %s.', self.repo.local_root + rel_path, e)
+            return False
+        logging.info('Rescanned local dir "%s". %d dirs changed and %d are new. %d dirs were not fully merged.',
+                     self.repo.local_root + rel_path, len(changed_dirs), len(new_dirs), len(unsynced_dirs))
+        for p in changed_dirs + unsynced_dirs:
+            self.task_pool.add_task(merge_dir.MergeDirectoryTask(
+                repo=self.repo, task_pool=self.task_pool, rel_path=p,
+                item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, path=p or '/'),
+                deep_merge=False))
+        for p in new_dirs:
+            parent_relpath, item_name = p.rsplit('/', maxsplit=1)
+            self.task_pool.add_task(upload_tree.UploadTreeTask(self.repo, self.task_pool, item_name, parent_relpath))
+        return True
@@ -1,13 +1,18 @@
 import logging
 import os
 
+from . import apply_delta
 from . import base
+from . import local_scan
 from . import merge_dir
+from ..od_repo import RepositoryStateKey
 
 
 class StartRepositoryTask(base.TaskBase):
     """A simple task that bootstraps the syncing process of a Drive.
     It checks if the root path is a directory, and if so, create a task to merge the remote root with local root.
+    If the daemon was shut down cleanly last time, or it crashed but all unfinished work was in task journal, only the
+    remote delta and the local directories changed since then are merged.
     """
 
     def __init__(self, repo, task_pool):
@@ -21,41 +26,51 @@ class StartRepositoryTask(base.TaskBase):
     def __repr__(self):
         return type(self).__name__ + '(drive=' + self.repo.drive.id + ')'
 
+    @staticmethod
+    def can_skip_full_merge(repo):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :return True | False: Whether or not the task will only merge what changed since the daemon last stopped.
+        """
+        return (repo.was_shut_down_cleanly or repo.is_journal_consistent) and \
+            repo.get_state(RepositoryStateKey.DELTA_TOKEN) is not None
+
+    def _scan_local_dirs(self):
+        """
+        Scan the whole local repository. Temporary files are left alone because downloads replayed from task journal
+        may be in progress. They were swept before workers started.
+        :return ([str], [str], [str]): Relative paths of changed, unsynced and new directories.
+        """
+        return local_scan.scan_local_dirs(self.repo, '')
+
     def handle(self):
         try:
-            if os.path.isdir(self.repo.local_root):
-                # And add a recursive merge task to task queue.
-                item_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, path='/')
-                self.task_pool.add_task(merge_dir.MergeDirectoryTask(self.repo, self.task_pool, '', item_request))
-            else:
+            if not os.path.isdir(self.repo.local_root):
                 raise OSError('Local root of Drive %s does not exist or is not a directory. Please check "%s".' %
                               (self.repo.drive.id, self.repo.local_root))
+            can_skip_full_merge = self.can_skip_full_merge(self.repo)
+            # If the daemon crashes before the work is queued, next start has to merge the whole Drive.
+            self.repo.set_state(RepositoryStateKey.JOURNAL_CONSISTENT, '0')
+            if can_skip_full_merge:
+                # Later runs of this task (e.g., when webhook is unavailable) do a full merge.
+                self.repo.was_shut_down_cleanly = self.repo.is_journal_consistent = False
+                changed_dirs, unsynced_dirs, new_dirs = self._scan_local_dirs()
+                logging.info('Resuming sync of Drive %s. Since last session %d local dirs changed and %d are new. '
+                             '%d dirs were not fully merged.',
+                             self.repo.drive.id, len(changed_dirs), len(new_dirs), len(unsynced_dirs))
+                self.task_pool.add_task(apply_delta.ApplyDeltaTask(
+                    self.repo, self.task_pool, changed_dirs, new_dirs, local_unsynced_dirs=unsynced_dirs))
+            else:
+                # Changes made during the full merge will show up in next delta query.
+                apply_delta.save_latest_delta_token(self.repo)
+                # And add a recursive merge task to task queue.
+                item_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, path='/')
+                # After a crash or failed tasks, tags and snapshots of a subtree may not cover all work under it.
+                allow_prune = not self.repo.needs_recovery
+                self.repo.needs_recovery = False
+                self.task_pool.add_task(merge_dir.MergeDirectoryTask(
+                    self.repo, self.task_pool, '', item_request, allow_prune=allow_prune))
+            self.repo.mark_journal_consistent()
         except OSError as e:
             logging.error('Error: %s', e)
-
-
-# class ApplyLatestDeltaTask(StartRepositoryTask):
-#
-#     TOKEN_LATEST = 'latest'
-#
-#     def handle(self):
-#         try:
-#             logging.debug('Checking delta for Drive %s.', self.repo.drive.id)
-#             item_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, path='/')
-#             delta_collection = item_request.delta(token=self.TOKEN_LATEST).get()
-#             for item in delta_collection:
-#                 print(item.name)
-#             logging.info('Delta token: %s.', delta_collection.token)
-#             import json
-#             with open('delta_latest.json', 'a') as f:
-#                 json.dump(delta_collection.__dict__, f, sort_keys=True, indent=4, separators=(',', ': '))
-#                 f.write('\n')
-#             delta_collection_2 = item_request.delta(token=delta_collection.token).get()
-#             for item in delta_collection_2:
-#                 print(item.name)
-#             logging.info('Delta token 2: %s.', delta_collection_2.token)
-#             with open('delta_latest_succ.json', 'a') as f:
-#                 json.dump(delta_collection_2.__dict__, f, sort_keys=True, indent=4, separators=(',', ': '))
-#                 f.write('\n')
-#         except:
-#             raise
+            return False
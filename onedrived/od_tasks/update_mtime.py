@@ -26,12 +26,21 @@ class UpdateTimestampTask(update_item_base.UpdateItemTaskBase):
     def __repr__(self):
         return type(self).__name__ + '(%s)' % self.local_abspath
 
-    def update_timestamp_and_record(self, new_item, item_local_stat):
+    def update_timestamp_and_record(self, new_item, item_local_stat, parent_relpath=None):
+        """
+        :param onedrivesdk.model.item.Item new_item:
+        :param posix.stat_result item_local_stat:
+        :param str | None parent_relpath: Where the item is now, if not where the task was created for.
+        """
+        if parent_relpath is None:
+            parent_relpath = self.parent_relpath
+            local_abspath = self.local_abspath
+        else:
+            local_abspath = self.repo.local_root + parent_relpath + '/' + new_item.name
         remote_mtime, remote_mtime_w = get_item_modified_datetime(new_item)
         if not remote_mtime_w:
             # last_modified_datetime attribute is not modifiable in OneDrive server. Update local mtime.
-            fix_owner_and_timestamp(self.local_abspath, self.repo.context.user_uid,
-                                    datetime_to_timestamp(remote_mtime))
+            fix_owner_and_timestamp(local_abspath, self.repo.context.user_uid, datetime_to_timestamp(remote_mtime))
         else:
             file_system_info = FileSystemInfo()
             file_system_info.last_modified_date_time = datetime.utcfromtimestamp(item_local_stat.st_mtime)
@@ -39,7 +48,7 @@ class UpdateTimestampTask(update_item_base.UpdateItemTaskBase):
             updated_item.file_system_info = file_system_info
             item_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, id=new_item.id)
             new_item = item_request_call(self.repo, item_request.update, updated_item)
-        self.repo.update_item(new_item, self.parent_relpath, item_local_stat.st_size)
+        self.repo.update_item(new_item, parent_relpath, item_local_stat.st_size)
 
     def handle(self):
         logging.info('Updating timestamp for file "%s".', self.local_abspath)
@@ -1,11 +1,26 @@
 import logging
 import os
+import time
 
 import onedrivesdk
 import onedrivesdk.error
 
 from . import update_mtime
-from ..od_api_helper import item_request_call
+from ..od_api_helper import copy_item, item_request_call
+from ..od_fileutils import is_open_for_writing
+from ..od_hashutils import sha1_value
+
+
+class SourceChangedException(Exception):
+    pass
+
+
+def get_file_snapshot(item_stat):
+    """
+    :param posix.stat_result item_stat:
+    :return (int, int, int): Attributes of a file that change when it's written or replaced.
+    """
+    return item_stat.st_size, item_stat.st_mtime_ns, item_stat.st_ino
 
 
 class UploadFileTask(update_mtime.UpdateTimestampTask):
@@ -14,6 +29,22 @@ class UploadFileTask(update_mtime.UpdateTimestampTask):
     # using Session API (https://dev.onedrive.com/items/upload_large_files.htm).
     PUT_FILE_SIZE_THRESHOLD_BYTES = 10 << 20
 
+    # If a file is at least this large and a remote file has the same content, copy the remote file instead.
+    COPY_FILE_SIZE_THRESHOLD_BYTES = 10 << 20
+
+    # Wait this long before uploading again a file that changed during upload, so that its writer can finish.
+    RESCHEDULE_DELAY_SEC = 10
+
+    # Files at least this large are held until they stop changing and no other process has them open for writing.
+    # Applications like video exporters close and reopen such files many times while writing them.
+    STABILITY_CHECK_SIZE_BYTES = 1 << 20
+
+    # A file is stable if it has not changed for this long and no other process has it open for writing. The window
+    # doubles each time a held file is found still changing or open. A file unchanged for MAX_SETTLE_SEC is uploaded
+    # even if a writer keeps it open, e.g., a log file or a database.
+    MIN_SETTLE_SEC = 5
+    MAX_SETTLE_SEC = 300
+
     def __init__(self, repo, task_pool, parent_dir_request, parent_relpath, item_name):
         """
         :param onedrived.od_repo.OneDriveLocalRepository repo:
@@ -24,16 +55,122 @@ class UploadFileTask(update_mtime.UpdateTimestampTask):
         """
         super().__init__(repo, task_pool, parent_relpath, item_name)
         self.parent_dir_request = parent_dir_request
+        self._source_snapshot = None
+        # Set by the watcher when the file is written during upload.
+        self._source_changed = False
+        self.settle_sec = self.MIN_SETTLE_SEC
+        # Snapshot of the file when the upload was last held.
+        self._held_snapshot = None
 
     def __repr__(self):
         return type(self).__name__ + '(%s)' % self.local_abspath
 
+    def mark_source_changed(self):
+        self._source_changed = True
+
+    def _check_source(self):
+        """
+        :raise SourceChangedException: If the file was written or replaced since the upload started.
+        """
+        if self._source_changed:
+            raise SourceChangedException('Local file "%s" was written during upload.' % self.local_abspath)
+        try:
+            snapshot = get_file_snapshot(os.stat(self.local_abspath))
+        except OSError as e:
+            raise SourceChangedException('Local file "%s" is gone: %s.' % (self.local_abspath, e))
+        if snapshot != self._source_snapshot:
+            raise SourceChangedException('Local file "%s" changed from (size, mtime_ns, inode) %s to %s.' % (
+                self.local_abspath, self._source_snapshot, snapshot))
+
+    def _get_hold_sec(self, item_stat):
+        """
+        :param posix.stat_result item_stat:
+        :return int | float: Seconds to wait before uploading the file, or 0 if it's stable.
+        """
+        if item_stat.st_size < self.STABILITY_CHECK_SIZE_BYTES:
+            return 0
+        snapshot = get_file_snapshot(item_stat)
+        if self._held_snapshot is not None and snapshot != self._held_snapshot:
+            self.settle_sec = min(self.settle_sec * 2, self.MAX_SETTLE_SEC)
+        self._held_snapshot = snapshot
+        age_sec = time.time() - item_stat.st_mtime
+        if age_sec < self.settle_sec:
+            return self.settle_sec - age_sec
+        if age_sec >= self.MAX_SETTLE_SEC:
+            # Scanning open files of all processes is costly, and a file this stable is uploaded anyway.
+            return 0
+        if is_open_for_writing(item_stat):
+            self.settle_sec = min(self.settle_sec * 2, self.MAX_SETTLE_SEC)
+            return min(self.settle_sec, self.MAX_SETTLE_SEC - age_sec)
+        return 0
+
+    def _reschedule(self, delay_sec):
+        """
+        Upload the file again later. The task journal entry of this task is kept until the new task is queued, so that
+        the upload is not lost if the daemon stops in between.
+        :param int | float delay_sec:
+        """
+        task = UploadFileTask(self.repo, self.task_pool, self.parent_dir_request, self.parent_relpath, self.item_name)
+        task.interactive = self.interactive
+        task.settle_sec, task._held_snapshot = self.settle_sec, self._held_snapshot
+        held_journal_seq, self.journal_seq = self.journal_seq, None
+        loop = self.repo.context.loop
+        if loop:
+            loop.call_soon_threadsafe(loop.call_later, delay_sec, task._resume, held_journal_seq)
+        else:
+            task._resume(held_journal_seq)
+
+    def _resume(self, held_journal_seq):
+        # If the file is gone, the watcher handles the deletion.
+        if os.path.isfile(self.local_abspath):
+            self.task_pool.add_task(self)
+        if held_journal_seq is not None:
+            self.repo.delete_journal_entry(held_journal_seq)
+
     def update_progress(self, curr_part, total_part):
+        if curr_part < total_part:
+            # Don't send more parts of a file that will be uploaded again.
+            self._check_source()
         if curr_part == total_part:
             logging.debug('All %d parts of file "%s" have been uploaded.', total_part, self.local_abspath)
         else:
             logging.debug('Uploading file "%s": Part %d / %d.', self.local_abspath, curr_part + 1, total_part)
 
+    def _copy_remote_duplicate(self, item_stat):
+        """
+        Look for a remote file with the same content in the Drive and copy it to the path to upload to.
+        :param posix.stat_result item_stat:
+        :return onedrivesdk.Item | None: The remote item copied to, or None if the file has to be uploaded.
+        """
+        if not self.repo.has_other_file_of_size(item_stat.st_size, self.item_name, self.parent_relpath):
+            # Reading the whole file to hash it can't pay off.
+            return None
+        sha1_hash = sha1_value(self.local_abspath)
+        records = [r for r in self.repo.get_items_by_hash(sha1_hash, item_stat.st_size)
+                   if (r.parent_path, r.item_name) != (self.parent_relpath, self.item_name)]
+        if len(records) == 0:
+            return None
+        record = records[0]
+        logging.info('Copy remote item "%s/%s" to "%s" which has the same content.',
+                     record.parent_path, record.item_name, self.rel_path)
+        try:
+            item_id = copy_item(self.repo, record.item_id, self.parent_relpath, self.item_name)
+            if item_id is None:
+                return None
+            item = item_request_call(
+                self.repo, self.repo.authenticator.client.item(drive=self.repo.drive.id, id=item_id).get)
+        except onedrivesdk.error.OneDriveError as e:
+            # E.g., a remote item already exists at the path.
+            logging.info('Cannot copy remote item "%s/%s": %s. Upload the file instead.',
+                         record.parent_path, record.item_name, e)
+            return None
+        # The remote file may have changed after it was recorded.
+        if item.file is None or item.file.hashes is None or item.file.hashes.sha1_hash != sha1_hash:
+            logging.info('Copy of remote item "%s/%s" has different content. Upload the file instead.',
+                         record.parent_path, record.item_name)
+            return None
+        return item
+
     def handle(self):
         logging.info('Uploading file "%s" to OneDrive.', self.local_abspath)
         occupy_task = self.task_pool.occupy_path(self.local_abspath, self)
@@ -43,7 +180,21 @@ class UploadFileTask(update_mtime.UpdateTimestampTask):
             return False
         try:
             item_stat = os.stat(self.local_abspath)
-            if item_stat.st_size < self.PUT_FILE_SIZE_THRESHOLD_BYTES:
+            hold_sec = self._get_hold_sec(item_stat)
+            if hold_sec > 0:
+                logging.info('File "%s" is still being written. Check again in %d sec.', self.local_abspath, hold_sec)
+                self.task_pool.release_path(self.local_abspath)
+                self._reschedule(hold_sec)
+                return True
+            self._source_snapshot = get_file_snapshot(item_stat)
+            # Writes before now are in the snapshot.
+            self._source_changed = False
+            returned_item = None
+            if item_stat.st_size >= self.COPY_FILE_SIZE_THRESHOLD_BYTES:
+                returned_item = self._copy_remote_duplicate(item_stat)
+            if returned_item is not None:
+                logging.info('Copied remote duplicate of file "%s" instead of uploading it.', self.local_abspath)
+            elif item_stat.st_size < self.PUT_FILE_SIZE_THRESHOLD_BYTES:
                 item_request = self.parent_dir_request.children[self.item_name]
                 returned_item = item_request_call(self.repo, item_request.upload, self.local_abspath)
                 if returned_item is None:
@@ -60,9 +211,19 @@ class UploadFileTask(update_mtime.UpdateTimestampTask):
                         returned_item = onedrivesdk.Item(returned_item._prop_dict)
                     else:
                         returned_item = item_request_call(self.repo, item_request.get)
+            # The remote file may have data of an older or partly written version. Don't record it as synced, or
+            # change the local mtime to its mtime.
+            self._check_source()
             self.update_timestamp_and_record(returned_item, item_stat)
             self.task_pool.release_path(self.local_abspath)
             logging.info('Finished uploading file "%s".', self.local_abspath)
+            if self._source_changed:
+                self._reschedule(self.RESCHEDULE_DELAY_SEC)
+            return True
+        except SourceChangedException as e:
+            logging.info('%s Upload it again later.', e)
+            self.task_pool.release_path(self.local_abspath)
+            self._reschedule(self.RESCHEDULE_DELAY_SEC)
             return True
         except (onedrivesdk.error.OneDriveError, OSError) as e:
             logging.error('Error uploading file "%s": %s.', self.local_abspath, e)
@@ -0,0 +1,74 @@
+import logging
+import os
+
+import onedrivesdk.error
+
+from . import merge_dir, upload_file
+
+
+class UploadTreeTask(merge_dir.CreateFolderTask):
+    """
+    Upload a local dir that is new to the Drive, e.g., one copied in by "cp -r" or extracted from an archive. The remote
+    folder is created and the local dir is walked once: files are queued for upload and sub-dirs become tasks of their
+    own, so that folders of one depth level are created in parallel. Because the remote folder is known to be empty, no
+    dir in the tree is merged.
+    """
+
+    def __init__(self, repo, task_pool, item_name, parent_relpath):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param onedrived.od_task.TaskPool task_pool:
+        :param str item_name:
+        :param str parent_relpath:
+        """
+        super().__init__(repo, task_pool, item_name, parent_relpath, upload_if_success=False, abort_if_local_gone=True)
+        self.rel_path = parent_relpath + '/' + item_name
+
+    def __repr__(self):
+        return type(self).__name__ + '(%s)' % self.local_abspath
+
+    def handle(self):
+        logging.info('Uploading new local dir "%s".', self.local_abspath)
+        try:
+            if not os.path.isdir(self.local_abspath):
+                logging.warning('Local dir "%s" is gone. Skip uploading it.', self.local_abspath)
+                return True
+            # Watch before listing so that items added after listing are reported.
+            self.repo.context.watcher.add_watch(self.repo, self.local_abspath)
+            self.repo.delete_dir_snapshot(self.rel_path)
+            dir_mtime_ns = os.stat(self.local_abspath).st_mtime_ns
+            item = self.create_remote_folder()
+        except onedrivesdk.error.OneDriveError as e:
+            # E.g., a remote item of the same name was created at the same time.
+            logging.warning('Error creating remote dir of "%s": %s. Fall back to dir merge.', self.local_abspath, e)
+            self.task_pool.add_task(merge_dir.MergeDirectoryTask(
+                repo=self.repo, task_pool=self.task_pool, rel_path=self.rel_path,
+                item_request=self.repo.authenticator.client.item(drive=self.repo.drive.id, path=self.rel_path)))
+            return True
+        except OSError as e:
+            logging.error('Error uploading local dir "%s": %s.', self.local_abspath, e)
+            return False
+
+        try:
+            item_names = merge_dir.list_local_names(self.local_abspath)
+        except OSError as e:
+            logging.error('Error listing local dir "%s": %s.', self.local_abspath, e)
+            return False
+        dir_request = self.repo.authenticator.client.item(drive=self.repo.drive.id, id=item.id)
+        for name in sorted(item_names):
+            item_local_abspath = self.local_abspath + '/' + name
+            is_dir = os.path.isdir(item_local_abspath)
+            if self.repo.path_filter.should_ignore(self.rel_path + '/' + name, is_dir) or \
+                    self.repo.path_filter.is_temp_name(name):
+                logging.debug('Ignored local path "%s".', item_local_abspath)
+            elif is_dir:
+                self.task_pool.add_task(UploadTreeTask(self.repo, self.task_pool, name, self.rel_path))
+            elif os.path.isfile(item_local_abspath):
+                self.task_pool.add_task(upload_file.UploadFileTask(
+                    repo=self.repo, task_pool=self.task_pool, parent_dir_request=dir_request,
+                    parent_relpath=self.rel_path, item_name=name))
+            else:
+                logging.warning('Unsupported type of local item "%s". Skip it.', item_local_abspath)
+        # Items changed after the dir was stat'ed make it look changed on next startup.
+        self.repo.update_dir_snapshot(self.rel_path, dir_mtime_ns)
+        return True
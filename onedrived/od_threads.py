@@ -1,6 +1,9 @@
 import logging
 import threading
 
+from . import od_iosched
+from . import od_trace
+
 
 class TaskWorkerThread(threading.Thread):
 
@@ -10,6 +13,7 @@ class TaskWorkerThread(threading.Thread):
         """
         super().__init__(name=name, daemon=False)
         self.task_pool = task_pool
+        self.current_task = None
         self._running = True
 
     def stop(self):
@@ -26,5 +30,13 @@ class TaskWorkerThread(threading.Thread):
             task = self.task_pool.pop_task()
             if task is not None:
                 logging.debug('Got task %s.', task)
-                task.handle()
+                self.current_task = task
+                od_iosched.set_background(not task.interactive)
+                try:
+                    with od_trace.span(type(task).__name__, 'task', path=task.local_abspath):
+                        if task.handle() is False and task.repo is not None:
+                            task.repo.mark_task_failed(task.local_abspath)
+                finally:
+                    self.current_task = None
+                    self.task_pool.task_done(task)
         logging.info('Stopped.')
@@ -0,0 +1,190 @@
+"""
+od_trace.py
+Opt-in tracing of task execution and a stack dump facility for diagnosing stalls.
+Spans are written to a rotating file in Chrome trace event format, which can be loaded in chrome://tracing.
+:copyright: (c) Xiangyu Bu <xybu92@live.com>
+:license: MIT
+"""
+
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+
+class TraceWriter:
+    """Append trace events to a JSON array file and rotate the file when it grows too large."""
+
+    def __init__(self, path, max_bytes, backup_count=1):
+        """
+        :param str path: Path to the trace file.
+        :param int max_bytes: Rotate the file when its size exceeds this number of bytes.
+        :param int backup_count: Number of rotated files to keep.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._file = None
+        self._named_threads = set()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'w')
+        self._file.write('[\n')
+        self._is_empty = True
+        self._named_threads.clear()
+
+    def _rotate(self):
+        self._file.write('\n]\n')
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists('%s.%d' % (self.path, i)):
+                os.replace('%s.%d' % (self.path, i), '%s.%d' % (self.path, i + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        self._open()
+
+    def _write_event(self, event):
+        if not self._is_empty:
+            self._file.write(',\n')
+        json.dump(event, self._file, separators=(',', ':'))
+        self._is_empty = False
+
+    def _abort(self, e):
+        logging.error('Error writing trace file "%s": %s. Stop tracing.', self.path, e)
+        try:
+            self._file.close()
+        except (OSError, ValueError):
+            pass
+        self._file = None
+
+    def write(self, event):
+        """
+        Errors are logged instead of raised because spans wrap the work of sync threads.
+        :param dict event: A complete trace event except for pid and tid fields.
+        :return True | False: False if the writer has failed or been closed.
+        """
+        thread = threading.current_thread()
+        event['pid'] = self.pid
+        event['tid'] = thread.ident
+        with self._lock:
+            if self._file is None:
+                return False
+            try:
+                if thread.ident not in self._named_threads:
+                    # Metadata event so that the viewer shows thread names instead of thread IDs.
+                    self._write_event({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': thread.ident,
+                                       'args': {'name': thread.name}})
+                    self._named_threads.add(thread.ident)
+                self._write_event(event)
+                if self._file.tell() > self.max_bytes:
+                    self._rotate()
+                return True
+            except (OSError, ValueError) as e:
+                self._abort(e)
+                return False
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                try:
+                    self._file.write('\n]\n')
+                    self._file.close()
+                    self._file = None
+                except (OSError, ValueError) as e:
+                    self._abort(e)
+
+
+_writer = None
+
+
+def enable_tracing(path, max_bytes, backup_count=1):
+    """
+    Start recording spans to the given file. Calling it again replaces the previous trace file.
+    :param str path:
+    :param int max_bytes:
+    :param int backup_count:
+    """
+    global _writer
+    disable_tracing()
+    _writer = TraceWriter(path, max_bytes, backup_count)
+    logging.info('Recording trace events to "%s".', path)
+
+
+def disable_tracing():
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def is_tracing_enabled():
+    return _writer is not None
+
+
+@contextmanager
+def span(name, cat, **kwargs):
+    """
+    Record the execution of the enclosed block as a complete event. Spans opened in the same thread nest naturally.
+    When tracing is disabled the overhead is a single global lookup.
+    :param str name: Name of the span, e.g., the task type or API call.
+    :param str cat: Category of the span, e.g., "task", "api", "hash", "db".
+    :param kwargs: Extra arguments attached to the event.
+    """
+    writer = _writer
+    if writer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        end = time.time()
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6)}
+        if kwargs:
+            event['args'] = {k: str(v) for k, v in kwargs.items()}
+        if not writer.write(event):
+            _discard_writer(writer)
+
+
+def _discard_writer(writer):
+    global _writer
+    if _writer is writer:
+        _writer = None
+
+
+def dump_thread_stacks(workers=()):
+    """
+    Format the stack of every thread in the process, along with the task each worker thread is handling.
+    :param [onedrived.od_threads.TaskWorkerThread] workers:
+    :return str:
+    """
+    current_tasks = {w.ident: w.current_task for w in workers if w is not None}
+    threads_by_id = {t.ident: t for t in threading.enumerate()}
+    lines = []
+    for thread_id, frame in sys._current_frames().items():
+        thread = threads_by_id.get(thread_id)
+        lines.append('Thread %s (%d):' % (thread.name if thread else '<unknown>', thread_id))
+        if thread_id in current_tasks:
+            lines.append('  Current task: %s' % current_tasks[thread_id])
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+    return '\n'.join(lines)
+
+
+def install_stack_dump_handler(get_workers, signum=signal.SIGUSR2):
+    """
+    Log stacks of all threads when the process receives the signal.
+    :param () -> [onedrived.od_threads.TaskWorkerThread] get_workers: Returns the current worker threads.
+    :param int signum:
+    """
+    # noinspection PyUnusedLocal
+    def _handler(sig, frame):
+        logging.critical('Received signal %d. Dumping thread stacks:\n%s', sig, dump_thread_stacks(get_workers()))
+    signal.signal(signum, _handler)
@@ -1,14 +1,18 @@
+import collections
+import errno
 import logging
 import os
 import threading
+import time
 
 import onedrivesdk.error
 from inotify_simple import flags as _inotify_flags, masks as _inotify_masks, INotify as _INotify
 
-from .od_tasks import delete_item, move_item, merge_dir, update_mtime, upload_file
+from .od_tasks import delete_item, move_item, merge_dir, rescan_dir, update_mtime, upload_file, upload_tree
 from .od_models.path_filter import PathFilter
-from .od_models.bidict import loosebidict
+from .od_models.watch_tree import WatchTree
 from .od_api_helper import item_request_call
+from .od_poller import DirPoller
 from .od_hashutils import hash_match
 from .od_repo import ItemRecordType
 from .od_stringutils import get_filename_with_incremented_count
@@ -23,44 +27,140 @@ class ParentTaskExistsException(Exception):
 
 class LocalRepositoryWatcher:
 
-    FLAGS = _inotify_flags.CREATE | _inotify_flags.CLOSE_WRITE | _inotify_flags.DELETE | _inotify_masks.MOVE
+    FLAGS = _inotify_flags.CREATE | _inotify_flags.CLOSE_WRITE | _inotify_flags.DELETE | _inotify_flags.DELETE_SELF | \
+        _inotify_masks.MOVE
 
     BUSY_RETRY_INTERVAL_SEC = 30
     FD_READ_DELAY_MSEC = 200
-
-    def __init__(self, task_pool, loop=None):
+    # Delete events are held until no delete is seen for this period, so that a recursive delete can be recognized.
+    DELETE_SETTLE_SEC = 1
+    # But no longer than this period since the first held event.
+    MAX_DELETE_HOLD_SEC = 30
+    # When the kernel event queue overflows, dirs with events in this period are scanned for the lost events.
+    DIRTY_DIR_WINDOW_SEC = 60
+    MAX_DIRTY_DIRS = 256
+    # Events read but not handled. When the queue is full, the fd is not read until the queue is half drained.
+    MAX_QUEUED_EVENTS = 16384
+    EVENT_BATCH_SIZE = 1024
+
+    def __init__(self, task_pool, loop=None, backend=None):
         """
         :param onedrived.od_task.TaskPool task_pool:
         :param asyncio.SelectorEventLoop | None loop:
+        :param onedrived.od_fanotify.Fanotify | None backend: Source of events with the interface of
+            inotify_simple.INotify (fd, add_watch, rm_watch, read and close). Default: inotify.
         """
         self._lock = threading.RLock()
-        self.watch_descriptors = loosebidict()
+        # Maps watch descriptors to (repo, dir path). Paths follow dir moves.
+        self.watch_descriptors = WatchTree()
         self.task_queue = []
         self.task_pool = task_pool
-        self.notifier = _INotify()
+        # Held delete events, by watch descriptor of the parent dir.
+        self._pending_deletes = dict()
+        self._pending_deletes_since = None
+        self._flush_handle = None
+        # Maps (repo, rel_path) of dirs with recent events to time of the last event, from oldest to latest.
+        self._dirty_dirs = collections.OrderedDict()
+        self._event_queue = collections.deque()
+        self._is_reading = True
+        self._plan_handle = None
+        self.notifier = backend if backend is not None else _INotify()
         if loop is None:
             import asyncio
             self.loop = asyncio.get_event_loop()
         else:
             self.loop = loop
         self.loop.add_reader(self.notifier.fd, self.process_events)
+        # Dirs that can't be watched because the watch limit is reached.
+        self.poller = DirPoller(self.loop, self._handle_polled_change)
 
     def close(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        if self._plan_handle is not None:
+            self._plan_handle.cancel()
+        self.poller.close()
         self.notifier.close()
 
     def add_watch(self, repo, local_abspath):
         logging.debug('Adding watcher for "%s"', local_abspath)
         with self._lock:
-            if (repo, local_abspath) not in self.watch_descriptors.inv:
-                wd = self.notifier.add_watch(local_abspath, self.FLAGS)
+            if self.watch_descriptors.find(repo, local_abspath) is None and (repo, local_abspath) not in self.poller:
+                try:
+                    # If the dir is watched under an old path, the kernel returns the same wd and the path is updated.
+                    wd = self.notifier.add_watch(local_abspath, self.FLAGS)
+                except OSError as e:
+                    if e.errno != errno.ENOSPC:
+                        raise
+                    if len(self.poller) == 0:
+                        logging.warning('Inotify watch limit is reached. Poll local dir "%s" and later dirs instead. '
+                                        'Raise fs.inotify.max_user_watches to watch all dirs.', local_abspath)
+                    # A merge of the dir removes and adds the watch again, and then tries inotify again.
+                    self.poller.add_dir(repo, local_abspath)
+                    return
                 self.watch_descriptors[wd] = (repo, local_abspath)
 
     def rm_watch(self, repo, local_abspath):
+        """
+        :return True | False: Whether or not the path was being watched.
+        """
         logging.debug('Removing watcher for "%s"', local_abspath)
         with self._lock:
-            if (repo, local_abspath) in self.watch_descriptors.inv:
-                wd = self.watch_descriptors.inv.pop((repo, local_abspath))
-                self.notifier.rm_watch(wd)
+            wd = self.watch_descriptors.pop_path(repo, local_abspath)
+            if wd is None:
+                return self.poller.remove_dir(repo, local_abspath)
+            self._rm_watch_descriptor(wd, local_abspath)
+            return True
+
+    def rm_watch_tree(self, repo, local_abspath):
+        """
+        Remove the watches of a dir and all dirs under it, e.g., when the dir is moved out of the repository.
+        """
+        logging.debug('Removing watchers under "%s"', local_abspath)
+        with self._lock:
+            for wd in self.watch_descriptors.pop_subtree(repo, local_abspath):
+                self._rm_watch_descriptor(wd, local_abspath)
+            self.poller.remove_tree(repo, local_abspath)
+
+    def _rm_watch_descriptor(self, wd, local_abspath):
+        try:
+            self.notifier.rm_watch(wd)
+        except OSError as e:
+            # The kernel drops the watch of a deleted dir by itself.
+            logging.debug('Error removing watch under "%s": %s.', local_abspath, e)
+
+    def _move_watch(self, move_pair):
+        """
+        A dir moved within the watched trees keeps its watch, and so do the dirs under it. Relink the watch to the new
+        path so that events from the dirs are reported with their new paths.
+        :param [[inotify_simple.Event, inotify_simple.flags], [inotify_simple.Event, inotify_simple.flags]] move_pair:
+        """
+        (from_ev, _), (to_ev, _) = move_pair
+        from_repo, from_parent_dir = self.watch_descriptors[from_ev.wd]
+        with self._lock:
+            if to_ev.wd not in self.watch_descriptors:
+                self.rm_watch_tree(from_repo, from_parent_dir + '/' + from_ev.name)
+                return
+            to_repo, to_parent_dir = self.watch_descriptors[to_ev.wd]
+            if to_repo.path_filter.should_ignore(self._local_abspath_to_relpath(to_repo, to_parent_dir) + '/' +
+                                                 to_ev.name, is_dir=True):
+                self.rm_watch_tree(from_repo, from_parent_dir + '/' + from_ev.name)
+            else:
+                self.watch_descriptors.move(from_repo, from_parent_dir + '/' + from_ev.name,
+                                            to_repo, to_parent_dir + '/' + to_ev.name)
+                self.poller.move_tree(from_repo, from_parent_dir + '/' + from_ev.name,
+                                      to_repo, to_parent_dir + '/' + to_ev.name)
+
+    def _handle_polled_change(self, repo, local_abspath, dirs_changed):
+        """
+        :param onedrived.od_repo.OneDriveLocalRepository repo:
+        :param str local_abspath: Path of a polled dir found changed.
+        :param True | False dirs_changed: Whether or not sub-dirs were added or removed, which only a deep merge syncs.
+        """
+        logging.info('Polled local dir "%s" changed. Merge it.', local_abspath)
+        with self._lock:
+            self._add_merge_dir_task(repo, self._local_abspath_to_relpath(repo, local_abspath), deep_merge=dirs_changed)
+            self._submit_queued_tasks()
 
     def ensure_remote_path_is_dir(self, repo, rel_path):
         """
@@ -118,8 +218,8 @@ class LocalRepositoryWatcher:
 
     def _squash_tasks(self, repo, rel_path):
         for t in self.task_queue.copy():
-            if (isinstance(t, merge_dir.MergeDirectoryTask) or
-                    isinstance(t, delete_item.DeleteRemoteItemTask)) and t.repo is repo:
+            if isinstance(t, (merge_dir.MergeDirectoryTask, delete_item.DeleteRemoteItemTask,
+                              upload_tree.UploadTreeTask, rescan_dir.RescanLocalDirTask)) and t.repo is repo:
                 if t.rel_path == rel_path or rel_path.startswith(t.rel_path + '/'):
                     # A dir merge already exists, making this new task unnecessary.
                     raise ParentTaskExistsException(t)
@@ -249,7 +349,7 @@ class LocalRepositoryWatcher:
                                  to_parent_dir=None, to_parent_relpath=None):
 
         if to_parent_dir is None:
-            to_parent_dir = self.watch_descriptors[to_ev.wd]
+            _, to_parent_dir = self.watch_descriptors[to_ev.wd]
 
         if to_parent_relpath is None:
             to_parent_relpath = self._local_abspath_to_relpath(to_repo, to_parent_dir)
@@ -314,20 +414,106 @@ class LocalRepositoryWatcher:
                 return
 
         if _inotify_flags.ISDIR in to_flags:
-            self.task_queue.append(merge_dir.CreateFolderTask(
-                repo=to_repo, task_pool=self.task_pool, item_name=to_ev.name, parent_relpath=to_parent_relpath,
-                upload_if_success=True, abort_if_local_gone=True))
-            # After the directory is created, it will be merged and thus the watcher updated.
+            self._add_upload_tree_task(to_repo, to_parent_relpath, to_ev.name)
         else:
             to_dir_request = self._get_item_request_by_relpath(to_repo, to_parent_relpath)
             self.task_queue.append(upload_file.UploadFileTask(
                 repo=to_repo, task_pool=self.task_pool,
                 parent_dir_request=to_dir_request, parent_relpath=to_parent_relpath, item_name=to_ev.name))
 
+    def _hold_delete_event(self, ev, flags, repo, parent_dir):
+        """
+        "rm -rf" reports the deletion of every item under a dir, deepest first, before the deletion of the dir itself.
+        Hold delete events until deletes settle. Events under a dir that turns out deleted are then dropped, and the
+        delete of the topmost dir removes the whole remote tree at once.
+        """
+        now = time.time()
+        if self._pending_deletes_since is None:
+            self._pending_deletes_since = now
+        self._pending_deletes.setdefault(ev.wd, []).append((ev, flags, repo, parent_dir))
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        delay = min(self.DELETE_SETTLE_SEC, self._pending_deletes_since + self.MAX_DELETE_HOLD_SEC - now)
+        self._flush_handle = self.loop.call_later(max(delay, 0), self.flush_pending_deletes)
+
+    def _handle_dir_gone(self, ev):
+        """
+        :param inotify_simple.Event ev: A DELETE_SELF or IGNORED event.
+        """
+        pending = self._pending_deletes.pop(ev.wd, None)
+        if pending is not None:
+            logging.info('Dir "%s" was deleted. Its %d deleted children will be covered by its deletion.',
+                         pending[0][3], len(pending))
+        self.watch_descriptors.pop(ev.wd, None)
+
+    def flush_pending_deletes(self):
+        """Handle the held delete events that are not covered by the deletion of a parent dir."""
+        with self._lock:
+            self._flush_handle = None
+            pending, self._pending_deletes = self._pending_deletes, dict()
+            self._pending_deletes_since = None
+            for events in pending.values():
+                for ev, flags, repo, parent_dir in events:
+                    if os.path.lexists(parent_dir + '/' + ev.name):
+                        # Created again after deletion. Later events handle the new item.
+                        continue
+                    logging.info('Local path "%s/%s" was deleted on %s.', parent_dir, ev.name, str(ev))
+                    self._handle_unpaired_move_from(ev, flags, from_parent_dir=parent_dir, from_repo=repo)
+            self._submit_queued_tasks()
+
+    def _mark_dir_dirty(self, repo, parent_dir):
+        now = time.time()
+        key = (repo, self._local_abspath_to_relpath(repo, parent_dir))
+        self._dirty_dirs[key] = now
+        self._dirty_dirs.move_to_end(key)
+        while len(self._dirty_dirs) > 0:
+            (oldest_repo, _), t = next(iter(self._dirty_dirs.items()))
+            if now - t > self.DIRTY_DIR_WINDOW_SEC:
+                self._dirty_dirs.popitem(last=False)
+            elif len(self._dirty_dirs) > self.MAX_DIRTY_DIRS:
+                # Too many dirs are busy to track. Scan the whole repository if events are lost.
+                self._dirty_dirs.popitem(last=False)
+                self._dirty_dirs[(oldest_repo, '')] = now
+                self._dirty_dirs.move_to_end((oldest_repo, ''))
+            else:
+                break
+
+    def _handle_overflow(self):
+        """
+        The kernel dropped events because they were not read fast enough. Lost events most likely happened in the dirs
+        that were busy before the overflow, so scan them (or all watched trees if none was busy) for local changes.
+        """
+        now = time.time()
+        dirty_dirs = [k for k, t in self._dirty_dirs.items() if now - t <= self.DIRTY_DIR_WINDOW_SEC]
+        self._dirty_dirs.clear()
+        if len(dirty_dirs) == 0:
+            dirty_dirs = [(repo, '') for repo in self.watch_descriptors.repositories]
+        logging.warning('Inotify event queue overflowed. Rescan %d local dirs for lost events.', len(dirty_dirs))
+        for repo, rel_path in dirty_dirs:
+            try:
+                self._squash_tasks(repo, rel_path)
+                self.task_queue.append(rescan_dir.RescanLocalDirTask(repo, self.task_pool, rel_path))
+            except ParentTaskExistsException as e:
+                logging.info('Task on path "%s" will be covered by %s. Skip adding.', rel_path, e.task)
+
+    def _add_upload_tree_task(self, repo, parent_relpath, item_name):
+        item_relpath = parent_relpath + '/' + item_name
+        try:
+            self._squash_tasks(repo, item_relpath)
+            # The task watches the new dirs as it walks them.
+            self.task_queue.append(upload_tree.UploadTreeTask(
+                repo=repo, task_pool=self.task_pool, item_name=item_name, parent_relpath=parent_relpath))
+        except ParentTaskExistsException as e:
+            logging.info('Task on path "%s" will be covered by %s. Skip adding.', item_relpath, e.task)
+
     def _handle_file_creation(self, ev, repo, local_abspath, parent_dir):
         logging.info('Local path "%s" was updated on %s. Merge the parent directory.', local_abspath, str(ev))
-        if self.task_pool.has_pending_task(local_abspath) is None:
+        pending_task = self.task_pool.has_pending_task(local_abspath)
+        if pending_task is None:
             self.task_pool.release_path(local_abspath)
+        elif isinstance(pending_task, upload_file.UploadFileTask):
+            # The merge can't add an upload while one is in progress. The one in progress uploads the file again.
+            pending_task.mark_source_changed()
         self._add_merge_dir_task(repo, self._local_abspath_to_relpath(repo, parent_dir), deep_merge=False)
 
     def handle_event(self, ev, flags, move_pairs):
@@ -336,6 +522,16 @@ class LocalRepositoryWatcher:
         :param [inotify_simple.flags] flags:
         :param dict[int, [inotify_simple.Event, inotify_simple.flags]] move_pairs:
         """
+        if _inotify_flags.Q_OVERFLOW in flags:
+            return self._handle_overflow()
+
+        if _inotify_flags.DELETE_SELF in flags or _inotify_flags.IGNORED in flags:
+            return self._handle_dir_gone(ev)
+
+        if ev.wd not in self.watch_descriptors:
+            logging.debug('Dropped %s from a removed watch.', str(ev))
+            return
+
         repo, parent_dir = self.watch_descriptors[ev.wd]
 
         if repo is None:
@@ -349,13 +545,21 @@ class LocalRepositoryWatcher:
         if len(item_name):
             item_path += '/' + item_name
 
+        if event_isdir and _inotify_flags.MOVED_FROM in flags:
+            if ev.cookie in move_pairs:
+                self._move_watch(move_pairs[ev.cookie])
+            else:
+                # Moved out of the watched trees. The watches under it would report paths that no longer exist.
+                self.rm_watch_tree(repo, item_path)
+        elif event_isdir and _inotify_flags.DELETE in flags:
+            self.rm_watch(repo, item_path)
+
         if repo.path_filter.should_ignore(item_path, is_dir=event_isdir):
             logging.info('Ignored %s on path "%s" by path filter. Flags={%s}.',
                             str(ev), parent_dir + '/' + ev.name, ','.join([str(f) for f in flags]))
             return
 
-        if event_isdir and (_inotify_flags.MOVED_FROM in flags or _inotify_flags.DELETE in flags):
-            self.rm_watch(repo, parent_dir + '/' + ev.name)
+        self._mark_dir_dirty(repo, parent_dir)
 
         if ev.cookie in move_pairs:
             # Event is part of a move-from + move-to sequence. Handle the two events at move-to time.
@@ -374,7 +578,13 @@ class LocalRepositoryWatcher:
 
         if _inotify_flags.CREATE in flags:
             try:
-                if event_isdir or os.path.isdir(item_path):
+                parent_relpath = self._local_abspath_to_relpath(repo, parent_dir)
+                if event_isdir and not os.path.islink(item_path) and \
+                        repo.get_item_by_path(item_name, parent_relpath) is None:
+                    # A new tree, e.g., from "cp -r". Upload it without asking the server about every dir in it.
+                    logging.info('Local dir "%s" is new. Upload the tree under it.', item_path)
+                    self._add_upload_tree_task(repo, parent_relpath, item_name)
+                elif event_isdir or os.path.isdir(item_path):
                     # A new directory (or symlink to a directory) was created.
                     if self.ensure_remote_path_is_dir(
                             repo=repo, rel_path=self._local_abspath_to_relpath(repo, item_path)):
@@ -394,9 +604,7 @@ class LocalRepositoryWatcher:
             return self._handle_file_creation(ev, repo, item_path, parent_dir)
 
         if _inotify_flags.DELETE in flags:
-            logging.info('Local path "%s" was deleted on %s.', item_path, str(ev))
-            return self._handle_unpaired_move_from(ev, flags,
-                                                   from_parent_dir=parent_dir, from_parent_relpath=None, from_repo=repo)
+            return self._hold_delete_event(ev, flags, repo, parent_dir)
 
         logging.info('Unhandled inotify event %s on local path "%s". Flags: %s.',
                      str(ev), item_path, ','.join([str(f) for f in flags]))
@@ -428,19 +636,55 @@ class LocalRepositoryWatcher:
     def process_events(self):
         """
         When there is inotify events available, async loop schedules this function in MainThread. Also it seems that
-        async loop will not schedule it if this function is in the middle of execution.
-        :return:
+        async loop will not schedule it if this function is in the middle of execution. Events read are queued and
+        handled by process_queued_events.
+        """
+        self._event_queue.extend(self.notifier.read(timeout=0, read_delay=self.FD_READ_DELAY_MSEC))
+        logging.debug('Received inotify events. %d events are queued.', len(self._event_queue))
+        if self._is_reading and len(self._event_queue) >= self.MAX_QUEUED_EVENTS:
+            # Let the kernel hold new events. If they overflow its queue, the overflow is handled by rescans.
+            logging.warning('Too many inotify events are queued. Pause reading events.')
+            self.loop.remove_reader(self.notifier.fd)
+            self._is_reading = False
+        if self._plan_handle is None:
+            self._plan_handle = self.loop.call_soon(self.process_queued_events)
+
+    def process_queued_events(self):
+        """
+        Handle a batch of queued events, and schedule the next batch so that other callbacks of the loop run between.
+        """
+        self._plan_handle = None
+        events = []
+        while len(self._event_queue) > 0 and (len(events) < self.EVENT_BATCH_SIZE or
+                                              events[-1].mask & _inotify_flags.MOVED_FROM):
+            # Do not break a move pair apart.
+            events.append(self._event_queue.popleft())
+        self.handle_events(events)
+        if len(self._event_queue) > 0:
+            self._plan_handle = self.loop.call_soon(self.process_queued_events)
+        if not self._is_reading and len(self._event_queue) <= self.MAX_QUEUED_EVENTS // 2:
+            logging.info('Resume reading inotify events.')
+            self.loop.add_reader(self.notifier.fd, self.process_events)
+            self._is_reading = True
+
+    def handle_events(self, events):
+        """
+        :param [inotify_simple.Event] events:
         """
-        logging.debug('Received inotify events. Acquiring lock.')
         with self._lock:
-            events = self.notifier.read(timeout=0, read_delay=self.FD_READ_DELAY_MSEC)
             if len(events):
                 move_pairs, all_events = self._recognize_event_patterns(events)
                 logging.debug('Read the following events: %s.', all_events)
                 for ev, flags in all_events:
                     self.handle_event(ev, flags, move_pairs)
-                try:
-                    while True:
-                        self.task_pool.add_task(self.task_queue.pop())
-                except IndexError:
-                    pass
+                self._submit_queued_tasks()
+
+    def _submit_queued_tasks(self):
+        try:
+            while True:
+                task = self.task_queue.pop()
+                # Rescans after queue overflows may walk whole repositories, so they don't take the fast lane.
+                task.interactive = not isinstance(task, rescan_dir.RescanLocalDirTask)
+                self.task_pool.add_task(task)
+        except IndexError:
+            pass
@@ -16,6 +16,11 @@ def get_webhook_server(context):
     if context.config['webhook_type'] == 'direct':
         from .od_webhooks.http_server import WebhookConfig, WebhookListener
         wh_config = WebhookConfig(host=context.config['webhook_host'], port=context.config['webhook_port'])
+    elif context.config['webhook_type'] == 'direct_async':
+        from .od_webhooks.http_server import WebhookConfig
+        from .od_webhooks.async_server import WebhookListener
+        wh_config = WebhookConfig(host=context.config['webhook_host'], port=context.config['webhook_port'])
+        return WebhookListener(wh_config, context.loop)
     elif context.config['webhook_type'] == 'ngrok':
         from .od_webhooks.ngrok_server import WebhookConfig, WebhookListener
         ngrok_config_file = context.config_dir + '/' + context.DEFAULT_NGROK_CONF_FILENAME
@@ -55,6 +60,13 @@ class WebhookWorkerThread(threading.Thread):
     def queue_input(self, raw_bytes):
         self._raw_input_queue.put(raw_bytes, block=False)
 
+    def queue_subscription_ids(self, subscription_ids):
+        """
+        Queue subscription IDs of notifications that were already parsed by the listener.
+        :param set(str) subscription_ids:
+        """
+        self._raw_input_queue.put(frozenset(subscription_ids), block=False)
+
     def add_subscription(self, subscription, repo):
         """
         :param onedrivesdk.Subscription subscription:
@@ -74,6 +86,9 @@ class WebhookWorkerThread(threading.Thread):
 
     @staticmethod
     def parse_and_update_set(body, set_buffer):
+        if isinstance(body, frozenset):
+            set_buffer.update(body)
+            return
         subscription_ids = parse_notification_body(body)
         if subscription_ids is not None:
             set_buffer.update(subscription_ids)
@@ -135,5 +150,5 @@ class OneDriveWebhookHandler(http.server.BaseHTTPRequestHandler):
         self.send_header('Content-Type', 'text/plain')
         self.send_header('Content-Length', '0')
         self.end_headers()
-        logging.info(self.raw_requestline)
+        logging.debug(self.raw_requestline)
         self.server.worker_thread.queue_input(body)
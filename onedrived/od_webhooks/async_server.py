@@ -0,0 +1,216 @@
+"""
+async_server.py
+
+A webhook listener that directly accepts notifications from OneDrive server. It runs on the event loop of the daemon
+so that connections are served concurrently and kept alive, and a slow client does not block others.
+"""
+
+import asyncio
+import logging
+import socket
+import ssl
+import urllib.parse
+from http import HTTPStatus
+
+from . import http_server
+from ..od_webhook import parse_notification_body
+
+
+class WebhookProtocol(asyncio.Protocol):
+    """Serves HTTP/1.1 requests with Content-Length bodies on one connection."""
+
+    MAX_HEADER_BYTES = 16384
+    MAX_BODY_BYTES = 1048576
+    IDLE_TIMEOUT_SEC = 60
+
+    def __init__(self, listener):
+        """
+        :param WebhookListener listener:
+        """
+        self.listener = listener
+        self.transport = None
+        self._buffer = bytearray()
+        self._idle_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.listener.connections.add(self)
+        self._reset_idle_timer()
+
+    def connection_lost(self, exc):
+        self.listener.connections.discard(self)
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def data_received(self, data):
+        self._buffer.extend(data)
+        self._reset_idle_timer()
+        while not self.transport.is_closing() and self._handle_request():
+            pass
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def _reset_idle_timer(self):
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        self._idle_handle = self.listener.loop.call_later(self.IDLE_TIMEOUT_SEC, self.close)
+
+    def _handle_request(self):
+        """
+        :return True | False: Whether or not a complete request was consumed from the buffer.
+        """
+        header_end = self._buffer.find(b'\r\n\r\n')
+        if header_end < 0:
+            if len(self._buffer) > self.MAX_HEADER_BYTES:
+                self._respond(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, close=True)
+            return False
+        try:
+            request_line, *header_lines = self._buffer[:header_end].decode('latin-1').split('\r\n')
+            method, target, version = request_line.split(' ')
+            headers = dict()
+            for line in header_lines:
+                k, v = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            content_length = int(headers.get('content-length', 0))
+        except ValueError:
+            self._respond(HTTPStatus.BAD_REQUEST, close=True)
+            return False
+        if 'transfer-encoding' in headers:
+            self._respond(HTTPStatus.LENGTH_REQUIRED, close=True)
+            return False
+        if content_length < 0 or content_length > self.MAX_BODY_BYTES:
+            self._respond(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, close=True)
+            return False
+        body_start = header_end + 4
+        if len(self._buffer) < body_start + content_length:
+            return False
+        body = bytes(self._buffer[body_start:body_start + content_length])
+        del self._buffer[:body_start + content_length]
+        connection = headers.get('connection', '').lower()
+        keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+        status, content = self.listener.handle_request(method, target, body)
+        self._respond(status, content, close=not keep_alive)
+        return True
+
+    def _respond(self, status, content=b'', close=False):
+        lines = ['HTTP/1.1 %d %s' % (status.value, status.phrase),
+                 'Content-Type: text/plain',
+                 'Content-Length: %d' % len(content)]
+        if close:
+            lines.append('Connection: close')
+        self.transport.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + content)
+        if close:
+            self.transport.close()
+
+
+class WebhookListener:
+    """
+    Has the same interface as http_server.WebhookListener, but start() only schedules the server on the event loop.
+    Notifications are parsed on receipt, and subscription IDs received within FLUSH_DELAY_SEC are deduplicated before
+    they are handed to the webhook worker.
+    """
+
+    VALIDATION_REQUEST_QUERY = 'validationtoken'
+    FLUSH_DELAY_SEC = 1
+
+    def __init__(self, config, loop):
+        """
+        :param http_server.WebhookConfig config:
+        :param asyncio.AbstractEventLoop loop:
+        """
+        self.config = config
+        self.loop = loop
+        self.session_token = http_server.gen_random_token()
+        self.worker_thread = None
+        self.connections = set()
+        self._server = None
+        self._pending_subscription_ids = set()
+        if config.use_https:
+            self._ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self._ssl_context.load_cert_chain(certfile=config.https_certfile, keyfile=config.https_keyfile)
+        else:
+            self._ssl_context = None
+        # Bind now so that the port is known before the loop runs.
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('', config.port))
+        self._sock.listen(socket.SOMAXCONN)
+        self._sock.setblocking(False)
+        self.server_port = self._sock.getsockname()[1]
+
+    @property
+    def webhook_url(self):
+        if not hasattr(self, '_webhook_url'):
+            self.hostname = self.config.host if self.config.host != '' else http_server.resolve_public_ip()
+            self._webhook_url = '%s://%s:%d/%s' % (
+                'https' if self.config.use_https else 'http', self.hostname, self.server_port, self.session_token)
+        return self._webhook_url
+
+    def set_worker(self, worker):
+        self.worker_thread = worker
+
+    def start(self):
+        future = asyncio.ensure_future(
+            self.loop.create_server(lambda: WebhookProtocol(self), sock=self._sock, ssl=self._ssl_context),
+            loop=self.loop)
+        future.add_done_callback(self._on_server_created)
+
+    def _on_server_created(self, future):
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            logging.critical('Error starting webhook server: %s', future.exception())
+            return
+        self._server = future.result()
+        logging.info('Webhook server listening on %s.', self.webhook_url)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        else:
+            self._sock.close()
+        for conn in list(self.connections):
+            conn.close()
+        logging.info('Webhook server stopped.')
+
+    def join(self):
+        pass
+
+    def handle_request(self, method, target, body):
+        """
+        :param str method:
+        :param str target:
+        :param bytes body:
+        :return (http.HTTPStatus, bytes): Status and body of the response.
+        """
+        if method != 'POST':
+            return HTTPStatus.NOT_IMPLEMENTED, b''
+        url = urllib.parse.urlparse(target)
+        if url.path != '/' + self.session_token:
+            return HTTPStatus.UNAUTHORIZED, b''
+        query = urllib.parse.parse_qs(url.query)
+        if self.VALIDATION_REQUEST_QUERY in query and len(query) == 1:
+            return HTTPStatus.OK, query[self.VALIDATION_REQUEST_QUERY][0].encode('utf-8')
+        subscription_ids = parse_notification_body(body)
+        if subscription_ids is None:
+            return HTTPStatus.BAD_REQUEST, b''
+        self._add_subscription_ids(subscription_ids)
+        return HTTPStatus.OK, b''
+
+    def _add_subscription_ids(self, subscription_ids):
+        new_ids = set(subscription_ids) - self._pending_subscription_ids
+        if len(new_ids) == 0:
+            logging.debug('Dropped duplicate notification of subscriptions %s.', subscription_ids)
+            return
+        if len(self._pending_subscription_ids) == 0:
+            self.loop.call_later(self.FLUSH_DELAY_SEC, self._flush_subscription_ids)
+        self._pending_subscription_ids.update(new_ids)
+
+    def _flush_subscription_ids(self):
+        subscription_ids, self._pending_subscription_ids = self._pending_subscription_ids, set()
+        if self.worker_thread is not None:
+            self.worker_thread.queue_subscription_ids(subscription_ids)
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+
+from onedrived import od_cache
+from onedrived.od_hashutils import sha1_value
+
+
+class TestContentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = self.temp_dir.name + '/cache'
+        self.cache = od_cache.ContentCache(self.cache_dir, 100, os.getuid())
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _make_file(self, name, data):
+        path = self.temp_dir.name + '/' + name
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path, sha1_value(path)
+
+    def test_add_and_copy(self):
+        path, sha1_hash = self._make_file('a', b'a' * 10)
+        self.assertTrue(self.cache.add_file(path, sha1_hash.lower()))
+        self.assertIn(sha1_hash, self.cache)
+        self.assertEqual(10, self.cache.total_bytes)
+        dst_path = self.temp_dir.name + '/dst'
+        self.assertIsNotNone(self.cache.copy_file(sha1_hash, dst_path))
+        self.assertEqual(sha1_hash, sha1_value(dst_path))
+        self.assertIsNone(self.cache.copy_file('0' * 40, dst_path))
+
+    def test_evict_least_recently_used(self):
+        hashes = []
+        for name in ('a', 'b', 'c'):
+            path, sha1_hash = self._make_file(name, name.encode('utf-8') * 40)
+            self.cache.add_file(path, sha1_hash)
+            hashes.append(sha1_hash)
+            if name == 'b':
+                # Use "a" so that "b" becomes the least recently used.
+                self.cache.copy_file(hashes[0], self.temp_dir.name + '/dst')
+        self.assertIn(hashes[0], self.cache)
+        self.assertNotIn(hashes[1], self.cache)
+        self.assertIn(hashes[2], self.cache)
+        self.assertEqual(80, self.cache.total_bytes)
+        self.assertFalse(os.path.exists(self.cache_dir + '/' + hashes[1]))
+
+    def test_skip_large_file(self):
+        path, sha1_hash = self._make_file('a', b'a' * 101)
+        self.assertFalse(self.cache.add_file(path, sha1_hash))
+        self.assertEqual(0, self.cache.total_bytes)
+
+    def test_load(self):
+        path, sha1_hash = self._make_file('a', b'a' * 60)
+        self.cache.add_file(path, sha1_hash)
+        with open(self.cache_dir + '/x' + od_cache.ContentCache.TEMP_SUFFIX, 'wb') as f:
+            f.write(b'partial')
+        cache = od_cache.ContentCache(self.cache_dir, 100, os.getuid())
+        self.assertIn(sha1_hash, cache)
+        self.assertEqual(60, cache.total_bytes)
+        self.assertEqual([sha1_hash], os.listdir(self.cache_dir))
+        # A smaller budget evicts files on load.
+        cache = od_cache.ContentCache(self.cache_dir, 50, os.getuid())
+        self.assertNotIn(sha1_hash, cache)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+    def test_remove(self):
+        path, sha1_hash = self._make_file('a', b'a' * 10)
+        self.cache.add_file(path, sha1_hash)
+        self.cache.remove(sha1_hash)
+        self.cache.remove(sha1_hash)
+        self.assertNotIn(sha1_hash, self.cache)
+        self.assertEqual(0, self.cache.total_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
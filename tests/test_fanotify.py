@@ -0,0 +1,67 @@
+import os
+import struct
+import tempfile
+import unittest
+
+import inotify_simple
+
+from onedrived import od_fanotify
+
+
+def _make_event(mask, handle, name):
+    handle_type = 1
+    info = struct.pack('=iiIi', 0, 0, len(handle), handle_type) + handle + name.encode() + b'\0'
+    info += b'\0' * (-(len(info) + 4) % 4)
+    info = struct.pack('=BBH', od_fanotify.FAN_EVENT_INFO_TYPE_DFID_NAME, 0, len(info) + 4) + info
+    return struct.pack('=IBBHQii', 24 + len(info), 3, 0, 24, mask, od_fanotify.FAN_NOFD, 1) + info
+
+
+def _has_fanotify():
+    try:
+        od_fanotify.Fanotify().close()
+        return True
+    except OSError:
+        return False
+
+
+class TestFanotify(unittest.TestCase):
+
+    def test_parse_events(self):
+        data = _make_event(od_fanotify.FAN_CREATE | od_fanotify.FAN_ONDIR, b'\1\2\3\4', 'a') + \
+            _make_event(od_fanotify.FAN_DELETE_SELF, b'\5\6\7\10', '.') + \
+            struct.pack('=IBBHQii', 24, 3, 0, 24, od_fanotify.FAN_Q_OVERFLOW, od_fanotify.FAN_NOFD, 0)
+        self.assertEqual([(od_fanotify.FAN_CREATE | od_fanotify.FAN_ONDIR, struct.pack('=i', 1) + b'\1\2\3\4', 'a'),
+                          (od_fanotify.FAN_DELETE_SELF, struct.pack('=i', 1) + b'\5\6\7\10', ''),
+                          (od_fanotify.FAN_Q_OVERFLOW, None, '')],
+                         od_fanotify.parse_events(data))
+
+    @unittest.skipUnless(_has_fanotify(), 'fanotify with FAN_REPORT_DFID_NAME is not available.')
+    def test_read(self):
+        flags = inotify_simple.flags
+        with tempfile.TemporaryDirectory() as temp_dir:
+            notifier = od_fanotify.Fanotify()
+            try:
+                os.mkdir(temp_dir + '/a')
+                wd = notifier.add_watch(temp_dir, flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_FROM | flags.MOVED_TO)
+                sub_wd = notifier.add_watch(temp_dir + '/a', flags.CREATE)
+                with open(temp_dir + '/a/f', 'w') as f:
+                    f.write('f')
+                os.rename(temp_dir + '/a', temp_dir + '/b')
+                # A moved dir keeps its watch descriptor.
+                self.assertEqual(sub_wd, notifier.add_watch(temp_dir + '/b', flags.CREATE))
+                events = notifier.read(timeout=1000)
+                self.assertEqual([(sub_wd, flags.CREATE, 'f'), (sub_wd, flags.CLOSE_WRITE, 'f'),
+                                  (wd, flags.MOVED_FROM | flags.ISDIR, 'a'), (wd, flags.MOVED_TO | flags.ISDIR, 'b')],
+                                 [(ev.wd, ev.mask, ev.name) for ev in events])
+                self.assertNotEqual(0, events[2].cookie)
+                self.assertEqual(events[2].cookie, events[3].cookie)
+                notifier.rm_watch(sub_wd)
+                with open(temp_dir + '/b/g', 'w') as f:
+                    f.write('g')
+                self.assertEqual([], notifier.read(timeout=100))
+            finally:
+                notifier.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
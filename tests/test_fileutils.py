@@ -0,0 +1,96 @@
+import errno
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from onedrived import od_fileutils
+
+
+class TestFileUtils(unittest.TestCase):
+
+    DATA = b'Hello world!\n' * 1000
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.src_path = self.temp_dir.name + '/src'
+        self.dst_path = self.temp_dir.name + '/dst'
+        with open(self.src_path, 'wb') as f:
+            f.write(self.DATA)
+        with open(self.dst_path, 'wb') as f:
+            f.write(b'old data' * 2000)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def _check_copy(self, method, expected_method):
+        self.assertEqual(expected_method, method)
+        with open(self.dst_path, 'rb') as f:
+            self.assertEqual(self.DATA, f.read())
+
+    def test_clone_file(self):
+        method = od_fileutils.clone_file(self.src_path, self.dst_path)
+        self.assertIn(method, ('reflink', 'copy_file_range', 'copy'))
+        self._check_copy(method, method)
+
+    @mock.patch('onedrived.od_fileutils._clone', side_effect=OSError(errno.EOPNOTSUPP, 'Not supported'))
+    def test_copy_file_range(self, _):
+        if not hasattr(os, 'copy_file_range'):
+            self.skipTest('os.copy_file_range() is not available.')
+        self._check_copy(od_fileutils.clone_file(self.src_path, self.dst_path), 'copy_file_range')
+
+    @mock.patch('onedrived.od_fileutils._copy_file_range', side_effect=OSError(errno.EXDEV, 'Cross-device link'))
+    @mock.patch('onedrived.od_fileutils._clone', side_effect=OSError(errno.EXDEV, 'Cross-device link'))
+    def test_copy(self, *_):
+        self._check_copy(od_fileutils.clone_file(self.src_path, self.dst_path), 'copy')
+
+    @mock.patch('onedrived.od_fileutils._clone', side_effect=OSError(errno.EIO, 'I/O error'))
+    def test_error(self, _):
+        self.assertRaises(OSError, od_fileutils.clone_file, self.src_path, self.dst_path)
+
+    def test_iter_file_blocks(self):
+        blocks = []
+        buffers = set()
+        for block in od_fileutils.iter_file_blocks(self.src_path, block_size=4096):
+            blocks.append(bytes(block))
+            buffers.add(id(block.obj))
+        self.assertEqual(self.DATA, b''.join(blocks))
+        self.assertEqual([4096] * 3 + [len(self.DATA) - 3 * 4096], [len(b) for b in blocks])
+        # All blocks are read into one buffer, which is reused by the next read.
+        self.assertEqual(1, len(buffers))
+        it = od_fileutils.iter_file_blocks(self.dst_path, block_size=4096)
+        self.assertEqual(buffers.pop(), id(next(it).obj))
+        it.close()
+
+    def _check_open_for_writing(self, expected, **popen_kwargs):
+        proc = subprocess.Popen(('sleep', '30'), **popen_kwargs)
+        try:
+            # Wait until the child has replaced itself with sleep, and closed the files it doesn't keep.
+            for _ in range(100):
+                with open('/proc/%d/cmdline' % proc.pid, 'rb') as f:
+                    if f.read().startswith(b'sleep'):
+                        break
+                time.sleep(0.01)
+            self.assertEqual(expected, od_fileutils.is_open_for_writing(os.stat(self.src_path)))
+        finally:
+            proc.kill()
+            proc.wait()
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fdinfo'), 'Requires /proc.')
+    def test_is_open_for_writing(self):
+        self.assertFalse(od_fileutils.is_open_for_writing(os.stat(self.src_path)))
+        with open(self.src_path, 'ab') as f:
+            # Files opened by onedrived itself are not counted.
+            self.assertFalse(od_fileutils.is_open_for_writing(os.stat(self.src_path)))
+            self._check_open_for_writing(True, stdout=f)
+        with open(self.src_path, 'rb') as f:
+            self._check_open_for_writing(False, stdin=f)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -49,6 +49,37 @@ class TestHashUtils(unittest.TestCase):
             od_hashutils.hash_match(tmpname, self._mock_item()),
             'hash_match() should return False when SHA1 hash is missing.')
 
+    def test_quick_fingerprint(self):
+        with tempfile.NamedTemporaryFile() as f:
+            data = bytearray(b'\0' * (1 << 20))
+            f.write(data)
+            f.flush()
+            fingerprint = od_hashutils.quick_fingerprint(f.name, block_size=4096)
+            self.assertTrue(fingerprint.startswith('%d:' % len(data)))
+            # A change outside of the first, middle and last blocks is not found.
+            f.seek(4096)
+            f.write(b'\1')
+            f.flush()
+            self.assertEqual(fingerprint, od_hashutils.quick_fingerprint(f.name, block_size=4096))
+            f.seek(0)
+            f.write(b'\1')
+            f.flush()
+            self.assertNotEqual(fingerprint, od_hashutils.quick_fingerprint(f.name, block_size=4096))
+        self.assertNotEqual(od_hashutils.quick_fingerprint(self.TEST_FILES[0].name),
+                            od_hashutils.quick_fingerprint(self.TEST_FILES[1].name))
+
+    def test_hash_service(self):
+        hash_service = od_hashutils.HashService(2)
+        try:
+            paths = [f.name for f in self.TEST_FILES] + ['/foo/bar/baz/blah']
+            futures = hash_service.submit_batch(paths)
+            self.assertEqual(set(paths), set(futures.keys()))
+            for i, (data, sha1) in enumerate(self.TEST_CASES):
+                self.assertEqual(sha1, futures[self.TEST_FILES[i].name].result())
+            self.assertRaises(OSError, futures['/foo/bar/baz/blah'].result)
+        finally:
+            hash_service.shutdown()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,80 @@
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from onedrived import od_iosched
+
+
+class TestIOSched(unittest.TestCase):
+
+    def tearDown(self):
+        od_iosched.configure()
+        od_iosched.set_background(False)
+
+    def test_read_budget(self):
+        now = [100]
+        with mock.patch.object(od_iosched.time, 'monotonic', side_effect=lambda: now[0]):
+            budget = od_iosched.ReadBudget(1000)
+            self.assertEqual(0, budget.consume(1000))
+            self.assertEqual(0.5, budget.consume(500))
+            now[0] += 1
+            self.assertEqual(0, budget.consume(400))
+            # Idle time does not add more than one second of reads.
+            now[0] += 10
+            self.assertEqual(0, budget.consume(1000))
+            self.assertEqual(0.001, budget.consume(1))
+
+    @mock.patch.object(od_iosched.time, 'sleep')
+    def test_throttle_read(self, mock_sleep):
+        od_iosched.configure(read_bytes_per_sec=1000)
+        od_iosched.throttle_read(2000)
+        mock_sleep.assert_not_called()
+        od_iosched.set_background(True)
+        od_iosched.throttle_read(2000)
+        mock_sleep.assert_called_once_with(1)
+
+    @mock.patch.object(od_iosched, '_set_io_class')
+    def test_set_background(self, mock_set_io_class):
+        od_iosched.configure(io_class='idle')
+        self.assertFalse(od_iosched.is_background())
+        od_iosched.set_background(True)
+        od_iosched.set_background(True)
+        mock_set_io_class.assert_called_once_with(od_iosched.BACKGROUND_IO_CLASSES['idle'])
+        od_iosched.set_background(False)
+        mock_set_io_class.assert_called_with(od_iosched.IOPRIO_NORMAL)
+        od_iosched.configure(io_class='normal')
+        od_iosched.set_background(True)
+        self.assertEqual(2, mock_set_io_class.call_count)
+
+    def test_init_background_thread(self):
+        result = []
+
+        def run():
+            od_iosched.init_background_thread()
+            # Only the first call nices the thread.
+            od_iosched.init_background_thread()
+            result.append((od_iosched.is_background(), od_iosched.os.getpriority(
+                od_iosched.os.PRIO_PROCESS, od_iosched.get_thread_id())))
+
+        base_nice = od_iosched.os.getpriority(od_iosched.os.PRIO_PROCESS, od_iosched.get_thread_id())
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertEqual([(True, min(base_nice + 10, 19))], result)
+        # Other threads are not affected.
+        self.assertFalse(od_iosched.is_background())
+        self.assertEqual(base_nice, od_iosched.os.getpriority(od_iosched.os.PRIO_PROCESS, od_iosched.get_thread_id()))
+
+    def test_get_thread_id(self):
+        tid = od_iosched.get_thread_id()
+        self.assertIsNotNone(tid)
+        # Without threading.get_native_id() of Python 3.8, the ID comes from the gettid syscall.
+        with mock.patch.object(od_iosched, 'threading', spec=['local']):
+            self.assertEqual(tid, od_iosched.get_thread_id())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import onedrivesdk
+
+from onedrived import get_resource, od_lansync
+from onedrived.od_api_helper import get_item_modified_datetime
+from onedrived.od_dateutils import datetime_to_timestamp
+from tests.test_repo import get_sample_repo
+
+
+class TestLanSync(unittest.TestCase):
+
+    DATA = b'Hello world!\n'
+    SECRET = 'secret'
+
+    def setUp(self):
+        self.temp_config_dir, self.temp_repo_dir, _, self.repo = get_sample_repo()
+        item_data = json.loads(get_resource('data/folder_child_item.json', pkg_name='tests'))
+        item_data['size'] = len(self.DATA)
+        item_data['file']['hashes']['sha1Hash'] = self.sha1_hash = hashlib.sha1(self.DATA).hexdigest().upper()
+        item = onedrivesdk.Item(item_data)
+        os.mkdir(self.repo.local_root + '/Public')
+        with open(self.repo.local_root + '/Public/' + item.name, 'wb') as f:
+            f.write(self.DATA)
+        os.utime(self.repo.local_root + '/Public/' + item.name,
+                 (0, datetime_to_timestamp(get_item_modified_datetime(item)[0])))
+        self.repo.update_item(item, '/Public', len(self.DATA))
+        server_context = mock.MagicMock(repositories=[self.repo], content_cache=None)
+        self.server = od_lansync.LanSync(server_context, self.SECRET)
+        self.server.start()
+        self.client = od_lansync.LanSync(mock.MagicMock(repositories=[], content_cache=None), self.SECRET,
+                                         static_peers=[('127.0.0.1', self.server.server_port)])
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dst_path = self.temp_dir.name + '/dst'
+
+    def tearDown(self):
+        self.server.stop()
+        self.client.stop()
+        self.temp_dir.cleanup()
+        self.temp_config_dir.cleanup()
+        self.temp_repo_dir.cleanup()
+
+    def test_sign(self):
+        now = int(time.time())
+        signature = od_lansync.sign(self.SECRET, now, 'GET', '/')
+        self.assertTrue(od_lansync.verify(self.SECRET, signature, now, 'GET', '/'))
+        self.assertFalse(od_lansync.verify(self.SECRET, signature, now, 'GET', '/a'))
+        self.assertFalse(od_lansync.verify('other', signature, now, 'GET', '/'))
+        old = now - od_lansync.MAX_CLOCK_SKEW_SEC - 10
+        self.assertFalse(od_lansync.verify(self.SECRET, od_lansync.sign(self.SECRET, old, 'GET', '/'), old, 'GET', '/'))
+
+    def test_parse_peer_list(self):
+        self.assertEqual([('127.0.0.1', 7001), ('host', 7002)],
+                         od_lansync.parse_peer_list('127.0.0.1:7001, host:7002,'))
+        self.assertEqual([], od_lansync.parse_peer_list(''))
+
+    def test_query(self):
+        peer = ('127.0.0.1', self.server.server_port)
+        self.assertEqual(200, self.client._request('HEAD', peer, self.sha1_hash, len(self.DATA)).status_code)
+        self.assertEqual(404, self.client._request('HEAD', peer, '0' * 40, len(self.DATA)).status_code)
+        self.client.secret = 'other'
+        self.assertEqual(403, self.client._request('HEAD', peer, self.sha1_hash, len(self.DATA)).status_code)
+
+    def test_fetch_file(self):
+        self.assertEqual(('127.0.0.1', self.server.server_port),
+                         self.client.fetch_file(self.sha1_hash, len(self.DATA), self.dst_path))
+        with open(self.dst_path, 'rb') as f:
+            self.assertEqual(self.DATA, f.read())
+        self.assertIsNone(self.client.fetch_file('0' * 40, len(self.DATA), self.dst_path))
+
+    def test_fetch_changed_file(self):
+        with open(self.repo.local_root + '/Public/' + self.repo.get_items_by_hash(
+                self.sha1_hash, len(self.DATA))[0].item_name, 'ab') as f:
+            f.write(b'changed')
+        self.assertIsNone(self.client.fetch_file(self.sha1_hash, len(self.DATA), self.dst_path))
+
+    def test_handle_announcement(self):
+        self.assertTrue(self.client.handle_announcement(self.server.gen_announcement(), '10.0.0.2'))
+        self.assertIn(('10.0.0.2', self.server.server_port), self.client.peers)
+        self.assertFalse(self.client.handle_announcement(self.client.gen_announcement(), '10.0.0.1'))
+        self.assertFalse(self.client.handle_announcement(b'not json', '10.0.0.3'))
+        self.server.secret = 'other'
+        self.assertFalse(self.client.handle_announcement(self.server.gen_announcement(), '10.0.0.4'))
+        self.assertEqual(2, len(self.client.peers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,17 @@
+import os
 import tempfile
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import click
 
-from onedrived import od_main
+from onedrived import od_main, od_task
+from onedrived.od_tasks.start_repo import StartRepositoryTask
+
+from tests.test_repo import get_sample_repo
 
 
 class TestMainCLI(unittest.TestCase):
@@ -21,6 +29,38 @@ class TestMainCLI(unittest.TestCase):
         od_main.init_task_pool_and_workers()
         od_main.shutdown_workers()
 
+    def test_gen_start_repo_tasks_with_journal(self):
+        temp_config_dir, temp_repo_dir, _, repo = get_sample_repo()
+        self.addCleanup(temp_config_dir.cleanup)
+        self.addCleanup(temp_repo_dir.cleanup)
+        # Tasks left by last session are replayed from task journal.
+        for rel_path in ('/foo', '/bar', '/baz'):
+            repo.add_journal_entry('upload', rel_path, in_memory=False)
+        od_main.task_pool = od_task.TaskPool()
+        od_main.task_pool.set_journal(repo, max_tasks_in_memory=10)
+        self.assertEqual(3, od_main.task_pool.outstanding_task_count)
+        od_main.context.loop = mock.MagicMock()
+        with mock.patch.object(od_main, 'webhook_server', None):
+            od_main.gen_start_repo_tasks({repo.account_id: [repo]})
+        self.assertIsInstance(od_main.task_pool.has_pending_task(repo.local_root), StartRepositoryTask)
+        # Without webhook, the Drive is synced again later.
+        od_main.context.loop.call_later.assert_called_once_with(
+            od_main.context.config['scan_interval_sec'], od_main.gen_start_repo_tasks, {repo.account_id: [repo]})
+
+    def test_delete_temp_files(self):
+        temp_config_dir, temp_repo_dir, _, repo = get_sample_repo()
+        self.addCleanup(temp_config_dir.cleanup)
+        self.addCleanup(temp_repo_dir.cleanup)
+        os.mkdir(repo.local_root + '/foo')
+        temp_file_path = repo.local_root + '/foo/' + repo.path_filter.get_temp_name('bar')
+        with open(temp_file_path, 'w') as f:
+            f.write('partial')
+        # Even if the Drive will only merge what changed since last session.
+        repo.was_shut_down_cleanly = True
+        od_main.delete_temp_files({repo.account_id: [repo]})
+        self.assertFalse(os.path.exists(temp_file_path))
+        self.assertTrue(os.path.isdir(repo.local_root + '/foo'))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,6 +2,10 @@ import json
 import os
 import sys
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import onedrivesdk
 
@@ -65,6 +69,23 @@ class TestPathFilter(unittest.TestCase):
         ]
         self.assert_cases(cases)
 
+    def test_app_temp_files(self):
+        self.assertFalse(self.filter.should_ignore('/Videos/movie.mp4.part'))
+        # They are ignored by the default ignore list, where users can edit the rules.
+        self.filter = od_models.path_filter.PathFilter(
+            get_resource('data/ignore_v2.txt', pkg_name='onedrived').splitlines())
+        cases = [
+            ('/Docs/~$port.docx', False, True),
+            ('/Docs/~WRL0001.tmp', False, True),
+            ('/Docs/report.tmp', False, False),
+            ('/Videos/movie.mp4.part', False, True),
+            ('/Videos/movie.mp4.crdownload', False, True),
+            ('/Videos/movie.mp4.!qB', False, True),
+            ('/VMs/disk.vmdk.lck', True, True),
+            ('/Docs/party.txt', False, False)
+        ]
+        self.assert_cases(cases)
+
     def test_ignore_in_root(self):
         # The following rules also test dir-only ignores.
         cases = [
@@ -186,5 +207,39 @@ class TestBidict(unittest.TestCase):
         self.assertEqual(key, popped_key)
 
 
+class TestWatchTree(unittest.TestCase):
+
+    def setUp(self):
+        self.repo = mock.MagicMock(local_root='/repo')
+        self.tree = od_models.watch_tree.WatchTree()
+        for wd, rel_path in ((1, ''), (2, '/a'), (3, '/a/b'), (4, '/a/b/c'), (5, '/d')):
+            self.tree[wd] = (self.repo, self.repo.local_root + rel_path)
+
+    def test_lookup(self):
+        self.assertEqual((self.repo, '/repo/a/b'), self.tree[3])
+        self.assertEqual(4, self.tree.find(self.repo, '/repo/a/b/c'))
+        self.assertIsNone(self.tree.find(self.repo, '/repo/x'))
+        self.assertEqual(5, len(self.tree))
+
+    def test_move(self):
+        self.assertTrue(self.tree.move(self.repo, '/repo/a/b', self.repo, '/repo/d/e'))
+        self.assertEqual((self.repo, '/repo/d/e'), self.tree[3])
+        self.assertEqual((self.repo, '/repo/d/e/c'), self.tree[4])
+        self.assertIsNone(self.tree.find(self.repo, '/repo/a/b'))
+        self.assertFalse(self.tree.move(self.repo, '/repo/a/b', self.repo, '/repo/x'))
+
+    def test_move_by_reused_wd(self):
+        self.tree[2] = (self.repo, '/repo/x/y')
+        self.assertEqual((self.repo, '/repo/x/y/b/c'), self.tree[4])
+
+    def test_pop(self):
+        self.assertEqual((self.repo, '/repo/a/b'), self.tree.pop(3))
+        self.assertEqual((self.repo, '/repo/a/b/c'), self.tree[4])
+        self.assertIsNone(self.tree.pop(3, None))
+        self.assertEqual(4, self.tree.pop_path(self.repo, '/repo/a/b/c'))
+        self.assertEqual([2], sorted(self.tree.pop_subtree(self.repo, '/repo/a')))
+        self.assertEqual([1, 5], sorted(self.tree.keys()))
+
+
 if __name__ == '__main__':
     unittest.main()
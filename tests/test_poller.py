@@ -0,0 +1,82 @@
+import os
+import tempfile
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from onedrived import od_poller
+
+
+class TestDirPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.repo = mock.MagicMock()
+        self.callback = mock.MagicMock()
+        self.poller = od_poller.DirPoller(mock.MagicMock(), self.callback)
+        self.now = 1000
+        self.time_patch = mock.patch.object(od_poller.time, 'monotonic', side_effect=lambda: self.now)
+        self.time_patch.start()
+        self.path = self.temp_dir.name + '/a'
+        os.mkdir(self.path)
+        with open(self.path + '/f', 'w') as f:
+            f.write('f')
+
+    def tearDown(self):
+        self.time_patch.stop()
+        self.poller.close()
+        self.temp_dir.cleanup()
+
+    def _poll_after(self, sec):
+        self.now += sec
+        self.callback.reset_mock()
+        self.poller.poll()
+
+    def test_poll(self):
+        self.poller.add_dir(self.repo, self.path)
+        self.assertIn((self.repo, self.path), self.poller)
+        self._poll_after(self.poller.MIN_INTERVAL_SEC)
+        self.callback.assert_not_called()
+        # An unchanged dir is checked less often.
+        os.utime(self.path + '/f', (0, 0))
+        self._poll_after(self.poller.MIN_INTERVAL_SEC)
+        self.callback.assert_not_called()
+        self._poll_after(self.poller.MIN_INTERVAL_SEC)
+        self.callback.assert_called_once_with(self.repo, self.path, False)
+        os.mkdir(self.path + '/sub')
+        self._poll_after(self.poller.MIN_INTERVAL_SEC)
+        self.callback.assert_called_once_with(self.repo, self.path, True)
+        os.rmdir(self.path + '/sub')
+        os.remove(self.path + '/f')
+        os.rmdir(self.path)
+        self._poll_after(self.poller.MIN_INTERVAL_SEC)
+        self.callback.assert_not_called()
+        self.assertEqual(0, len(self.poller))
+
+    def test_max_dirs_per_cycle(self):
+        self.poller.MAX_DIRS_PER_CYCLE = 1
+        os.mkdir(self.path + '/sub')
+        self.poller.add_dir(self.repo, self.path)
+        self.poller.add_dir(self.repo, self.path + '/sub')
+        for p in (self.path, self.path + '/sub'):
+            with open(p + '/new', 'w') as f:
+                f.write('new')
+        self._poll_after(self.poller.MIN_INTERVAL_SEC)
+        self.callback.assert_called_once_with(self.repo, self.path, False)
+        self._poll_after(0)
+        self.callback.assert_called_once_with(self.repo, self.path + '/sub', False)
+
+    def test_move_and_remove_tree(self):
+        os.mkdir(self.path + '/sub')
+        self.poller.add_dir(self.repo, self.path + '/sub')
+        self.poller.move_tree(self.repo, self.path, self.repo, self.temp_dir.name + '/b')
+        self.assertIn((self.repo, self.temp_dir.name + '/b/sub'), self.poller)
+        self.assertNotIn((self.repo, self.path + '/sub'), self.poller)
+        self.poller.remove_tree(self.repo, self.temp_dir.name + '/b')
+        self.assertEqual(0, len(self.poller))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
 import json
+import os
 import tempfile
 import unittest
 try:
@@ -8,7 +9,7 @@ except ImportError:
 
 import onedrivesdk
 
-from onedrived import od_context, od_repo, od_api_helper, get_resource
+from onedrived import od_context, od_hashutils, od_repo, od_api_helper, get_resource
 from tests.test_auth import get_sample_authenticator
 from tests.test_models import get_sample_drive, get_sample_drive_config
 
@@ -19,7 +20,8 @@ def get_sample_repo():
     ctx = mock.MagicMock(spec=od_context.UserContext,
                          config=od_context.UserContext.DEFAULT_CONFIG,
                          config_dir=temp_config_dir.name,
-                         host_name='hostname', loop=None)
+                         host_name='hostname', loop=None, content_cache=None,
+                         lan_sync=None, hash_service=None)
     auth = get_sample_authenticator()
     drive = get_sample_drive()
     drive_dict, drive_config = get_sample_drive_config()
@@ -136,6 +138,138 @@ class TestOneDriveLocalRepository(unittest.TestCase):
         self._check_immediate_children('/' + self.root_folder_item.name,
                                        (self.root_child_item, self.root_subfolder_item))
 
+    def test_get_item_by_id(self):
+        self._check_item_props(self.root_child_item, self.repo.get_item_by_id(self.root_child_item.id))
+        self.assertIsNone(self.repo.get_item_by_id('nonexistent_id'))
+
+    def test_get_item_by_inode(self):
+        self.assertIsNone(self.repo.get_item_by_path(self.image_item.name, '').inode)
+        with open(self.repo.local_root + '/' + self.image_item.name, 'w') as f:
+            f.write('image')
+        self.repo.update_item(self.image_item, '', 5)
+        stat = os.stat(self.repo.local_root + '/' + self.image_item.name)
+        self._check_item_props(self.image_item, self.repo.get_item_by_inode(stat.st_ino, stat.st_dev))
+        self.assertIsNone(self.repo.get_item_by_inode(stat.st_ino, stat.st_dev + 1))
+
+    def test_fingerprint(self):
+        self.assertIsNone(self.repo.get_item_by_path(self.image_item.name, '').fingerprint)
+        local_path = self.repo.local_root + '/' + self.image_item.name
+        with open(local_path, 'w') as f:
+            f.write('image')
+        self.repo.update_item(self.image_item, '', 5)
+        self.assertEqual(od_hashutils.quick_fingerprint(local_path),
+                         self.repo.get_item_by_path(self.image_item.name, '').fingerprint)
+        # The local file does not have the content of the item.
+        self.repo.update_item(self.image_item, '', 6)
+        self.assertIsNone(self.repo.get_item_by_path(self.image_item.name, '').fingerprint)
+
+    def test_upgrade_item_store(self):
+        with self.repo._conn:
+            self.repo._conn.execute('DROP TABLE items')
+            self.repo._conn.execute('CREATE TABLE items (id TEXT, type INT, name TEXT, parent_id TEXT, '
+                                    'parent_path TEXT, etag TEXT, ctag TEXT, size INT, size_local INT, '
+                                    'created_time TEXT, modified_time TEXT, status INT, sha1_hash TEXT, '
+                                    'record_time TEXT, PRIMARY KEY (parent_path, name) ON CONFLICT REPLACE)')
+        self.repo.close()
+        self.repo._init_item_store()
+        self._add_all_items()
+        self.test_add_get_items()
+
+    def test_get_items_by_hash(self):
+        sha1_hash = self.root_child_item.file.hashes.sha1_hash
+        records = self.repo.get_items_by_hash(sha1_hash, self.root_child_item.size)
+        self.assertEqual([self.root_child_item.id], [r.item_id for r in records])
+        self.assertEqual([], self.repo.get_items_by_hash(sha1_hash, self.root_child_item.size + 1))
+
+    def test_state(self):
+        key = od_repo.RepositoryStateKey.DELTA_TOKEN
+        self.assertIsNone(self.repo.get_state(key))
+        self.repo.set_state(key, 'foo')
+        self.repo.set_state(key, 'bar')
+        self.assertEqual('bar', self.repo.get_state(key))
+        self.repo.set_state(key, None)
+        self.assertEqual('baz', self.repo.get_state(key, 'baz'))
+
+    def test_clean_shutdown_marker(self):
+        self.assertFalse(self.repo.was_shut_down_cleanly)
+        self.repo.mark_clean_shutdown()
+        self.repo._init_shutdown_marker()
+        self.assertTrue(self.repo.was_shut_down_cleanly)
+        # The marker is consumed when the repository is opened.
+        self.repo._init_shutdown_marker()
+        self.assertFalse(self.repo.was_shut_down_cleanly)
+        self.repo.mark_task_failed()
+        self.assertFalse(self.repo.mark_clean_shutdown())
+        self.repo._init_shutdown_marker()
+        self.assertFalse(self.repo.was_shut_down_cleanly)
+
+    def test_journal_consistent_marker(self):
+        self.assertFalse(self.repo.is_journal_consistent)
+        self.repo.mark_journal_consistent()
+        self.repo._init_shutdown_marker()
+        self.assertTrue(self.repo.is_journal_consistent)
+        # Unlike the clean shutdown marker, the marker is kept after the repository is opened.
+        self.repo._init_shutdown_marker()
+        self.assertTrue(self.repo.is_journal_consistent)
+        self.repo.mark_task_failed()
+        self.repo.mark_journal_consistent()
+        self.repo._init_shutdown_marker()
+        self.assertFalse(self.repo.is_journal_consistent)
+
+    def test_task_journal(self):
+        seq1 = self.repo.add_journal_entry('upload', '/foo/a', in_memory=False)
+        seq2 = self.repo.add_journal_entry('delete', '/foo/b', 'id_b', args='{"is_folder": false}', in_memory=False)
+        self.repo.add_journal_entry('upload', '/bar', in_memory=False)
+        self.repo.add_journal_entry('upload', '/baz', in_memory=True)
+        self.assertEqual(3, self.repo.count_journal_entries_on_disk())
+        self.assertTrue(self.repo.has_journal_entry_on_disk('/foo/a'))
+        self.assertFalse(self.repo.has_journal_entry_on_disk('/baz'))
+        self.assertEqual([od_repo.TaskJournalEntry(seq1, 'upload', '/foo/a', None, None, None),
+                          od_repo.TaskJournalEntry(seq2, 'delete', '/foo/b', 'id_b', None, '{"is_folder": false}')],
+                         self.repo.load_journal_entries(2))
+        self.assertFalse(self.repo.has_journal_entry_on_disk('/foo/a'))
+        self.assertEqual(1, self.repo.count_journal_entries_on_disk())
+        self.repo.delete_journal_entry(seq1)
+        self.assertEqual(1, self.repo.delete_journal_entries_under('/bar'))
+        self.assertEqual(0, self.repo.count_journal_entries_on_disk())
+        self.repo.delete_journal_entries([seq2])
+        self.assertEqual([('/baz',)], self.repo._conn.execute('SELECT rel_path FROM task_journal').fetchall())
+        self.assertEqual('wal', self.repo._conn.execute('PRAGMA journal_mode').fetchone()[0])
+
+    def test_dir_snapshots(self):
+        self.repo.update_dir_snapshot('', 1)
+        self.repo.update_dir_snapshot('/Public', 2)
+        self.repo.update_dir_snapshot('/Public/foo', 3)
+        self.repo.update_dir_snapshot('/Public/foo', 4)
+        self.repo.move_item(item_name=self.root_folder_item.name, parent_relpath='',
+                            new_name='Public2', new_parent_relpath='', is_folder=True)
+        self.assertEqual({'': 1, '/Public2': 2, '/Public2/foo': 4}, self.repo.get_dir_snapshots())
+        self.repo.delete_item(item_name='Public2', parent_relpath='', is_folder=True)
+        self.assertEqual({'': 1}, self.repo.get_dir_snapshots())
+
+    def test_has_other_file_of_size(self):
+        item = self.root_child_item
+        self.assertFalse(self.repo.has_other_file_of_size(item.size, item.name, '/Public'))
+        self.assertTrue(self.repo.has_other_file_of_size(item.size, 'copy', '/Public'))
+        self.assertFalse(self.repo.has_other_file_of_size(item.size + 1, 'copy', '/Public'))
+
+    def test_invalidate_dirs_of_failed_task(self):
+        for rel_path in ('', '/Public', '/Other'):
+            self.repo.update_dir_snapshot(rel_path, 1)
+        self.repo.mark_task_failed(self.repo.local_root + '/Public/' + self.root_child_item.name)
+        self.assertEqual({'/Other': 1}, self.repo.get_dir_snapshots())
+        record = self.repo.get_item_by_path(self.root_folder_item.name, '')
+        self.assertIsNone(record.c_tag)
+        self.assertIsNone(record.e_tag)
+        # Records of files keep their tags.
+        self.assertEqual(self.root_child_item.c_tag, self.repo.get_item_by_id(self.root_child_item.id).c_tag)
+
+    def test_needs_recovery(self):
+        self.assertTrue(self.repo.needs_recovery)
+        self.repo.mark_journal_consistent()
+        self.repo._init_shutdown_marker()
+        self.assertFalse(self.repo.needs_recovery)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -2,12 +2,16 @@ import unittest
 
 from onedrived import od_task
 from onedrived.od_tasks.base import TaskBase
+from onedrived.od_tasks.delete_item import DeleteRemoteItemTask
+from onedrived.od_tasks.start_repo import StartRepositoryTask
+
+from tests.test_repo import get_sample_repo
 
 
 class TestTaskPool(unittest.TestCase):
 
-    def _get_dummy_task(self, local_abspath=None):
-        t = TaskBase(repo=None, task_pool=self.task_pool)
+    def _get_dummy_task(self, local_abspath=None, repo=None):
+        t = TaskBase(repo=repo, task_pool=self.task_pool)
         t.local_abspath = local_abspath
         return t
 
@@ -54,6 +58,115 @@ class TestTaskPool(unittest.TestCase):
         self.assertEqual('/foo2', self.task_pool.pop_task().local_abspath)
         self.assertEqual('/foo2/bar', self.task_pool.pop_task().local_abspath)
 
+    def test_round_robin_across_repos(self):
+        for i in range(3):
+            self.task_pool.add_task(self._get_dummy_task(local_abspath='/a/%d' % i, repo='a'))
+        self.task_pool.add_task(self._get_dummy_task(local_abspath='/b/0', repo='b'))
+        self.task_pool.add_task(self._get_dummy_task(local_abspath='/c/0', repo='c'))
+        self.assertEqual(['/a/0', '/b/0', '/c/0', '/a/1', '/a/2'],
+                         [self.task_pool.pop_task().local_abspath for _ in range(5)])
+        self.assertIsNone(self.task_pool.pop_task())
+
+    def test_priority(self):
+        self.task_pool.set_schedule('a', priority=2)
+        for i in range(4):
+            self.task_pool.add_task(self._get_dummy_task(local_abspath='/a/%d' % i, repo='a'))
+            self.task_pool.add_task(self._get_dummy_task(local_abspath='/b/%d' % i, repo='b'))
+        self.assertEqual(['/a/0', '/a/1', '/b/0', '/a/2', '/a/3', '/b/1', '/b/2', '/b/3'],
+                         [self.task_pool.pop_task().local_abspath for _ in range(8)])
+
+    def test_max_concurrent_tasks(self):
+        self.task_pool.set_schedule('a', max_concurrent_tasks=1)
+        for i in range(2):
+            self.task_pool.add_task(self._get_dummy_task(local_abspath='/a/%d' % i, repo='a'))
+        for _ in range(2):
+            self.task_pool.semaphore.acquire()
+        task = self.task_pool.pop_task()
+        self.assertEqual('/a/0', task.local_abspath)
+        # The other task has to wait until the running one is done.
+        self.assertIsNone(self.task_pool.pop_task())
+        self.assertEqual(1, self.task_pool.outstanding_task_count)
+        self.assertFalse(self.task_pool.semaphore.acquire(blocking=False))
+        self.task_pool.task_done(task)
+        self.assertTrue(self.task_pool.semaphore.acquire(blocking=False))
+        self.assertEqual('/a/1', self.task_pool.pop_task().local_abspath)
+
+    def test_fast_lane(self):
+        self.task_pool.set_schedule('b', max_concurrent_tasks=1)
+        for i in range(2):
+            self.task_pool.add_task(self._get_dummy_task(local_abspath='/a/%d' % i, repo='a'))
+        for path, repo in (('/b/0', 'b'), ('/b/1', 'b'), ('/a/2', 'a')):
+            task = self._get_dummy_task(local_abspath=path, repo=repo)
+            task.interactive = True
+            self.task_pool.add_task(task)
+        # Repo "b" is capped after its first task, so the rest of its tasks wait.
+        self.assertEqual(['/b/0', '/a/2', '/a/0', '/a/1'],
+                         [self.task_pool.pop_task().local_abspath for _ in range(4)])
+        self.assertEqual(1, self.task_pool.outstanding_task_count)
+        self.task_pool.remove_children_tasks('/b')
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+
+
+class TestTaskPoolJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.task_pool = od_task.TaskPool()
+        self.temp_config_dir, self.temp_repo_dir, self.drive_config, self.repo = get_sample_repo()
+        self.task_pool.set_journal(self.repo, max_tasks_in_memory=2)
+
+    def tearDown(self):
+        self.temp_config_dir.cleanup()
+        self.temp_repo_dir.cleanup()
+
+    def _get_delete_task(self, item_name):
+        return DeleteRemoteItemTask(self.repo, self.task_pool, '', item_name, item_id='id_' + item_name)
+
+    def test_bounded_window(self):
+        for name in ('a', 'b', 'c', 'd'):
+            self.assertTrue(self.task_pool.add_task(self._get_delete_task(name)))
+        # Tasks which are not journaled are always kept in memory.
+        self.assertTrue(self.task_pool.add_task(StartRepositoryTask(self.repo, self.task_pool)))
+        self.assertEqual(5, self.task_pool.outstanding_task_count)
+        self.assertEqual(2, self.repo.count_journal_entries_on_disk())
+        self.assertEqual(3, len(self.task_pool.tasks_by_path))
+        # A task on a path which waits on disk is a duplicate.
+        self.assertFalse(self.task_pool.add_task(self._get_delete_task('c')))
+        tasks = []
+        for _ in range(5):
+            tasks.append(self.task_pool.pop_task())
+        self.assertEqual(['/a', '/b', None, '/c', '/d'], [getattr(t, 'rel_path', None) for t in tasks])
+        self.assertIsInstance(tasks[2], StartRepositoryTask)
+        self.assertEqual('id_c', tasks[3].item_id)
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+        for t in tasks:
+            self.task_pool.task_done(t)
+        self.assertEqual([], self.repo.load_journal_entries(10))
+
+    def test_replay(self):
+        for name in ('a', 'b', 'c'):
+            self.task_pool.add_task(self._get_delete_task(name))
+        self.task_pool.task_done(self.task_pool.pop_task())
+        # Simulate a restart.
+        self.repo._conn.execute('UPDATE task_journal SET in_memory=0')
+        task_pool = od_task.TaskPool()
+        task_pool.set_journal(self.repo, max_tasks_in_memory=2)
+        self.assertEqual(2, task_pool.outstanding_task_count)
+        for name in ('b', 'c'):
+            self.assertTrue(task_pool.semaphore.acquire(blocking=False))
+            task = task_pool.pop_task()
+            self.assertIsInstance(task, DeleteRemoteItemTask)
+            self.assertEqual('/' + name, task.rel_path)
+            self.assertIs(task_pool, task.task_pool)
+
+    def test_remove_children_tasks(self):
+        for name in ('a', 'b', 'c'):
+            self.task_pool.add_task(DeleteRemoteItemTask(self.repo, self.task_pool, '/foo', name))
+        self.task_pool.add_task(self._get_delete_task('bar'))
+        self.task_pool.remove_children_tasks(self.repo.local_root + '/foo')
+        self.assertEqual(1, self.task_pool.outstanding_task_count)
+        self.assertEqual('/bar', self.task_pool.pop_task().rel_path)
+        self.assertEqual([('/bar',)], self.repo._conn.execute('SELECT rel_path FROM task_journal').fetchall())
+
 
 if __name__ == '__main__':
     unittest.main()
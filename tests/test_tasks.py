@@ -1,15 +1,31 @@
+import hashlib
 import json
 import os
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import onedrivesdk
 import requests_mock
 
-from onedrived import get_resource, od_task, od_webhook
+from onedrived import get_resource, od_cache, od_hashutils, od_repo, od_task, od_webhook
+from onedrived.od_api_helper import get_item_modified_datetime
+from onedrived.od_dateutils import datetime_to_timestamp
+from onedrived.od_tasks.apply_delta import ApplyDeltaTask
 from onedrived.od_tasks.base import TaskBase
 from onedrived.od_tasks.start_repo import StartRepositoryTask
 from onedrived.od_tasks.update_subscriptions import UpdateSubscriptionTask
+import onedrived.od_tasks.delete_item as delete_item
+import onedrived.od_tasks.download_file as download_file
+import onedrived.od_tasks.journal as journal
 import onedrived.od_tasks.merge_dir as merge_dir
+import onedrived.od_tasks.move_item as move_item
+import onedrived.od_tasks.rescan_dir as rescan_dir
+import onedrived.od_tasks.update_mtime as update_mtime
+import onedrived.od_tasks.upload_file as upload_file
+import onedrived.od_tasks.upload_tree as upload_tree
 
 from tests.test_repo import get_sample_repo
 
@@ -34,12 +50,221 @@ class TasksTestCaseBase(unittest.TestCase):
         self.temp_repo_dir.cleanup()
 
 
+def get_delta_url(repo):
+    return '%sdrives/%s/items/root/view.delta' % (repo.authenticator.client.base_url, repo.drive.id)
+
+
 class TestStartRepositoryTask(TasksTestCaseBase):
 
-    def test_handle(self):
+    @requests_mock.mock()
+    def test_handle(self, m):
+        m.get(get_delta_url(self.repo) + '?token=latest', json={'value': [], '@delta.token': 'token1'})
         task = StartRepositoryTask(self.repo, self.task_pool)
         task.handle()
         self.assertEqual(1, self.task_pool.outstanding_task_count)
+        merge_task = self.task_pool.pop_task()
+        self.assertIsInstance(merge_task, merge_dir.MergeDirectoryTask)
+        # Last session did not end cleanly.
+        self.assertFalse(merge_task.allow_prune)
+        self.assertEqual('token1', self.repo.get_state(od_repo.RepositoryStateKey.DELTA_TOKEN))
+        self.task_pool.task_done(merge_task)
+        task.handle()
+        self.assertTrue(self.task_pool.pop_task().allow_prune)
+
+    def test_scan_local_dirs(self):
+        folder_item = onedrivesdk.Item(json.loads(get_resource('data/folder_item.json', pkg_name='tests')))
+        file_item = onedrivesdk.Item(json.loads(get_resource('data/folder_child_item.json', pkg_name='tests')))
+        os.mkdir(self.repo.local_root + '/edited')
+        os.mkdir(self.repo.local_root + '/' + folder_item.name)
+        with open(self.repo.local_root + '/edited/' + file_item.name, 'w') as f:
+            f.write('edited')
+        temp_file_path = self.repo.local_root + '/edited/' + self.repo.path_filter.get_temp_name('foo')
+        with open(temp_file_path, 'w') as f:
+            f.write('partial')
+        self.repo.update_item(folder_item, '', 0)
+        self.repo.update_item(file_item, '/edited', file_item.size)
+        for rel_path in ('', '/edited'):
+            self.repo.update_dir_snapshot(rel_path, os.stat(self.repo.local_root + rel_path).st_mtime_ns)
+        changed_dirs, unsynced_dirs, new_dirs = StartRepositoryTask(self.repo, self.task_pool)._scan_local_dirs()
+        self.assertEqual(['/edited'], changed_dirs)
+        self.assertEqual(['/' + folder_item.name], unsynced_dirs)
+        self.assertEqual([], new_dirs)
+        # A download replayed from task journal may be writing it.
+        self.assertTrue(os.path.exists(temp_file_path))
+
+    def test_handle_after_clean_shutdown(self):
+        os.mkdir(self.repo.local_root + '/unchanged')
+        os.mkdir(self.repo.local_root + '/changed')
+        for rel_path in ('', '/unchanged', '/changed'):
+            self.repo.update_dir_snapshot(rel_path, os.stat(self.repo.local_root + rel_path).st_mtime_ns)
+        os.mkdir(self.repo.local_root + '/new')
+        os.mkdir(self.repo.local_root + '/new/sub')
+        os.mkdir(self.repo.local_root + '/changed/sub')
+        self.repo.update_dir_snapshot('/changed/sub', os.stat(self.repo.local_root + '/changed/sub').st_mtime_ns)
+        self.repo.set_state(od_repo.RepositoryStateKey.DELTA_TOKEN, 'token1')
+        self.repo.was_shut_down_cleanly = True
+        StartRepositoryTask(self.repo, self.task_pool).handle()
+        task = self.task_pool.pop_task()
+        self.assertIsInstance(task, ApplyDeltaTask)
+        self.assertEqual({'', '/changed'}, task.local_changed_dirs)
+        self.assertEqual({'/new'}, task.local_new_dirs)
+        self.assertFalse(self.repo.was_shut_down_cleanly)
+        self.assertEqual('1', self.repo.get_state(od_repo.RepositoryStateKey.JOURNAL_CONSISTENT))
+
+    def test_handle_after_crash(self):
+        self.repo.update_dir_snapshot('', os.stat(self.repo.local_root).st_mtime_ns)
+        self.repo.set_state(od_repo.RepositoryStateKey.DELTA_TOKEN, 'token1')
+        self.assertFalse(StartRepositoryTask.can_skip_full_merge(self.repo))
+        # Last session crashed, but its unfinished tasks are in task journal.
+        self.repo.is_journal_consistent = True
+        StartRepositoryTask(self.repo, self.task_pool).handle()
+        self.assertIsInstance(self.task_pool.pop_task(), ApplyDeltaTask)
+        self.assertFalse(self.repo.is_journal_consistent)
+
+
+class TestApplyDeltaTask(TasksTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.child_item = json.loads(get_resource('data/folder_child_item.json', pkg_name='tests'))
+        self.repo.set_state(od_repo.RepositoryStateKey.DELTA_TOKEN, 'token1')
+
+    def _mock_delta(self, m, items):
+        m.get(get_delta_url(self.repo) + '?token=token1',
+              json={'value': [], '@odata.nextLink': get_delta_url(self.repo) + '?token=token2'})
+        m.get(get_delta_url(self.repo) + '?token=token2', json={'value': items, '@delta.token': 'token3'})
+
+    def _pop_all_tasks(self):
+        return [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+
+    @requests_mock.mock()
+    def test_handle(self, m):
+        self._mock_delta(m, [self.child_item])
+        os.mkdir(self.repo.local_root + '/Public')
+        ApplyDeltaTask(self.repo, self.task_pool, local_changed_dirs=['/foo']).handle()
+        self.assertEqual('token3', self.repo.get_state(od_repo.RepositoryStateKey.DELTA_TOKEN))
+        merge_task, changes_task = self._pop_all_tasks()
+        self.assertEqual('/foo', merge_task.rel_path)
+        self.assertTrue(merge_task.assume_remote_unchanged)
+        self.assertFalse(merge_task.deep_merge)
+        self.assertIsInstance(changes_task, merge_dir.MergeRemoteChangesTask)
+        self.assertEqual('/Public', changes_task.rel_path)
+        changes_task.handle()
+        download_task = self.task_pool.pop_task()
+        self.assertIsInstance(download_task, download_file.DownloadFileTask)
+        self.assertEqual(self.repo.local_root + '/Public/' + self.child_item['name'], download_task.local_abspath)
+
+    @requests_mock.mock()
+    def test_handle_dir_changed_on_both_sides(self, m):
+        self._mock_delta(m, [self.child_item])
+        os.mkdir(self.repo.local_root + '/Public')
+        ApplyDeltaTask(self.repo, self.task_pool, local_changed_dirs=['/Public']).handle()
+        merge_task, = self._pop_all_tasks()
+        self.assertNotIsInstance(merge_task, merge_dir.MergeRemoteChangesTask)
+        self.assertEqual('/Public', merge_task.rel_path)
+        self.assertFalse(merge_task.assume_remote_unchanged)
+
+    @requests_mock.mock()
+    def test_handle_pending_merge(self, m):
+        self._mock_delta(m, [self.child_item])
+        os.mkdir(self.repo.local_root + '/Public')
+        pending_task = merge_dir.MergeDirectoryTask(
+            self.repo, self.task_pool, '/Public', item_request=None, deep_merge=False,
+            assume_remote_unchanged=True, parent_remote_unchanged=True)
+        self.task_pool.add_task(pending_task)
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        self.assertEqual([pending_task], self._pop_all_tasks())
+        self.assertFalse(pending_task.assume_remote_unchanged)
+
+    @requests_mock.mock()
+    def test_handle_missing_local_dir(self, m):
+        self._mock_delta(m, [self.child_item])
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        merge_task, = self._pop_all_tasks()
+        self.assertEqual('', merge_task.rel_path)
+        self.assertTrue(merge_task.deep_merge)
+
+    @requests_mock.mock()
+    def test_handle_deleted_file(self, m):
+        child_item = onedrivesdk.Item(self.child_item)
+        self.repo.update_item(child_item, '/Public', child_item.size)
+        self._mock_delta(m, [{'id': child_item.id, 'name': child_item.name, 'deleted': {}}])
+        os.mkdir(self.repo.local_root + '/Public')
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        changes_task, = self._pop_all_tasks()
+        changes_task.handle()
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+        self.assertIsNone(self.repo.get_item_by_id(child_item.id))
+
+    @requests_mock.mock()
+    def test_handle_deleted_folder_with_content_cache(self, m):
+        data = b'license'
+        folder_item = json.loads(get_resource('data/folder_item.json', pkg_name='tests'))
+        self.child_item['size'] = len(data)
+        self.child_item['file']['hashes']['sha1Hash'] = hashlib.sha1(data).hexdigest().upper()
+        child_item = onedrivesdk.Item(json.loads(json.dumps(self.child_item)))
+        self.repo.update_item(onedrivesdk.Item(dict(folder_item)), '', 0)
+        os.mkdir(self.repo.local_root + '/Public')
+        with open(self.repo.local_root + '/Public/' + child_item.name, 'wb') as f:
+            f.write(data)
+        os.utime(self.repo.local_root + '/Public/' + child_item.name,
+                 (0, datetime_to_timestamp(get_item_modified_datetime(child_item)[0])))
+        self.repo.update_item(child_item, '/Public', len(data))
+        self.repo.context.content_cache = od_cache.ContentCache(
+            self.temp_config_dir.name + '/content_cache', 1 << 20, os.getuid())
+        self._mock_delta(m, [{'id': folder_item['id'], 'name': folder_item['name'], 'deleted': {}}])
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        self.assertFalse(os.path.exists(self.repo.local_root + '/Public'))
+        self.assertIsNone(self.repo.get_item_by_id(child_item.id))
+        self.assertIn(child_item.file.hashes.sha1_hash, self.repo.context.content_cache)
+
+    @requests_mock.mock()
+    def test_handle_renamed_folder(self, m):
+        folder_item = json.loads(get_resource('data/folder_item.json', pkg_name='tests'))
+        self.repo.update_item(onedrivesdk.Item(dict(folder_item)), '', 0)
+        self.repo.update_item(onedrivesdk.Item(dict(self.child_item)), '/Public', self.child_item['size'])
+        os.mkdir(self.repo.local_root + '/Public')
+        folder_item['name'] = 'Public2'
+        self._mock_delta(m, [folder_item])
+        ApplyDeltaTask(self.repo, self.task_pool, local_changed_dirs=['/Public']).handle()
+        self.assertTrue(os.path.isdir(self.repo.local_root + '/Public2'))
+        self.assertEqual('/Public2', self.repo.get_item_by_id(self.child_item['id']).parent_path)
+        merge_task, = self._pop_all_tasks()
+        self.assertEqual('/Public2', merge_task.rel_path)
+
+    @requests_mock.mock()
+    def test_handle_items_without_parent_path(self, m):
+        folder_item = json.loads(get_resource('data/folder_item.json', pkg_name='tests'))
+        root_item = {'id': folder_item['parentReference']['id'], 'name': 'root', 'folder': {}, 'root': {}}
+        new_folder_item = dict(folder_item, id='new_folder_id', name='New', parentReference={'id': folder_item['id']})
+        new_file_item = dict(self.child_item, parentReference={'id': 'new_folder_id'})
+        orphan_item = dict(self.child_item, id='orphan_id', parentReference={'id': 'unknown_id'})
+        self.repo.update_item(onedrivesdk.Item(dict(folder_item)), '', 0)
+        self.repo.context.user_uid = os.getuid()
+        os.mkdir(self.repo.local_root + '/Public')
+        self._mock_delta(m, [root_item, new_folder_item, new_file_item])
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        self.assertTrue(os.path.isdir(self.repo.local_root + '/Public/New'))
+        changes_task, = self._pop_all_tasks()
+        self.assertIsInstance(changes_task, merge_dir.MergeRemoteChangesTask)
+        self.assertEqual('/Public/New', changes_task.rel_path)
+        # An item whose parent can't be resolved is merged with the whole Drive.
+        self.repo.set_state(od_repo.RepositoryStateKey.DELTA_TOKEN, 'token1')
+        self._mock_delta(m, [root_item, orphan_item])
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        merge_task, = self._pop_all_tasks()
+        self.assertEqual('', merge_task.rel_path)
+        self.assertTrue(merge_task.deep_merge)
+
+    @requests_mock.mock()
+    def test_handle_without_token(self, m):
+        self.repo.set_state(od_repo.RepositoryStateKey.DELTA_TOKEN, None)
+        m.get(get_delta_url(self.repo) + '?token=latest', json={'value': [], '@delta.token': 'token1'})
+        ApplyDeltaTask(self.repo, self.task_pool).handle()
+        task = self.task_pool.pop_task()
+        self.assertEqual('', task.rel_path)
+        self.assertTrue(task.deep_merge)
+        self.assertEqual('token1', self.repo.get_state(od_repo.RepositoryStateKey.DELTA_TOKEN))
 
 
 class TestUpdateSubscriptionTask(TasksTestCaseBase):
@@ -114,6 +339,563 @@ class TestMergeDirTask(TasksTestCaseBase):
         self.assertIsNone(merge_dir.get_os_stat('/foo/bar/baz/blah'))
         self.assertIsNotNone(merge_dir.get_os_stat('/'))
 
+    def _get_pruned_subtree(self):
+        item = onedrivesdk.Item(json.loads(get_resource('data/folder_item.json', pkg_name='tests')))
+        self.repo.update_item(item, '', size_local=0)
+        os.mkdir(self.repo.local_root + '/Public')
+        for rel_path in ('/Public/unchanged', '/Public/changed'):
+            os.mkdir(self.repo.local_root + rel_path)
+            self.repo.update_item(self._get_folder_item(rel_path), '/Public', 0)
+        for rel_path in ('/Public', '/Public/unchanged', '/Public/changed'):
+            self.repo.update_dir_snapshot(rel_path, os.stat(self.repo.local_root + rel_path).st_mtime_ns)
+        self._generate_random_files(('Public/changed/foo',))
+        os.mkdir(self.repo.local_root + '/Public/new')
+        return item
+
+    @staticmethod
+    def _get_folder_item(rel_path):
+        item = onedrivesdk.Item(json.loads(get_resource('data/folder_item.json', pkg_name='tests')))
+        item.id = rel_path
+        item.name = os.path.basename(rel_path)
+        return item
+
+    def test_prune_unchanged_subtree(self):
+        item = self._get_pruned_subtree()
+        task = merge_dir.MergeDirectoryTask(self.repo, self.task_pool, '', item_request=None)
+        task._handle_remote_folder(item, self.repo.local_root + '/Public', self.repo.get_item_by_path('Public', ''),
+                                   set())
+        tasks = [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+        merge_tasks = [t for t in tasks if isinstance(t, merge_dir.MergeDirectoryTask)]
+        # Adding "new" changed the mtime of "Public".
+        self.assertEqual(['/Public', '/Public/changed'], sorted(t.rel_path for t in merge_tasks))
+        for t in merge_tasks:
+            self.assertFalse(t.deep_merge)
+            self.assertTrue(t.assume_remote_unchanged and t.parent_remote_unchanged)
+        create_tasks = [t for t in tasks if isinstance(t, merge_dir.CreateFolderTask)]
+        self.assertEqual([self.repo.local_root + '/Public/new'], [t.local_abspath for t in create_tasks])
+
+    def test_not_prune_subtree_of_failed_task(self):
+        item = self._get_pruned_subtree()
+        self.repo.mark_task_failed(self.repo.local_root + '/Public/unchanged/foo')
+        task = merge_dir.MergeDirectoryTask(self.repo, self.task_pool, '', item_request=None)
+        task._handle_remote_folder(item, self.repo.local_root + '/Public', self.repo.get_item_by_path('Public', ''),
+                                   set())
+        merge_task, = [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+        self.assertEqual('/Public', merge_task.rel_path)
+        self.assertTrue(merge_task.deep_merge)
+        self.assertFalse(merge_task.assume_remote_unchanged)
+        self.assertIsNone(self.repo.get_item_by_path('unchanged', '/Public').c_tag)
+        # Dirs beside the path of the failed task are left alone.
+        self.assertIsNotNone(self.repo.get_item_by_path('changed', '/Public').c_tag)
+
+    def test_not_prune_in_recovery_merge(self):
+        item = self._get_pruned_subtree()
+        task = merge_dir.MergeDirectoryTask(self.repo, self.task_pool, '', item_request=None, allow_prune=False)
+        task._handle_remote_folder(item, self.repo.local_root + '/Public', self.repo.get_item_by_path('Public', ''),
+                                   set())
+        merge_task, = [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+        self.assertEqual('/Public', merge_task.rel_path)
+        self.assertTrue(merge_task.deep_merge)
+        self.assertFalse(merge_task.allow_prune)
+        self.assertFalse(journal.create_task(self.repo, self.task_pool, od_repo.TaskJournalEntry(
+            0, *journal.get_descriptor(merge_task))).allow_prune)
+
+    def test_not_prune_unsynced_subtree(self):
+        self._get_pruned_subtree()
+        # A merge under the subtree did not finish.
+        self.repo.delete_dir_snapshot('/Public/unchanged')
+        task = merge_dir.MergeDirectoryTask(self.repo, self.task_pool, '', item_request=None)
+        self.assertFalse(task._prune_subtree('/Public'))
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+
+    def _get_local_only_task(self):
+        os.mkdir(self.repo.local_root + '/Public')
+        item = onedrivesdk.Item(json.loads(get_resource('data/folder_child_item.json', pkg_name='tests')))
+        self.repo.update_item(item, '/Public', item.size)
+        task = merge_dir.MergeDirectoryTask(
+            self.repo, self.task_pool, '/Public', item_request=None, deep_merge=False,
+            assume_remote_unchanged=True, parent_remote_unchanged=True)
+        return item, task
+
+    def test_dead_record_of_local_only_merge(self):
+        item, task = self._get_local_only_task()
+        task.handle()
+        delete_task = self.task_pool.pop_task()
+        self.assertIsInstance(delete_task, delete_item.DeleteRemoteItemTask)
+        self.assertEqual(item.id, delete_task.item_id)
+        self.assertEqual(self.repo.local_root + '/Public/' + item.name, delete_task.local_abspath)
+
+    def test_dead_record_of_appeared_item(self):
+        item, task = self._get_local_only_task()
+        task.list_local_names = lambda: set()
+        self._generate_random_files(('Public/' + item.name,))
+        task.handle()
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+
+    def test_fingerprint_of_changed_file(self):
+        item, task = self._get_local_only_task()
+        local_path = self.repo.local_root + '/Public/' + item.name
+        with open(local_path, 'wb') as f:
+            f.write(b'\0' * item.size)
+        self.repo.update_item(item, '/Public', item.size)
+        # A header change keeps the size of the file.
+        with open(local_path, 'r+b') as f:
+            f.write(b'\1')
+        os.utime(local_path, (1, 1))
+        with mock.patch.object(merge_dir, 'sha1_value') as mock_sha1_value:
+            task.handle()
+            mock_sha1_value.assert_not_called()
+        upload_task = self.task_pool.pop_task()
+        self.assertIsInstance(upload_task, upload_file.UploadFileTask)
+        self.assertEqual(local_path, upload_task.local_abspath)
+
+    def test_prefetch_sha1_values(self):
+        item, task = self._get_local_only_task()
+        self._generate_random_files(('Public/' + item.name, 'Public/untracked'))
+        local_path = self.repo.local_root + '/Public/' + item.name
+        os.truncate(local_path, item.size)
+        self.repo.context.hash_service = od_hashutils.HashService(1)
+        try:
+            task._prefetch_sha1_values([], self.repo.get_immediate_children_of_dir('/Public'))
+            # Only the file with the size of its record but another mtime needs hashing.
+            self.assertEqual([local_path], list(task._sha1_futures.keys()))
+            self.assertEqual(od_hashutils.sha1_value(local_path), task._get_sha1_value(local_path))
+            self.assertEqual(0, len(task._sha1_futures))
+        finally:
+            self.repo.context.hash_service.shutdown()
+
+
+class TestOfflineMove(TasksTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.item = onedrivesdk.Item(json.loads(get_resource('data/folder_child_item.json', pkg_name='tests')))
+        os.mkdir(self.repo.local_root + '/Public')
+        with open(self.repo.local_root + '/Public/' + self.item.name, 'w') as f:
+            f.write('license')
+        os.utime(self.repo.local_root + '/Public/' + self.item.name,
+                 (0, datetime_to_timestamp(get_item_modified_datetime(self.item)[0])))
+        self.repo.update_item(self.item, '/Public', 7)
+        os.rename(self.repo.local_root + '/Public/' + self.item.name, self.repo.local_root + '/Public/LICENSE.txt')
+        self.task = merge_dir.MergeDirectoryTask(
+            self.repo, self.task_pool, '/Public', item_request=None, deep_merge=False,
+            assume_remote_unchanged=True, parent_remote_unchanged=True)
+
+    @requests_mock.mock()
+    def test_move_renamed_file(self, m):
+        moved_item = json.loads(get_resource('data/folder_child_item.json', pkg_name='tests'))
+        moved_item['name'] = 'LICENSE.txt'
+        m.patch('%sdrives/%s/items/%s' % (self.repo.authenticator.client.base_url, self.repo.drive.id, self.item.id),
+                json=moved_item)
+        self.task.handle()
+        self.assertIsNone(self.repo.get_item_by_path(self.item.name, '/Public'))
+        self.assertEqual(self.item.id, self.repo.get_item_by_path('LICENSE.txt', '/Public').item_id)
+        # Deletion of the old remote item queued for the dead record is skipped.
+        delete_task = self.task_pool.pop_task()
+        self.assertIsInstance(delete_task, delete_item.DeleteRemoteItemTask)
+        self.assertTrue(delete_task.handle())
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+
+    def test_upload_edited_file(self):
+        with open(self.repo.local_root + '/Public/LICENSE.txt', 'a') as f:
+            f.write(' edited')
+        self.assertFalse(self.task._move_from_record(
+            'LICENSE.txt', os.stat(self.repo.local_root + '/Public/LICENSE.txt'), False))
+
+
+class TestRemoteMove(TasksTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.item = onedrivesdk.Item(json.loads(get_resource('data/folder_child_item.json', pkg_name='tests')))
+        os.mkdir(self.repo.local_root + '/Public')
+        with open(self.repo.local_root + '/Public/' + self.item.name, 'w') as f:
+            f.write('license')
+        os.utime(self.repo.local_root + '/Public/' + self.item.name,
+                 (0, datetime_to_timestamp(get_item_modified_datetime(self.item)[0])))
+        self.repo.update_item(self.item, '/Public', 7)
+        self.task = merge_dir.MergeDirectoryTask(self.repo, self.task_pool, '/Public', item_request=None)
+
+    def _get_renamed_item(self):
+        renamed_item = json.loads(get_resource('data/folder_child_item.json', pkg_name='tests'))
+        renamed_item['name'] = 'LICENSE.txt'
+        return onedrivesdk.Item(renamed_item)
+
+    def test_rename_local_file(self):
+        all_local_items = {self.item.name}
+        all_records = self.repo.get_immediate_children_of_dir('/Public')
+        self.task._handle_remote_item(self._get_renamed_item(), all_local_items, all_records)
+        self.assertTrue(os.path.isfile(self.repo.local_root + '/Public/LICENSE.txt'))
+        self.assertEqual('LICENSE.txt', self.repo.get_item_by_id(self.item.id).item_name)
+        self.assertEqual(set(), all_local_items)
+        self.assertEqual({}, all_records)
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+
+    def test_download_over_edited_file(self):
+        with open(self.repo.local_root + '/Public/' + self.item.name, 'a') as f:
+            f.write(' edited')
+        self.task._handle_remote_item(self._get_renamed_item(), {self.item.name}, {})
+        self.assertFalse(os.path.exists(self.repo.local_root + '/Public/LICENSE.txt'))
+        self.assertIsInstance(self.task_pool.pop_task(), download_file.DownloadFileTask)
+
+
+class TestUploadFileTask(TasksTestCaseBase):
+
+    MONITOR_URL = 'https://monitor.onedrive.com/copy/1'
+
+    def setUp(self):
+        super().setUp()
+        data = b'duplicate data'
+        self.sha1_hash = hashlib.sha1(data).hexdigest().upper()
+        self.source_item = self._get_item('xybu_id!339', 'LICENSE')
+        self.repo.update_item(onedrivesdk.Item(self.source_item), '/Public', len(data))
+        os.mkdir(self.repo.local_root + '/Docs')
+        with open(self.repo.local_root + '/Docs/copy.txt', 'wb') as f:
+            f.write(data)
+        self.task = upload_file.UploadFileTask(self.repo, self.task_pool, None, '/Docs', 'copy.txt')
+        self.task.COPY_FILE_SIZE_THRESHOLD_BYTES = 0
+
+    def _get_item(self, item_id, name):
+        item = json.loads(get_resource('data/folder_child_item.json', pkg_name='tests'))
+        item['id'] = item_id
+        item['name'] = name
+        item['size'] = len(b'duplicate data')
+        item['file']['hashes']['sha1Hash'] = self.sha1_hash
+        return item
+
+    def _get_item_url(self, item_id):
+        return '%sdrives/%s/items/%s' % (self.repo.authenticator.client.base_url, self.repo.drive.id, item_id)
+
+    @requests_mock.mock()
+    def test_copy_remote_duplicate(self, m):
+        copy_item = self._get_item('new_id', 'copy.txt')
+        m.post(self._get_item_url(self.source_item['id']) + '/action.copy', status_code=202,
+               headers={'Location': self.MONITOR_URL})
+        m.get(self.MONITOR_URL, json={'status': 'completed', 'resourceId': 'new_id'})
+        m.get(self._get_item_url('new_id'), json=copy_item)
+        m.patch(self._get_item_url('new_id'), json=copy_item)
+        self.assertTrue(self.task.handle())
+        self.assertEqual('new_id', self.repo.get_item_by_path('copy.txt', '/Docs').item_id)
+
+    @requests_mock.mock()
+    def test_copy_failed(self, m):
+        m.post(self._get_item_url(self.source_item['id']) + '/action.copy', status_code=202,
+               headers={'Location': self.MONITOR_URL})
+        m.get(self.MONITOR_URL, json={'status': 'failed'})
+        self.assertIsNone(self.task._copy_remote_duplicate(os.stat(self.task.local_abspath)))
+
+    def test_no_remote_duplicate_of_size(self):
+        with open(self.task.local_abspath, 'ab') as f:
+            f.write(b'more data')
+        with mock.patch.object(upload_file, 'sha1_value') as mock_sha1_value:
+            self.assertIsNone(self.task._copy_remote_duplicate(os.stat(self.task.local_abspath)))
+            mock_sha1_value.assert_not_called()
+
+    @requests_mock.mock()
+    def test_source_changed_during_upload(self, m):
+        copy_item = self._get_item('new_id', 'copy.txt')
+
+        def get_copy_item(request, context):
+            with open(self.task.local_abspath, 'ab') as f:
+                f.write(b'new data')
+            return copy_item
+
+        m.post(self._get_item_url(self.source_item['id']) + '/action.copy', status_code=202,
+               headers={'Location': self.MONITOR_URL})
+        m.get(self.MONITOR_URL, json={'status': 'completed', 'resourceId': 'new_id'})
+        m.get(self._get_item_url('new_id'), json=get_copy_item)
+        self.repo.context.loop = mock.MagicMock()
+        self.assertTrue(self.task.handle())
+        # The stale remote file is not recorded, and the file will be uploaded again.
+        self.assertIsNone(self.repo.get_item_by_path('copy.txt', '/Docs'))
+        self.assertFalse(self.task_pool.has_pending_task(self.task.local_abspath))
+        loop = self.repo.context.loop
+        loop.call_soon_threadsafe.assert_called_once_with(
+            loop.call_later, self.task.RESCHEDULE_DELAY_SEC, mock.ANY, None)
+        new_task = loop.call_soon_threadsafe.call_args[0][2].__self__
+        self.assertIsInstance(new_task, upload_file.UploadFileTask)
+        self.assertEqual(self.task.local_abspath, new_task.local_abspath)
+
+    def _count_journal_entries(self):
+        return self.repo._conn.execute('SELECT COUNT(*) FROM task_journal').fetchone()[0]
+
+    @mock.patch.object(upload_file.UploadFileTask, 'STABILITY_CHECK_SIZE_BYTES', 0)
+    def test_hold_unstable_file(self):
+        self.task_pool.set_journal(self.repo, max_tasks_in_memory=10)
+        self.task_pool.add_task(self.task)
+        self.assertIs(self.task, self.task_pool.pop_task())
+        self.repo.context.loop = mock.MagicMock()
+        with mock.patch.object(upload_file, 'is_open_for_writing', return_value=False):
+            self.assertTrue(self.task.handle())
+            self.task_pool.task_done(self.task)
+            loop = self.repo.context.loop
+            delay_sec, resume, held_journal_seq = loop.call_soon_threadsafe.call_args[0][1:]
+            self.assertTrue(0 < delay_sec <= self.task.MIN_SETTLE_SEC)
+            # The upload is kept in task journal while it's held.
+            self.assertEqual(1, self._count_journal_entries())
+            with open(self.task.local_abspath, 'ab') as f:
+                f.write(b'more data')
+            resume(held_journal_seq)
+            self.assertEqual(1, self._count_journal_entries())
+            new_task = self.task_pool.pop_task()
+            self.assertTrue(new_task.handle())
+            # The file is still being written, so it's held for longer.
+            held_task = loop.call_soon_threadsafe.call_args[0][2].__self__
+            self.assertEqual(self.task.MIN_SETTLE_SEC * 2, held_task.settle_sec)
+            os.utime(new_task.local_abspath, (1, 1))
+            self.assertEqual(0, new_task._get_hold_sec(os.stat(new_task.local_abspath)))
+
+    @mock.patch.object(upload_file.UploadFileTask, 'STABILITY_CHECK_SIZE_BYTES', 0)
+    def test_hold_file_open_for_writing(self):
+        now = os.stat(self.task.local_abspath).st_mtime + self.task.MIN_SETTLE_SEC
+        with mock.patch.object(upload_file, 'is_open_for_writing', return_value=True) as mock_is_open, \
+                mock.patch.object(upload_file.time, 'time', side_effect=lambda: now):
+            hold_secs = []
+            while True:
+                hold_sec = self.task._get_hold_sec(os.stat(self.task.local_abspath))
+                if hold_sec == 0:
+                    break
+                hold_secs.append(hold_sec)
+                now += hold_sec
+            # Checks back off, and stop once the file has been unchanged for long.
+            self.assertEqual([10, 20, 40, 80, 145], hold_secs)
+            self.assertEqual(5, mock_is_open.call_count)
+            mock_is_open.reset_mock()
+            self.assertEqual(0, self.task._get_hold_sec(os.stat(self.task.local_abspath)))
+            mock_is_open.assert_not_called()
+
+    def test_abort_upload_of_changed_source(self):
+        self.task._source_snapshot = upload_file.get_file_snapshot(os.stat(self.task.local_abspath))
+        self.task.update_progress(1, 3)
+        self.task.mark_source_changed()
+        self.assertRaises(upload_file.SourceChangedException, self.task.update_progress, 2, 3)
+        self.task._source_changed = False
+        os.truncate(self.task.local_abspath, 1)
+        self.assertRaises(upload_file.SourceChangedException, self.task.update_progress, 2, 3)
+        # Nothing is left to send after the last part.
+        self.task.update_progress(3, 3)
+
+
+class TestUploadTreeTask(TasksTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.folder_item = json.loads(get_resource('data/folder_item.json', pkg_name='tests'))
+        self.children_url = '%sdrives/%s/items/root/children' % (
+            self.repo.authenticator.client.base_url, self.repo.drive.id)
+        os.makedirs(self.repo.local_root + '/Public/sub')
+        for name in ('a.txt', 'sub/b.txt', self.repo.path_filter.get_temp_name('c.txt')):
+            with open(self.repo.local_root + '/Public/' + name, 'w') as f:
+                f.write(name)
+        self.task = upload_tree.UploadTreeTask(self.repo, self.task_pool, 'Public', '')
+
+    @requests_mock.mock()
+    def test_handle(self, m):
+        m.post(self.children_url, json=self.folder_item)
+        self.assertTrue(self.task.handle())
+        self.assertEqual(self.folder_item['id'], self.repo.get_item_by_path('Public', '').item_id)
+        self.assertIn('/Public', self.repo.get_dir_snapshots())
+        tasks = [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+        self.assertEqual({(upload_file.UploadFileTask, '/Public/a.txt'), (upload_tree.UploadTreeTask, '/Public/sub')},
+                         {(type(t), t.rel_path) for t in tasks})
+        # Only the remote folder was created. No dir was listed.
+        self.assertEqual(1, m.call_count)
+
+    @requests_mock.mock()
+    def test_handle_name_conflict(self, m):
+        m.post(self.children_url, status_code=409, json={'error': {'code': 'nameAlreadyExists', 'message': 'Exists.'}})
+        self.assertTrue(self.task.handle())
+        task, = [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+        self.assertIsInstance(task, merge_dir.MergeDirectoryTask)
+        self.assertEqual('/Public', task.rel_path)
+
+
+class TestRescanLocalDirTask(TasksTestCaseBase):
+
+    def test_handle(self):
+        folder_item = onedrivesdk.Item(json.loads(get_resource('data/folder_item.json', pkg_name='tests')))
+        self.repo.update_item(folder_item, '', 0)
+        os.makedirs(self.repo.local_root + '/Public/new')
+        with open(self.repo.local_root + '/Public/a.txt', 'w') as f:
+            f.write('a')
+        self.repo.update_dir_snapshot('/Public', os.stat(self.repo.local_root + '/Public').st_mtime_ns)
+        # The scan starts from the closest dir that exists.
+        self.assertTrue(rescan_dir.RescanLocalDirTask(self.repo, self.task_pool, '/Public/gone').handle())
+        tasks = [self.task_pool.pop_task() for _ in range(self.task_pool.outstanding_task_count)]
+        self.assertEqual({(merge_dir.MergeDirectoryTask, '/Public'), (upload_tree.UploadTreeTask, '/Public/new')},
+                         {(type(t), t.rel_path) for t in tasks})
+        self.assertFalse(next(t for t in tasks if isinstance(t, merge_dir.MergeDirectoryTask)).deep_merge)
+
+
+class TestDeleteRemoteItemTask(TasksTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.item = onedrivesdk.Item(json.loads(get_resource('data/folder_child_item.json', pkg_name='tests')))
+        self.repo.update_item(self.item, '/Public', self.item.size)
+        self.task = delete_item.DeleteRemoteItemTask(
+            self.repo, self.task_pool, '/Public', self.item.name, item_id=self.item.id)
+        self.item_url = '%sdrives/%s/items/%s' % (
+            self.repo.authenticator.client.base_url, self.repo.drive.id, self.item.id)
+
+    @requests_mock.mock()
+    def test_handle(self, m):
+        m.delete(self.item_url, status_code=204)
+        self.assertTrue(self.task.handle())
+        self.assertIsNone(self.repo.get_item_by_id(self.item.id))
+
+    @requests_mock.mock()
+    def test_handle_item_not_found(self, m):
+        m.delete(self.item_url, status_code=404, json={'error': {'code': 'itemNotFound', 'message': 'Not found.'}})
+        self.assertTrue(self.task.handle())
+        self.assertIsNone(self.repo.get_item_by_id(self.item.id))
+
+    @requests_mock.mock()
+    def test_handle_error(self, m):
+        m.delete(self.item_url, status_code=403, json={'error': {'code': 'accessDenied', 'message': 'Denied.'}})
+        self.assertFalse(self.task.handle())
+        self.assertIsNotNone(self.repo.get_item_by_id(self.item.id))
+
+
+class TestTaskJournal(TasksTestCaseBase):
+
+    def _replay(self, task, task_type=None):
+        descriptor = journal.get_descriptor(task)
+        self.assertIsNotNone(descriptor)
+        entry = od_repo.TaskJournalEntry(1, *descriptor)
+        new_task = journal.create_task(self.repo, self.task_pool, entry)
+        self.assertIs(task_type or type(task), type(new_task))
+        self.assertEqual(task.local_abspath, new_task.local_abspath)
+        return new_task
+
+    def test_round_trip(self):
+        item = onedrivesdk.Item(json.loads(get_resource('data/folder_child_item.json', pkg_name='tests')))
+        task = self._replay(download_file.DownloadFileTask(self.repo, self.task_pool, item, '/Public'))
+        self.assertEqual((item.id, item.e_tag), (task.remote_item.id, task.remote_item.e_tag))
+        self.assertFalse(task.has_full_metadata)
+        task = self._replay(upload_file.UploadFileTask(
+            self.repo, self.task_pool, self.repo.authenticator.client.item(drive=self.repo.drive.id, id='root'),
+            '', 'foo'))
+        self.assertEqual('foo', task.item_name)
+        task = self._replay(update_mtime.UpdateTimestampTask(self.repo, self.task_pool, '/a', 'b', item_id='id'))
+        self.assertEqual('id', task.item_id)
+        task = self._replay(delete_item.DeleteRemoteItemTask(self.repo, self.task_pool, '/a', 'b', is_folder=True))
+        self.assertTrue(task.is_folder)
+        task = self._replay(move_item.MoveItemTask(self.repo, self.task_pool, '/a', 'b', new_parent_relpath='/c'))
+        self.assertEqual('/c/b', task.new_relpath)
+        task = self._replay(merge_dir.CreateFolderTask(self.repo, self.task_pool, 'b', '/a', upload_if_success=False))
+        self.assertFalse(task.upload_if_success)
+        task = self._replay(upload_tree.UploadTreeTask(self.repo, self.task_pool, 'b', '/a'))
+        self.assertEqual('/a/b', task.rel_path)
+        task = self._replay(rescan_dir.RescanLocalDirTask(self.repo, self.task_pool, '/a'))
+        self.assertEqual('/a', task.rel_path)
+        task = self._replay(merge_dir.MergeDirectoryTask(
+            self.repo, self.task_pool, '/a', None, deep_merge=False, assume_remote_unchanged=True))
+        self.assertFalse(task.deep_merge)
+        # A replayed merge lists the remote dir.
+        self.assertFalse(task.assume_remote_unchanged)
+        self._replay(merge_dir.MergeRemoteChangesTask(self.repo, self.task_pool, '', None, [item]),
+                     task_type=merge_dir.MergeDirectoryTask)
+
+    def test_not_journaled(self):
+        self.assertIsNone(journal.get_descriptor(StartRepositoryTask(self.repo, self.task_pool)))
+        self.assertIsNone(journal.get_descriptor(ApplyDeltaTask(self.repo, self.task_pool)))
+
+    def test_invalid_entry(self):
+        self.assertIsNone(journal.create_task(self.repo, self.task_pool, od_repo.TaskJournalEntry(
+            1, 'unknown', '/a', None, None, None)))
+        self.assertIsNone(journal.create_task(self.repo, self.task_pool, od_repo.TaskJournalEntry(
+            1, 'upload', '', None, None, None)))
+
+
+class TestDownloadFileTask(TasksTestCaseBase):
+
+    def setUp(self):
+        super().setUp()
+        self.item_data = json.loads(get_resource('data/folder_child_item.json', pkg_name='tests'))
+        item = onedrivesdk.Item({'id': self.item_data['id'], 'name': self.item_data['name']})
+        self.task = download_file.DownloadFileTask(self.repo, self.task_pool, item, '/Public', has_full_metadata=False)
+        self.item_url = '%sdrives/%s/items/%s' % (
+            self.repo.authenticator.client.base_url, self.repo.drive.id, self.item_data['id'])
+
+    @requests_mock.mock()
+    def test_fetch_metadata(self, m):
+        m.get(self.item_url, json=self.item_data)
+        self.assertTrue(self.task._fetch_metadata())
+        self.assertTrue(self.task.has_full_metadata)
+        self.assertEqual(self.item_data['size'], self.task.remote_item.size)
+
+    @requests_mock.mock()
+    def test_fetch_metadata_of_moved_item(self, m):
+        self.item_data['parentReference']['path'] = '/drive/root:/Other'
+        m.get(self.item_url, json=self.item_data)
+        self.assertFalse(self.task._fetch_metadata())
+
+    @requests_mock.mock()
+    def test_handle_deleted_item(self, m):
+        m.get(self.item_url, status_code=404, json={'error': {'code': 'itemNotFound', 'message': 'Not found.'}})
+        self.assertTrue(self.task.handle())
+        self.assertFalse(os.path.exists(self.task.local_abspath))
+
+    @requests_mock.mock()
+    def test_handle_with_local_duplicate(self, m):
+        data = b'license'
+        self.item_data['size'] = len(data)
+        self.item_data['file']['hashes']['sha1Hash'] = hashlib.sha1(data).hexdigest().upper()
+        m.get(self.item_url, json=self.item_data)
+        duplicate = onedrivesdk.Item(json.loads(json.dumps(dict(self.item_data, id='duplicate_id'))))
+        for rel_path in ('/Public', '/Backup'):
+            os.mkdir(self.repo.local_root + rel_path)
+        with open(self.repo.local_root + '/Backup/' + duplicate.name, 'wb') as f:
+            f.write(data)
+        os.utime(self.repo.local_root + '/Backup/' + duplicate.name,
+                 (0, datetime_to_timestamp(get_item_modified_datetime(duplicate)[0])))
+        self.repo.update_item(duplicate, '/Backup', len(data))
+        self.repo.context.user_uid = os.getuid()
+        # The content is not downloaded.
+        self.assertTrue(self.task.handle())
+        with open(self.task.local_abspath, 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(self.item_data['id'], self.repo.get_item_by_path(duplicate.name, '/Public').item_id)
+
+    @requests_mock.mock()
+    def test_handle_with_cached_content(self, m):
+        data = b'license'
+        self.item_data['size'] = len(data)
+        self.item_data['file']['hashes']['sha1Hash'] = hashlib.sha1(data).hexdigest().upper()
+        m.get(self.item_url, json=self.item_data)
+        os.mkdir(self.repo.local_root + '/Public')
+        cache = od_cache.ContentCache(self.temp_config_dir.name + '/content_cache', 1 << 20, os.getuid())
+        with open(self.temp_config_dir.name + '/cached', 'wb') as f:
+            f.write(data)
+        cache.add_file(self.temp_config_dir.name + '/cached', self.item_data['file']['hashes']['sha1Hash'])
+        self.repo.context.content_cache = cache
+        self.repo.context.user_uid = os.getuid()
+        # The content is not downloaded.
+        self.assertTrue(self.task.handle())
+        with open(self.task.local_abspath, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    @requests_mock.mock()
+    def test_handle_with_lan_peer(self, m):
+        data = b'license'
+        self.item_data['size'] = len(data)
+        self.item_data['file']['hashes']['sha1Hash'] = hashlib.sha1(data).hexdigest().upper()
+        m.get(self.item_url, json=self.item_data)
+        os.mkdir(self.repo.local_root + '/Public')
+
+        def fetch_file(sha1_hash, size, dst_path):
+            with open(dst_path, 'wb') as f:
+                f.write(data)
+            return '127.0.0.1', 7001
+
+        self.repo.context.lan_sync = mock.MagicMock(fetch_file=fetch_file)
+        self.repo.context.user_uid = os.getuid()
+        # The content is not downloaded.
+        self.assertTrue(self.task.handle())
+        with open(self.task.local_abspath, 'rb') as f:
+            self.assertEqual(data, f.read())
+
 
 if __name__ == '__main__':
     unittest.main()
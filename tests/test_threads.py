@@ -1,5 +1,9 @@
 import threading
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from onedrived import od_threads, od_task
 from onedrived.od_tasks.base import TaskBase
@@ -16,6 +20,13 @@ class DummyTask(TaskBase):
         self.sem.release()
 
 
+class FailedTask(DummyTask):
+
+    def handle(self):
+        super().handle()
+        return False
+
+
 class TestTaskWorkerThread(unittest.TestCase):
 
     def setUp(self):
@@ -32,6 +43,19 @@ class TestTaskWorkerThread(unittest.TestCase):
         self.task_pool.close(1)
         w.join(timeout=5)
 
+    def test_failed_task(self):
+        sem = threading.Semaphore(value=0)
+        repo = mock.MagicMock()
+        t = FailedTask(sem, repo, self.task_pool)
+        w = od_threads.TaskWorkerThread('DummyWorker', task_pool=self.task_pool)
+        w.start()
+        self.assertTrue(self.task_pool.add_task(t))
+        self.assertTrue(sem.acquire(timeout=5))
+        w.stop()
+        self.task_pool.close(1)
+        w.join(timeout=5)
+        repo.mark_task_failed.assert_called_once_with('/Dummy')
+
 
 if __name__ == '__main__':
     unittest.main()
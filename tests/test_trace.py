@@ -0,0 +1,83 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+from onedrived import od_api_helper, od_trace
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.trace_path = self.temp_dir.name + '/trace.json'
+
+    def tearDown(self):
+        od_trace.disable_tracing()
+        self.temp_dir.cleanup()
+
+    def _load_events(self, path):
+        with open(path, 'r') as f:
+            return [e for e in json.load(f) if e['ph'] == 'X']
+
+    def test_span_disabled(self):
+        self.assertFalse(od_trace.is_tracing_enabled())
+        with od_trace.span('foo', 'task'):
+            pass
+        self.assertFalse(os.path.exists(self.trace_path))
+
+    def test_nested_spans(self):
+        od_trace.enable_tracing(self.trace_path, max_bytes=1 << 20)
+        self.assertTrue(od_trace.is_tracing_enabled())
+        with od_trace.span('outer', 'task', path='/foo'):
+            with od_trace.span('inner', 'hash'):
+                pass
+        od_trace.disable_tracing()
+        inner, outer = self._load_events(self.trace_path)
+        self.assertEqual('outer', outer['name'])
+        self.assertEqual('/foo', outer['args']['path'])
+        self.assertEqual('hash', inner['cat'])
+        self.assertLessEqual(outer['ts'], inner['ts'])
+        self.assertGreaterEqual(outer['ts'] + outer['dur'], inner['ts'] + inner['dur'])
+
+    def test_rotation(self):
+        od_trace.enable_tracing(self.trace_path, max_bytes=1024)
+        for i in range(100):
+            with od_trace.span('span_%d' % i, 'task'):
+                pass
+        od_trace.disable_tracing()
+        self.assertTrue(os.path.isfile(self.trace_path + '.1'))
+        self.assertLess(0, len(self._load_events(self.trace_path + '.1')))
+        self.assertLess(0, len(self._load_events(self.trace_path)))
+
+    def test_write_error_disables_tracing(self):
+        od_trace.enable_tracing(self.trace_path, max_bytes=1 << 20)
+        # Simulate an I/O failure of the trace file.
+        od_trace._writer._file.close()
+        with od_trace.span('foo', 'task'):
+            pass
+        self.assertFalse(od_trace.is_tracing_enabled())
+
+    def test_api_span_args(self):
+        class FakeRequest:
+            _request_url = 'https://api.onedrive.com/v1.0/drive/items/foo'
+
+            def get(self):
+                return 'bar'
+
+        od_trace.enable_tracing(self.trace_path, max_bytes=1 << 20)
+        self.assertEqual('bar', od_api_helper.item_request_call(None, FakeRequest().get))
+        od_trace.disable_tracing()
+        event, = self._load_events(self.trace_path)
+        self.assertEqual('FakeRequest.get', event['name'])
+        self.assertEqual(FakeRequest._request_url, event['args']['url'])
+
+    def test_dump_thread_stacks(self):
+        dump = od_trace.dump_thread_stacks()
+        self.assertIn(threading.current_thread().name, dump)
+        self.assertIn('test_dump_thread_stacks', dump)
+
+
+if __name__ == '__main__':
+    unittest.main()
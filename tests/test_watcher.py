@@ -1,8 +1,23 @@
+import errno
+import json
+import os
+import shutil
 import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 import inotify_simple
+import onedrivesdk
+import requests_mock
 
-from onedrived import od_task, od_watcher
+from onedrived import get_resource, od_task, od_watcher
+from onedrived.od_tasks.delete_item import DeleteRemoteItemTask
+from onedrived.od_tasks.rescan_dir import RescanLocalDirTask
+from onedrived.od_tasks.upload_file import UploadFileTask
+from onedrived.od_tasks.upload_tree import UploadTreeTask
+from tests.test_repo import get_sample_repo
 
 
 class TestLocalRepositoryWatcher(unittest.TestCase):
@@ -28,5 +43,147 @@ class TestLocalRepositoryWatcher(unittest.TestCase):
         self.assertEqual((ev_b, flags_b), all_events[1])
 
 
+class TestEventHandling(unittest.TestCase):
+
+    def setUp(self):
+        self.task_pool = od_task.TaskPool()
+        self.watcher = od_watcher.LocalRepositoryWatcher(self.task_pool, None)
+        self.temp_config_dir, self.temp_repo_dir, _, self.repo = get_sample_repo()
+        self.folder_item = json.loads(get_resource('data/folder_item.json', pkg_name='tests'))
+        self.repo.update_item(onedrivesdk.Item(json.loads(json.dumps(self.folder_item))), '', 0)
+        os.makedirs(self.repo.local_root + '/Public/sub')
+        for wd, rel_path in ((1, ''), (2, '/Public'), (3, '/Public/sub')):
+            self.watcher.watch_descriptors[wd] = (self.repo, self.repo.local_root + rel_path)
+        self.folder_url = '%sdrives/%s/root:/Public:' % (self.repo.authenticator.client.base_url, self.repo.drive.id)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.temp_config_dir.cleanup()
+        self.temp_repo_dir.cleanup()
+
+    @requests_mock.mock()
+    def test_delete_tree(self, m):
+        m.get(self.folder_url, json=self.folder_item)
+        shutil.rmtree(self.repo.local_root + '/Public')
+        flags = inotify_simple.flags
+        self.watcher.handle_events([
+            inotify_simple.Event(wd=3, mask=flags.DELETE, cookie=0, name='c'),
+            inotify_simple.Event(wd=3, mask=flags.DELETE_SELF, cookie=0, name=''),
+            inotify_simple.Event(wd=3, mask=flags.IGNORED, cookie=0, name=''),
+            inotify_simple.Event(wd=2, mask=flags.DELETE, cookie=0, name='a')])
+        self.watcher.handle_events([
+            inotify_simple.Event(wd=2, mask=flags.DELETE | flags.ISDIR, cookie=0, name='sub'),
+            inotify_simple.Event(wd=2, mask=flags.DELETE_SELF, cookie=0, name=''),
+            inotify_simple.Event(wd=2, mask=flags.IGNORED, cookie=0, name=''),
+            inotify_simple.Event(wd=1, mask=flags.DELETE | flags.ISDIR, cookie=0, name='Public')])
+        self.assertEqual(0, m.call_count)
+        self.watcher.flush_pending_deletes()
+        self.assertEqual(1, m.call_count)
+        self.assertEqual(1, self.task_pool.outstanding_task_count)
+        task = self.task_pool.pop_task()
+        self.assertIsInstance(task, DeleteRemoteItemTask)
+        self.assertEqual('/Public', task.rel_path)
+        self.assertTrue(task.is_folder)
+        self.assertEqual([1], list(self.watcher.watch_descriptors.keys()))
+
+    @requests_mock.mock()
+    def test_skip_recreated_item(self, m):
+        flags = inotify_simple.flags
+        self.watcher.handle_events([inotify_simple.Event(wd=2, mask=flags.DELETE, cookie=0, name='sub')])
+        self.watcher.flush_pending_deletes()
+        self.assertEqual(0, m.call_count)
+        self.assertEqual(0, self.task_pool.outstanding_task_count)
+
+    def test_move_dir(self):
+        flags = inotify_simple.flags
+        with mock.patch.object(self.watcher, '_handle_move_pair') as handle_move_pair:
+            self.watcher.handle_events([
+                inotify_simple.Event(wd=1, mask=flags.MOVED_FROM | flags.ISDIR, cookie=7, name='Public'),
+                inotify_simple.Event(wd=1, mask=flags.MOVED_TO | flags.ISDIR, cookie=7, name='Moved')])
+            self.assertEqual(1, handle_move_pair.call_count)
+        self.assertEqual((self.repo, self.repo.local_root + '/Moved/sub'), self.watcher.watch_descriptors[3])
+        self.assertEqual(2, self.watcher.watch_descriptors.find(self.repo, self.repo.local_root + '/Moved'))
+
+    def test_move_dir_out(self):
+        with mock.patch.object(self.watcher, '_handle_unpaired_move_from') as handle_move_from:
+            self.watcher.handle_events([inotify_simple.Event(
+                wd=1, mask=inotify_simple.flags.MOVED_FROM | inotify_simple.flags.ISDIR, cookie=7, name='Public')])
+            self.assertEqual(1, handle_move_from.call_count)
+        self.assertEqual([1], list(self.watcher.watch_descriptors.keys()))
+
+    def test_write_during_upload(self):
+        local_abspath = self.repo.local_root + '/Public/a.txt'
+        with open(local_abspath, 'w') as f:
+            f.write('a')
+        task = UploadFileTask(self.repo, self.task_pool, None, '/Public', 'a.txt')
+        self.task_pool.occupy_path(local_abspath, task)
+        with mock.patch.object(task, 'mark_source_changed') as mark_source_changed:
+            self.watcher.handle_events([
+                inotify_simple.Event(wd=2, mask=inotify_simple.flags.CLOSE_WRITE, cookie=0, name='a.txt')])
+            mark_source_changed.assert_called_once_with()
+        self.assertIs(task, self.task_pool.has_pending_task(local_abspath))
+
+    def test_overflow(self):
+        flags = inotify_simple.flags
+        self.watcher.handle_events([
+            inotify_simple.Event(wd=3, mask=flags.DELETE, cookie=0, name='gone'),
+            inotify_simple.Event(wd=-1, mask=flags.Q_OVERFLOW, cookie=0, name='')])
+        task = self.task_pool.pop_task()
+        self.assertIsInstance(task, RescanLocalDirTask)
+        self.assertEqual('/Public/sub', task.rel_path)
+        self.watcher.handle_events([inotify_simple.Event(wd=-1, mask=flags.Q_OVERFLOW, cookie=0, name='')])
+        self.assertEqual('', self.task_pool.pop_task().rel_path)
+
+    def test_event_queue(self):
+        flags = inotify_simple.flags
+        watcher = od_watcher.LocalRepositoryWatcher(self.task_pool, mock.MagicMock())
+        watcher.MAX_QUEUED_EVENTS = 4
+        watcher.EVENT_BATCH_SIZE = 2
+        events = [inotify_simple.Event(wd=2, mask=flags.MOVED_FROM, cookie=1, name='a'),
+                  inotify_simple.Event(wd=2, mask=flags.MOVED_FROM, cookie=2, name='b'),
+                  inotify_simple.Event(wd=2, mask=flags.MOVED_TO, cookie=2, name='c'),
+                  inotify_simple.Event(wd=2, mask=flags.DELETE, cookie=0, name='d'),
+                  inotify_simple.Event(wd=2, mask=flags.DELETE, cookie=0, name='e')]
+        try:
+            with mock.patch.object(watcher.notifier, 'read', return_value=events):
+                watcher.process_events()
+            watcher.loop.remove_reader.assert_called_once_with(watcher.notifier.fd)
+            self.assertEqual(1, watcher.loop.call_soon.call_count)
+            with mock.patch.object(watcher, 'handle_events') as handle_events:
+                watcher.process_queued_events()
+                # The batch is extended to keep the move pair together.
+                handle_events.assert_called_with(events[:3])
+                # Reading is resumed when the queue is half drained. The first call is made by the constructor.
+                self.assertEqual(2, watcher.loop.add_reader.call_count)
+                watcher.process_queued_events()
+                handle_events.assert_called_with(events[3:])
+            self.assertEqual(2, watcher.loop.call_soon.call_count)
+        finally:
+            watcher.close()
+
+    def test_poll_over_watch_limit(self):
+        path = self.repo.local_root + '/Public/sub'
+        with mock.patch.object(self.watcher.notifier, 'add_watch', side_effect=OSError(errno.ENOSPC, 'No space')):
+            self.assertTrue(self.watcher.rm_watch(self.repo, path))
+            self.watcher.add_watch(self.repo, path)
+        self.assertIn((self.repo, path), self.watcher.poller)
+        self.watcher._handle_polled_change(self.repo, path, True)
+        task = self.task_pool.pop_task()
+        self.assertEqual('/Public/sub', task.rel_path)
+        self.assertTrue(task.deep_merge)
+        self.assertTrue(self.watcher.rm_watch(self.repo, path))
+        self.assertNotIn((self.repo, path), self.watcher.poller)
+
+    @requests_mock.mock()
+    def test_create_tree(self, m):
+        os.makedirs(self.repo.local_root + '/new/sub')
+        self.watcher.handle_events([inotify_simple.Event(
+            wd=1, mask=inotify_simple.flags.CREATE | inotify_simple.flags.ISDIR, cookie=0, name='new')])
+        self.assertEqual(0, m.call_count)
+        task = self.task_pool.pop_task()
+        self.assertIsInstance(task, UploadTreeTask)
+        self.assertEqual('/new', task.rel_path)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,14 @@
+import asyncio
+import http.client
 import json
 import threading
 import unittest
+from unittest import mock
 
 import onedrivesdk
 
 from onedrived import get_resource, od_webhook
+from onedrived.od_webhooks import async_server, http_server
 
 from tests.test_repo import get_sample_repo
 
@@ -47,6 +51,79 @@ class TestWebhookWorker(unittest.TestCase):
         self.assertEqual([self.repo], self.callback_repos)
         self.assertEqual(1, self.callback_count)
 
+    def test_queue_subscription_ids(self):
+        self.worker.start()
+        subscription = onedrivesdk.Subscription()
+        subscription.id = 's'
+        self.worker.add_subscription(subscription, self.repo)
+        self.worker.queue_subscription_ids({'s', '233'})
+        self.assertTrue(self.callback_called_sem.acquire(timeout=3))
+        self.assertFalse(self.callback_called_sem.acquire(timeout=1))
+        self.assertEqual([self.repo], self.callback_repos)
+
+
+class TestAsyncWebhookListener(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.listener = async_server.WebhookListener(http_server.WebhookConfig(host='localhost'), self.loop)
+        self.worker = mock.MagicMock()
+        self.flushed_sem = threading.Semaphore(value=0)
+        self.worker.queue_subscription_ids.side_effect = lambda ids: self.flushed_sem.release()
+        self.listener.set_worker(self.worker)
+        self.listener.start()
+        self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.loop_thread.start()
+        self.path = '/' + self.listener.session_token
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.loop_thread.join()
+        self.listener.stop()
+        self.loop.close()
+
+    def _get_connection(self):
+        return http.client.HTTPConnection('localhost', self.listener.server_port, timeout=3)
+
+    def test_webhook_url(self):
+        self.assertEqual('http://localhost:%d/%s' % (self.listener.server_port, self.listener.session_token),
+                         self.listener.webhook_url)
+
+    def test_validation(self):
+        conn = self._get_connection()
+        conn.request('POST', self.path + '?validationtoken=abc')
+        response = conn.getresponse()
+        self.assertEqual(200, response.status)
+        self.assertEqual(b'abc', response.read())
+        conn.request('POST', '/wrong_token?validationtoken=abc')
+        response = conn.getresponse()
+        self.assertEqual(401, response.status)
+        response.read()
+        conn.close()
+
+    def test_notifications(self):
+        notification = get_resource('data/webhook_notification.json', pkg_name='tests').encode('utf-8')
+        # A stuck client with an incomplete request should not block others.
+        stuck_conn = self._get_connection()
+        stuck_conn.putrequest('POST', self.path)
+        stuck_conn.putheader('Content-Length', '100')
+        stuck_conn.endheaders(b'{')
+        conn = self._get_connection()
+        # Duplicate notifications on the same kept-alive connection are deduplicated.
+        for _ in range(3):
+            conn.request('POST', self.path, body=notification)
+            response = conn.getresponse()
+            self.assertEqual(200, response.status)
+            response.read()
+        conn.request('POST', self.path, body=b'not json')
+        response = conn.getresponse()
+        self.assertEqual(400, response.status)
+        response.read()
+        conn.close()
+        stuck_conn.close()
+        self.assertTrue(self.flushed_sem.acquire(timeout=3))
+        self.worker.queue_subscription_ids.assert_called_once_with({'s'})
+
 
 if __name__ == '__main__':
     unittest.main()